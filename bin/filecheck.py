@@ -1,26 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import io
 import os
+import bz2
+import gzip
+import hashlib
+import heapq
+import itertools
+import lzma
 import mimetypes
-import shlex
+import posixpath
+import re
+import stat
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import types
 import zipfile
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
-import oletools.oleid
+from oletools import crypto
+from oletools.oleid import detect_flash
 import olefile
 import officedissector
 
-import warnings
 import exifread
-from PIL import Image
+from PIL import Image, ImageSequence, TiffImagePlugin
 # from PIL import PngImagePlugin
 
-from pdfid import PDFiD, cPDFiD
+from pdfid import PDFiD, cPDFiD, cCount
 
-from kittengroomer import FileBase, KittenGroomerBase, main
+from twiggy import emitters, filters, formats, levels, outputs
+
+from kittengroomer import (CopyEngine, CostModel, FileBase, KittenGroomerBase, KittenGroomerError,
+                           Journal, SubtypeDispatcher, VerdictCache, Watchdog, main, get_parser,
+                           mime_detector)
+import kittengroomer.helpers
+import magic
 
 SEVENZ_PATH = '/usr/bin/7z'
 
+# Libraries whose results make the verdicts, their versions are part of _ruleset_version
+ANALYZER_MODULES = ('PIL', 'olefile', 'oletools.oleid', 'oletools.crypto', 'exifread',
+                    'officedissector', 'pdfid')
+
 
 # Prepare application/<subtype>
 mimes_ooxml = ['vnd.openxmlformats-officedocument.']
@@ -34,6 +61,70 @@ mimes_compressed = ['zip', 'rar', 'bzip2', 'lzip', 'lzma', 'lzop',
                     'xz', 'compress', 'gzip', 'tar']
 mimes_data = ['octet-stream']
 
+# Single file compressed streams the stdlib can read, by magic number
+compressed_streams = [
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+]
+
+# Default of the header precheck of image(), which comes on top of PIL's
+# own decompression bomb check: refuse images over its warning limit, PIL
+# itself only refuses twice that.
+MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS
+
+# Names counted by _scan_pdf, by cPDFiD attribute
+PDF_KEYWORDS = {
+    'encrypt': b'Encrypt',
+    'js': b'JS',
+    'javascript': b'JavaScript',
+    'aa': b'AA',
+    'openaction': b'OpenAction',
+    'richmedia': b'RichMedia',
+    'launch': b'Launch',
+}
+# Characters PDFiD reads as part of a name ('\xdf'.upper() is 'SS'), a '#'
+# continues the name with an escaped character
+_pdf_word = rb'0-9A-Za-z\xdf'
+# The names without '#', as a whole word
+_pdf_plain_names = re.compile(rb'/(' + b'|'.join(PDF_KEYWORDS.values()) +
+                              rb')(?![' + _pdf_word + rb'#])')
+# Any name with a '#', decoded by _pdf_hexcode_words
+_pdf_hexcode_names = re.compile(rb'/[' + _pdf_word + rb']*#[' + _pdf_word + rb'#]*')
+_pdf_hexcode = re.compile(rb'[0-9A-Fa-f]{2}')
+
+# Paths of the OLE storages holding VBA macros, lowercase like olefile compares them
+OLE_MACRO_PATHS = {'macros', 'macros/vba', '_vba_project_cur', 'vba'}
+
+# Content and relationship types officedissector reports as macros, ActiveX
+# controls, embedded objects or packages
+OOXML_MARKERS = re.compile(rb'vbaproject|intlmacrosheet|activex|relationships/control|'
+                           rb'relationships/oleobject|relationships/package', re.IGNORECASE)
+# The only content type declaring relationships parts in a plain OOXML package
+OOXML_RELS_TYPE = (b'<Default Extension="rels" '
+                   b'ContentType="application/vnd.openxmlformats-package.relationships+xml"')
+# Largest content types and relationships scanned before calling officedissector
+MAX_OOXML_METADATA = 0x100000
+_ooxml_tag = re.compile(rb'<(Default|Override|Relationship)\b([^>]*)>')
+_xml_attribute = re.compile(rb'(\w+)="([^"]*)"')
+
+# Largest decompressed text chunk of a PNG, the same as PIL
+MAX_PNG_TEXT = 0x100000
+
+# Modes of PIL reading a tRNS chunk, by bit depth and color type of the PNG
+PNG_TRANSPARENCY_MODES = {(1, 0): '1', (2, 0): 'L', (4, 0): 'L', (8, 0): 'L', (16, 0): 'I;16',
+                          (8, 2): 'RGB', (16, 2): 'RGB',
+                          (1, 3): 'P', (2, 3): 'P', (4, 3): 'P', (8, 3): 'P'}
+# A palette with a single transparent entry, reported by its index
+_png_single_transparent = re.compile(b'^\xff*\x00\xff*$')
+
+# The compression ratio of archives smaller than this once uncompressed is not checked
+RATIO_MIN_SIZE = 0x1000000
+
+# Errors raised by the stdlib readers on broken archives
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError,
+                  zlib.error, lzma.LZMAError)
+
 # Prepare image/<subtype>
 mimes_exif = ['image/jpeg', 'image/tiff']
 mimes_png = ['image/png']
@@ -56,6 +147,50 @@ aliases = {
 # It works as expected if you do mimetypes.guess_type('application/gzip', strict=False)
 propertype = {'.gz': 'application/gzip'}
 
+
+def _build_extension_index():
+    """
+    Returns a read-only dict: known extension => expected mimetype.
+
+    Same result as _check_extension used to get from mimetypes.guess_type,
+    with propertype and aliases already applied. Extensions for which
+    guess_type looks at the rest of the path (compression suffixes) are
+    not in the index.
+    """
+    index = {}
+    for ext in mimetypes.types_map:
+        if ext in propertype:
+            index[ext] = propertype[ext]
+        elif ext not in mimetypes.encodings_map and ext not in mimetypes.suffix_map:
+            expected_mimetype, encoding = mimetypes.guess_type('file' + ext, strict=False)
+            index[ext] = aliases.get(expected_mimetype, expected_mimetype)
+    return types.MappingProxyType(index)
+
+
+def _build_mimetype_index():
+    """
+    Returns a read-only dict: mimetype => tuple of the expected extensions.
+
+    Same result as mimetypes.guess_all_extensions with aliases already
+    applied. Keys are lower case, mimetypes with no known extension are
+    not in the index.
+    """
+    index = {}
+    known_mimetypes = set(mimetypes.types_map.values()) | set(mimetypes.common_types.values())
+    for mimetype in known_mimetypes | set(aliases):
+        extensions = mimetypes.guess_all_extensions(aliases.get(mimetype, mimetype), strict=False)
+        if extensions:
+            index[mimetype.lower()] = tuple(extensions)
+    return types.MappingProxyType(index)
+
+
+# Built once at import, so every worker gets them for free
+if not mimetypes.inited:
+    mimetypes.init()
+KNOWN_EXTENSIONS = frozenset(mimetypes.types_map)
+EXTENSION_MIMETYPES = _build_extension_index()
+MIMETYPE_EXTENSIONS = _build_mimetype_index()
+
 # Commonly used malicious extensions
 # Sources: http://www.howtogeek.com/137270/50-file-extensions-that-are-potentially-dangerous-on-windows/
 # https://github.com/wiregit/wirecode/blob/master/components/core-settings/src/main/java/org/limewire/core/settings/FilterSettings.java
@@ -82,9 +217,13 @@ MAL_EXTS = (
 
 class File(FileBase):
 
-    def __init__(self, src_path, dst_path):
-        super(File, self).__init__(src_path, dst_path)
+    def __init__(self, src_path, dst_path, mimetype=None, digests=None, entry=None):
+        super(File, self).__init__(src_path, dst_path, mimetype, digests, entry)
         self.is_recursive = False
+        # Members of the archive left in scratch_dir for the other workers,
+        # see _process_archive_members
+        self.queued_members = []
+        self.scratch_dir = None
         self._check_dangerous()
         if self.is_dangerous():
             return
@@ -111,14 +250,14 @@ class File(FileBase):
         module's list of valid mimetypes and the expected mimetype based on its
         extension differs from the mimetype determined by libmagic, then it
         marks the file as dangerous."""
-        if propertype.get(self.extension) is not None:
-            expected_mimetype = propertype.get(self.extension)
+        if self.extension not in KNOWN_EXTENSIONS:
+            return
+        if self.extension in EXTENSION_MIMETYPES:
+            expected_mimetype = EXTENSION_MIMETYPES[self.extension]
         else:
             expected_mimetype, encoding = mimetypes.guess_type(self.src_path, strict=False)
-            if aliases.get(expected_mimetype) is not None:
-                expected_mimetype = aliases.get(expected_mimetype)
-        is_known_extension = self.extension in mimetypes.types_map.keys()
-        if is_known_extension and expected_mimetype != self.mimetype:
+            expected_mimetype = aliases.get(expected_mimetype, expected_mimetype)
+        if expected_mimetype != self.mimetype:
             self.log_details.update({'expected_mimetype': expected_mimetype})
             self.make_dangerous()
 
@@ -126,32 +265,677 @@ class File(FileBase):
         """Takes the mimetype (as determined by libmagic) and determines
         whether the list of extensions that are normally associated with
         that extension contains the file's actual extension."""
-        if aliases.get(self.mimetype) is not None:
-            mimetype = aliases.get(self.mimetype)
-        else:
-            mimetype = self.mimetype
-        expected_extensions = mimetypes.guess_all_extensions(mimetype, strict=False)
+        expected_extensions = MIMETYPE_EXTENSIONS.get(self.mimetype.lower())
         if expected_extensions:
             if len(self.extension) > 0 and self.extension not in expected_extensions:
-                self.log_details.update({'expected_extensions': expected_extensions})
+                self.log_details.update({'expected_extensions': list(expected_extensions)})
                 self.make_dangerous()
 
+    def has_queued_members(self):
+        """Returns True if members of the archive are left for the other workers."""
+        return any(task is not None for task, lines in self.queued_members)
+
     def has_metadata(self):
         if self.mimetype in mimes_metadata:
             return True
         return False
 
 
+class ArchiveBudgetExceeded(KittenGroomerError):
+    """An archive goes over one of the limits of an ArchiveBudget."""
+
+    def __init__(self, message, budget):
+        super(ArchiveBudgetExceeded, self).__init__(message)
+        self.budget = budget
+
+
+class ArchiveBudget(object):
+    """
+    Uncompressed bytes and entries extracted from an archive, with their limits.
+
+    The content of nested archives is charged to all the enclosing archives.
+    A limit set to None is not enforced.
+    """
+
+    def __init__(self, name, compressed_size=None, max_size=None, max_entries=None, max_ratio=None):
+        self.name = name
+        self.compressed_size = compressed_size
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.max_ratio = max_ratio
+        self.size = 0
+        self.entries = 0
+
+    def check(self, size=0, entries=0):
+        """Raises ArchiveBudgetExceeded if extracting size more bytes and
+        entries more entries would go over a limit."""
+        size += self.size
+        entries += self.entries
+        if self.max_size is not None and size > self.max_size:
+            raise ArchiveBudgetExceeded('{}: more than {} bytes uncompressed'.format(
+                self.name, self.max_size), self)
+        if self.max_entries is not None and entries > self.max_entries:
+            raise ArchiveBudgetExceeded('{}: more than {} entries'.format(
+                self.name, self.max_entries), self)
+        if (self.max_ratio is not None and self.compressed_size and size > RATIO_MIN_SIZE and
+                size > self.compressed_size * self.max_ratio):
+            raise ArchiveBudgetExceeded('{}: compression ratio above {}'.format(
+                self.name, self.max_ratio), self)
+
+    def charge(self, size=0, entries=0):
+        self.size += size
+        self.entries += entries
+
+
+class ImageBudget(object):
+    """
+    Pixels of the images decoded by a run, with the limits of a single
+    frame and of the run. A limit set to None is not enforced.
+
+    Shared by the threads of a process, each worker process has its own.
+    """
+
+    def __init__(self, max_pixels=MAX_IMAGE_PIXELS, max_run_pixels=None):
+        self.max_pixels = max_pixels
+        self.max_run_pixels = max_run_pixels
+        self.pixels = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def charge(self, header):
+        """Raises KittenGroomerError if the image described by header goes
+        over a limit, charges its pixels to the run otherwise."""
+        if self.max_pixels is not None and header['pixels'] > self.max_pixels:
+            raise KittenGroomerError('{} pixels in a frame, more than {}'.format(
+                header['pixels'], self.max_pixels))
+        pixels = header['pixels'] * header['frames']
+        with self._lock:
+            if self.max_run_pixels is not None and self.pixels + pixels > self.max_run_pixels:
+                raise KittenGroomerError('more than {} pixels decoded by the run'.format(
+                    self.max_run_pixels))
+            self.pixels += pixels
+
+
+class WorkScheduler(object):
+    """
+    Queue of the files of a parallel run, see _processdir_parallel.
+
+    A task is the arguments of _process_file_in_worker. Tasks are handed
+    out from the longest to the shortest expected processing time, given
+    by a CostModel. Their log lines (and content.log lines) are given back
+    in the order the tasks were added, the members of an archive right
+    after it.
+    """
+
+    def __init__(self, cost_model):
+        self.cost_model = cost_model
+        self._ids = itertools.count()
+        self._queue = []
+        # Id of the task after each one in the log, None before the first
+        self._following = {}
+        self._last = None
+        self._next_lines = None
+        self._lines = {}
+        self._content = {}
+        self._content_ready = []
+        # Archives waiting for their members: [members left, journal entry], by task id
+        self._archives = {}
+        self._archive_of = {}
+        # Bytes of the queued members not done yet, and their sizes by task id
+        self.queued_size = 0
+        self._member_sizes = {}
+
+    def has_tasks(self):
+        return bool(self._queue)
+
+    def add(self, task, mimetype, size):
+        """
+        Queues a task for a file of mimetype and size, logged after the
+        ones already added. All of them are added before the first done.
+        """
+        task_id = self._push(task, mimetype, size)
+        self._following[self._last] = task_id
+        self._last = task_id
+        if self._next_lines is None:
+            self._next_lines = task_id
+
+    def _push(self, task, mimetype, size):
+        task_id = next(self._ids)
+        heapq.heappush(self._queue, (-self.cost_model.estimate(mimetype, size), task_id, task))
+        return task_id
+
+    def pop(self):
+        """Returns the (id, task) expected to be the longest."""
+        _, task_id, task = heapq.heappop(self._queue)
+        return task_id, task
+
+    def done(self, task_id, lines, members, journal_entry, content=b''):
+        """
+        Records the results of a task: its log lines, the members of the
+        archive it queued, the journal entry of the archive and its
+        content.log lines (see _process_file_in_worker). Returns the
+        journal entries of the archives whose members are all done.
+        """
+        self._lines[task_id] = lines
+        if content:
+            self._content[task_id] = content
+        if journal_entry is not None:
+            self._archives[task_id] = [0, journal_entry]
+        previous, after = task_id, self._following.get(task_id)
+        for member, member_lines in members:
+            if member is None:
+                # Processed by the worker of the archive
+                member_id = next(self._ids)
+                self._lines[member_id] = member_lines
+            else:
+                size = os.lstat(member[0]).st_size
+                member_id = self._push(member, member[4], size)
+                self.queued_size += size
+                self._member_sizes[member_id] = size
+                self._archive_of[member_id] = task_id
+                self._archives[task_id][0] += 1
+            self._following[previous] = member_id
+            previous = member_id
+        self._following[previous] = after
+        if task_id not in self._archive_of:
+            return []
+        archive_id = self._archive_of.pop(task_id)
+        self.queued_size -= self._member_sizes.pop(task_id)
+        self._archives[archive_id][0] -= 1
+        if self._archives[archive_id][0] > 0:
+            return []
+        return [self._archives.pop(archive_id)[1]]
+
+    def take_lines(self):
+        """Returns the log lines that can be written since the last call."""
+        lines = []
+        while self._next_lines in self._lines:
+            lines.append(self._lines.pop(self._next_lines))
+            if self._next_lines in self._content:
+                self._content_ready.append(self._content.pop(self._next_lines))
+            self._next_lines = self._following.get(self._next_lines)
+        return ''.join(lines)
+
+    def take_content(self):
+        """Returns the content.log lines of the tasks whose log lines were taken."""
+        content, self._content_ready = b''.join(self._content_ready), []
+        return content
+
+    def pending_archives(self):
+        """Returns the journal entries of the archives with members not done yet."""
+        return [journal_entry for members_left, journal_entry in self._archives.values()]
+
+
+def _image_header(image):
+    """Returns the pixels of a frame and the number of frames of an image
+    opened by PIL, which has only read its header."""
+    width, height = image.size
+    return {'pixels': width * height, 'frames': getattr(image, 'n_frames', 1)}
+
+
+def _pdf_hexcode_words(name):
+    """Yields the (word, hexcode) PDFiD reads in a name containing '#'.
+
+    '#' followed by two hexadecimal digits is the escaped character,
+    any other '#' ends the word, the next word is still a name."""
+    word = bytearray()
+    hexcode = False
+    i = 1
+    while i < len(name):
+        if name[i] == ord('#'):
+            if _pdf_hexcode.fullmatch(name, i + 1, i + 3):
+                word.append(int(name[i + 1:i + 3], 16))
+                hexcode = True
+                i += 3
+                continue
+            if word:
+                yield bytes(word), hexcode
+            word = bytearray()
+            hexcode = False
+        else:
+            word.append(name[i])
+        i += 1
+    if word:
+        yield bytes(word), hexcode
+
+
+def _scan_pdf(buf):
+    """
+    Counts the PDF_KEYWORDS names in buf like PDFiD does, with bulk regular
+    expression searches instead of PDFiD's byte by byte tokenizer.
+
+    Returns an object with the same keyword attributes as cPDFiD, or None
+    if PDFiD wouldn't find the PDF header, PDFiD has to decide then.
+    """
+    # PDFiD looks for the header in the first 1024 bytes and skips it, up
+    # to the end of the line or 10 characters
+    head = buf[:1024]
+    index = head.find(b'%PDF')
+    if index == -1:
+        return None
+    for end_header in range(index + 4, index + 4 + 10):
+        if end_header >= len(head):
+            return None
+        if head[end_header] in b'\r\n':
+            break
+    counts = {name: [0, 0] for name in PDF_KEYWORDS.values()}
+    for name in _pdf_plain_names.findall(buf, end_header):
+        counts[name][0] += 1
+    for match in _pdf_hexcode_names.finditer(buf, end_header):
+        for word, hexcode in _pdf_hexcode_words(match.group()):
+            if word in counts:
+                counts[word][0] += 1
+                counts[word][1] += hexcode
+    return types.SimpleNamespace(**{attribute: cCount(*counts[name])
+                                    for attribute, name in PDF_KEYWORDS.items()})
+
+
+def _zip_features(archive):
+    """
+    Returns a summary of the members of the opened ZipFile archive, from its
+    central directory only.
+    """
+    features = {'vba': False, 'activex': False, 'embeddings': False, 'odf_macro': False}
+    for info in archive.infolist():
+        name = info.filename.lower()
+        if name.endswith('vbaproject.bin') or '/macrosheets/' in name:
+            features['vba'] = True
+        if '/activex/' in name:
+            features['activex'] = True
+        if '/embeddings/' in name:
+            features['embeddings'] = True
+        if name.startswith(('script', 'basic', 'object')) or name.endswith('.bin'):
+            features['odf_macro'] = True
+    return features
+
+
+def _ooxml_plain_metadata(archive):
+    """
+    True if the content types and relationships of the OOXML package in
+    archive declare no macro, control or embedded object or package, and
+    would be accepted by officedissector: every part has a content type,
+    every relationship has its source and target.
+
+    The parts are only scanned as bytes, anything they could hide from
+    the scan (escapes, other encodings, other relationships parts) is
+    not plain.
+    """
+    parts = {'/' + info.filename: info for info in archive.infolist() if not info.is_dir()}
+    if '/[Content_Types].xml' not in parts:
+        return False
+    metadata = ['/[Content_Types].xml'] + [name for name in parts if name.endswith('.rels')]
+    if sum(parts[name].file_size for name in metadata) > MAX_OOXML_METADATA:
+        return False
+    tags = {}
+    for name in metadata:
+        data = archive.read(parts[name])
+        if b'\x00' in data or b'&' in data or OOXML_MARKERS.search(data):
+            return False
+        if name == '/[Content_Types].xml' and (data.count(b'relationships+xml') != 1 or
+                                               OOXML_RELS_TYPE not in data):
+            return False
+        tags[name] = [(tag, dict(_xml_attribute.findall(attributes)))
+                      for tag, attributes in _ooxml_tag.findall(data)]
+    extensions = {attributes.get(b'Extension') for tag, attributes in tags['/[Content_Types].xml']
+                  if tag == b'Default'}
+    overrides = {attributes.get(b'PartName') for tag, attributes in tags['/[Content_Types].xml']
+                 if tag == b'Override'}
+    for name in parts:
+        if name.encode() in overrides:
+            continue
+        if '.' not in name or name.rsplit('.', 1)[1].encode() not in extensions:
+            return False
+    for name in metadata[1:]:
+        # Same paths as officedissector: '/word/_rels/document.xml.rels' is
+        # about '/word/document.xml', its targets are relative to '/word'
+        source = name.rsplit('.', 1)[0].rsplit('/', 2)
+        if len(source) != 3:
+            return False
+        if source[0] + '/' + source[2] not in parts and source[0] + '/' + source[2] != '/':
+            return False
+        for tag, attributes in tags[name]:
+            if tag != b'Relationship' or b'Target' not in attributes:
+                return False
+            target = attributes[b'Target'].decode()
+            if attributes.get(b'TargetMode') == b'External' or target == 'NULL':
+                continue
+            if posixpath.normpath(source[0] + '/' + target) not in parts:
+                return False
+    return True
+
+
+def _walk_ole(storage, path=()):
+    """Yields (path, entry) for every entry under storage, depth first."""
+    for entry in storage.kids:
+        entry_path = path + (entry.name,)
+        yield entry_path, entry
+        if entry.entry_type == olefile.STGTY_STORAGE:
+            yield from _walk_ole(entry, entry_path)
+
+
+def _ole_indicators(ole):
+    """
+    Returns the encrypted/macro/objpool/flash indicators of the opened
+    OleFileIO ole, from a single walk of its directory tree. Encryption is
+    checked by oletools like OleID does (Word, Excel, PowerPoint schemes).
+    """
+    indicators = {'encrypted': crypto.is_encrypted(ole), 'macro': False, 'objpool': False,
+                  'flash': False}
+    for path, entry in _walk_ole(ole.root):
+        name = '/'.join(path).lower()
+        if name in OLE_MACRO_PATHS:
+            indicators['macro'] = True
+        elif name == 'objectpool':
+            indicators['objpool'] = True
+        if entry.entry_type != olefile.STGTY_STREAM:
+            continue
+        if detect_flash(ole.openstream(list(path)).read()):
+            indicators['flash'] = True
+    return indicators
+
+
+def _jpeg_exif(buf):
+    """Returns the TIFF structure of the Exif APP1 segment of the JPEG in buf,
+    or None. Only the segments before the image data are read."""
+    offset = 2
+    while offset + 4 <= len(buf):
+        if buf[offset] != 0xFF:
+            return None
+        marker = buf[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        if marker in (0xD9, 0xDA):
+            # End of image or start of the image data
+            return None
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            # Markers without a segment
+            offset += 2
+            continue
+        length = int.from_bytes(buf[offset + 2:offset + 4], 'big')
+        if marker == 0xE1 and buf[offset + 4:offset + 10] == b'Exif\x00\x00':
+            return buf[offset + 10:offset + 2 + length]
+        offset += 2 + length
+    return None
+
+
+def _inflate(data):
+    """Decompresses a compressed PNG text, at most MAX_PNG_TEXT bytes of it."""
+    decompressor = zlib.decompressobj()
+    text = decompressor.decompress(data, MAX_PNG_TEXT)
+    if decompressor.unconsumed_tail:
+        raise KittenGroomerError('Compressed text chunk over {} bytes'.format(MAX_PNG_TEXT))
+    return text
+
+
+def _png_metadata(buf):
+    """
+    Returns the metadata of the PNG in buf like PIL reports it in the info
+    of the image, except the frame control of an animated PNG.
+
+    Only the chunks before the image data are read, like PIL does when
+    opening an image. The last value of a key found twice is kept.
+    """
+    info = {}
+    mode = None
+    offset = 8
+    while offset + 8 <= len(buf):
+        length = int.from_bytes(buf[offset:offset + 4], 'big')
+        chunk_type = buf[offset + 4:offset + 8]
+        if chunk_type in (b'IDAT', b'IEND'):
+            break
+        data = buf[offset + 8:offset + 8 + length]
+        offset += 12 + length
+        if chunk_type == b'IHDR' and length >= 13:
+            mode = PNG_TRANSPARENCY_MODES.get((data[8], data[9]))
+            if data[12]:
+                info['interlace'] = 1
+        elif chunk_type == b'tEXt':
+            keyword, _, text = data.partition(b'\x00')
+            if keyword:
+                # PIL keeps an Exif text chunk as bytes
+                info[keyword.decode('latin-1')] = text if keyword == b'exif' else text.decode('latin-1')
+        elif chunk_type == b'zTXt':
+            keyword, _, text = data.partition(b'\x00')
+            try:
+                # After the compression method
+                text = _inflate(text[1:])
+            except zlib.error:
+                text = b''
+            if keyword:
+                info[keyword.decode('latin-1')] = text.decode('latin-1')
+        elif chunk_type == b'iTXt':
+            keyword, _, rest = data.partition(b'\x00')
+            fields = rest[2:].split(b'\x00', 2)
+            if len(rest) < 2 or len(fields) < 3 or (rest[0] and rest[1]):
+                continue
+            language, translated_keyword, text = fields
+            if rest[0]:
+                try:
+                    text = _inflate(text)
+                except zlib.error:
+                    continue
+            if keyword == b'XML:com.adobe.xmp':
+                info['xmp'] = text
+            try:
+                language.decode('utf-8'), translated_keyword.decode('utf-8')
+                info[keyword.decode('latin-1')] = text.decode('utf-8')
+            except UnicodeError:
+                pass
+        elif chunk_type == b'iCCP':
+            name, _, profile = data.partition(b'\x00')
+            try:
+                # After the compression method
+                info['icc_profile'] = _inflate(profile[1:])
+            except zlib.error:
+                info['icc_profile'] = None
+        elif chunk_type == b'tRNS':
+            if mode == 'P':
+                if _png_single_transparent.match(data):
+                    info['transparency'] = data.index(b'\x00')
+                else:
+                    info['transparency'] = data
+            elif mode == '1':
+                info['transparency'] = 255 if int.from_bytes(data[:2], 'big') else 0
+            elif mode in ('L', 'I;16'):
+                info['transparency'] = int.from_bytes(data[:2], 'big')
+            elif mode == 'RGB':
+                info['transparency'] = tuple(int.from_bytes(data[i:i + 2], 'big') for i in (0, 2, 4))
+        elif chunk_type == b'pHYs' and length >= 9:
+            px, py = int.from_bytes(data[:4], 'big'), int.from_bytes(data[4:8], 'big')
+            if data[8] == 1:
+                info['dpi'] = (px * 0.0254, py * 0.0254)
+            elif data[8] == 0:
+                info['aspect'] = (px, py)
+        elif chunk_type == b'gAMA' and length >= 4:
+            info['gamma'] = int.from_bytes(data[:4], 'big') / 100000.0
+        elif chunk_type == b'cHRM':
+            info['chromaticity'] = tuple(int.from_bytes(data[i:i + 4], 'big') / 100000.0
+                                         for i in range(0, length - length % 4, 4))
+        elif chunk_type == b'sRGB' and length >= 1:
+            info['srgb'] = data[0]
+        elif chunk_type == b'eXIf':
+            info['exif'] = b'Exif\x00\x00' + data
+    return info
+
+
+def _ruleset_version():
+    """Version of the rules applied to files: changes whenever this script or
+    kittengroomer.helpers is edited, or an analyzer library or libmagic is
+    upgraded."""
+    version = hashlib.sha1()
+    for path in (__file__, kittengroomer.helpers.__file__):
+        with open(path, 'rb') as f:
+            version.update(f.read())
+    versions = [(name, getattr(sys.modules.get(name), '__version__', None))
+                for name in ANALYZER_MODULES]
+    if hasattr(magic, 'version'):
+        versions.append(('libmagic', magic.version()))
+    version.update(repr(versions).encode())
+    return version.hexdigest()
+
+
+# Set in each worker process by _init_worker
+_worker_groomer = None
+_worker_output = None
+
+
+def _init_worker(groomer):
+    """Keep a copy of the groomer in the worker and capture its log messages."""
+    global _worker_groomer, _worker_output
+    _worker_groomer = groomer
+    _worker_output = outputs.ListOutput(format=formats.line_format, close_atexit=False)
+    emitters['*'] = filters.Emitter(levels.DEBUG, True, _worker_output)
+
+
+def _process_file_in_worker(task):
+    """
+    Process a single file in a worker. task is (srcpath, dstpath,
+    relative_path, archive depth, mimetype, digests, queue size), mimetype
+    and digests only for an archive member, extracted for this task, queue
+    size only for an archive (see queue_budget). Returns the log lines
+    it produced, the members of the archive it queued, the journal entry
+    and scratch directory of the archive for when they are processed, the
+    timings of the files processed and the lines it added to content.log.
+    """
+    srcpath, dstpath, relative_path, depth, mimetype, digests, queue_size = task
+    groomer = _worker_groomer
+    groomer.recursive_archive_depth = depth
+    groomer.take_log_lines = _take_worker_lines
+    groomer.queue_budget = queue_size
+    if depth > 0:
+        groomer.sniffed_mimetypes[srcpath] = mimetype
+        groomer.digests[srcpath] = digests
+    # The trees of the archives are written to content.log by the parent,
+    # in the order of a sequential run
+    fd, groomer.log_content = tempfile.mkstemp(prefix='kittengroomer_content_')
+    try:
+        file = groomer.process_file(srcpath, dstpath, relative_path)
+        with open(groomer.log_content, 'rb') as f:
+            content = f.read()
+    finally:
+        os.close(fd)
+        os.remove(groomer.log_content)
+    if depth > 0:
+        groomer._safe_remove(srcpath)
+    journal_entry = None
+    if file.has_queued_members():
+        journal_entry = (file.src_path, file.dst_path, file.get_verdict(), file.scratch_dir)
+    if file.queued_members:
+        # Written after the members
+        file.queued_members.append((None, _take_worker_lines()))
+    timings, groomer.timings = groomer.timings, []
+    return _take_worker_lines(), file.queued_members, journal_entry, timings, content
+
+
+def _take_worker_lines():
+    """Returns the log lines written by the worker since the last call."""
+    lines = ''.join(_worker_output.messages)
+    del _worker_output.messages[:]
+    return lines
+
+
 class KittenGroomerFileCheck(KittenGroomerBase):
 
-    def __init__(self, root_src=None, root_dst=None, max_recursive_depth=2, debug=False):
+    # Wall-clock budget in seconds of the handlers by mimetype or main type,
+    # see _run_handler. The other types get default_handler_timeout.
+    handler_timeouts = {
+        'application': 300,
+        'image': 120,
+    }
+    default_handler_timeout = 60
+    # Handlers run in the groomer process, without watchdog:
+    # - _archive extracts the members to the scratch directory and queues
+    #   them on the scheduler of the run, which a forked child can't hand
+    #   back. Each member runs under its own budget, and the extraction is
+    #   bounded by the archive budgets (size, entries, compression ratio).
+    unwatched_handlers = ('_archive',)
+    # Attributes of the current file the handlers change, handed back by the watchdog
+    handler_state = ('dst_path', 'log_details', 'log_string', 'filename_prefix', 'filename_suffix',
+                     'copied_from', 'extra_outputs')
+
+    def __init__(self, root_src=None, root_dst=None, max_recursive_depth=2, debug=False, workers=1,
+                 cache=None, cache_size=100000, resume=False, max_archive_size=0x100000000,
+                 max_archive_entries=100000, max_compression_ratio=100, max_run_size=None,
+                 max_image_memory=0x40000000, max_image_pixels=MAX_IMAGE_PIXELS,
+                 max_run_pixels=None, fsync='end', digest_algorithms=('sha1',), tree_hash_size=None,
+                 dedup=True, cost_model=None, watchdog=True, handler_timeout=None,
+                 handler_memory=0x80000000, scratch_dir=None, max_queued_size=0x10000000,
+                 clear_cache=False):
         if root_src is None:
             root_src = os.path.join(os.sep, 'media', 'src')
         if root_dst is None:
             root_dst = os.path.join(os.sep, 'media', 'dst')
-        super(KittenGroomerFileCheck, self).__init__(root_src, root_dst, debug)
+        if (cache is not None or dedup) and 'sha256' not in digest_algorithms:
+            # Key of the verdict cache and of dedup, see _content_key
+            digest_algorithms = tuple(digest_algorithms) + ('sha256',)
+        super(KittenGroomerFileCheck, self).__init__(root_src, root_dst, debug, resume, fsync,
+                                                     digest_algorithms, tree_hash_size)
+        # Files processed by the interrupted run we are resuming, if any
+        self.journal = Journal(self.log_journal)
+        if resume:
+            self.processed = self.journal.load()
+            self.log_name.info('Resuming, {} files already processed', len(self.processed))
+        else:
+            self.processed = {}
         self.recursive_archive_depth = 0
         self.max_recursive_depth = max_recursive_depth
+        self.max_archive_size = max_archive_size
+        self.max_archive_entries = max_archive_entries
+        self.max_compression_ratio = max_compression_ratio
+        self.max_image_memory = max_image_memory
+        self.image_budget = ImageBudget(max_image_pixels, max_run_pixels)
+        # Everything extracted by this run (by this worker with workers > 1),
+        # followed by the budgets of the archives being processed
+        self.archive_budgets = [ArchiveBudget('run', max_size=max_run_size)]
+        self.workers = workers
+        if cache is not None:
+            self.verdict_cache = VerdictCache(cache, _ruleset_version(), cache_size)
+            if clear_cache:
+                self.verdict_cache.clear()
+        else:
+            self.verdict_cache = None
+        # Verdict and outputs of the files processed by their handler in
+        # this run (by this worker with workers > 1), by digest and extension
+        self.dedup = dedup
+        self.unique_outputs = {}
+        # Orders the files of a parallel run, learned from the (mimetype,
+        # size, seconds) of the files processed, see _learn_costs
+        self.cost_model = CostModel(cost_model)
+        self.timings = []
+        # Time spent in the process_file calls made by the current one
+        self._nested_time = 0.0
+        # Set by the worker processing a file, see _process_archive_members
+        self.take_log_lines = None
+        # Archive members are extracted to a private directory of the run in
+        # scratch_root (see _make_scratch_dir). In a parallel run, at most
+        # max_queued_size bytes of them wait there for a worker, an archive
+        # can add queue_budget bytes (granted by _processdir_parallel)
+        self.scratch_root = scratch_dir if scratch_dir is not None else tempfile.gettempdir()
+        # Only depends on the destination, so resumed runs find the members
+        # they already processed
+        self.scratch_dir = os.path.join(self.scratch_root, 'kittengroomer_{}'.format(
+            hashlib.sha1(os.path.abspath(self.dst_root_dir).encode(errors='surrogateescape')).hexdigest()))
+        self.max_queued_size = max_queued_size
+        self.queue_budget = 0
+        if watchdog and Watchdog.available():
+            self.watchdog = Watchdog(handler_memory)
+        else:
+            self.watchdog = None
+        self.handler_memory = handler_memory
+        self.handler_timeouts = dict(self.handler_timeouts)
+        if handler_timeout is not None:
+            self.handler_timeouts = {key: handler_timeout for key in self.handler_timeouts}
+            self.default_handler_timeout = handler_timeout
 
         subtypes_apps = [
             (mimes_office, self._winoffice),
@@ -164,7 +948,14 @@ class KittenGroomerFileCheck(KittenGroomerBase):
             (mimes_compressed, self._archive),
             (mimes_data, self._binary_app),
         ]
-        self.subtypes_application = self._init_subtypes_application(subtypes_apps)
+        # Patterns are tried in this order, the first match wins
+        self.subtypes_application = SubtypeDispatcher(subtypes_apps)
+
+        subtypes_text = [
+            (mimes_rtf, self._rtf),
+            (mimes_ooxml, self._text_ooxml),
+        ]
+        self.subtypes_text = SubtypeDispatcher(subtypes_text)
 
         types_metadata = [
             (mimes_exif, self._metadata_exif),
@@ -187,7 +978,7 @@ class KittenGroomerFileCheck(KittenGroomerBase):
 
     # ##### Helper functions #####
     def _init_subtypes_application(self, subtypes_application):
-        """Creates a dictionary with the right method based on the sub mime type."""
+        """Creates a dictionary with the right method based on the exact mime type."""
         subtype_dict = {}
         for list_subtypes, func in subtypes_application:
             for st in list_subtypes:
@@ -205,14 +996,90 @@ class KittenGroomerFileCheck(KittenGroomerBase):
         else:
             tmp_log.debug(self.cur_file.log_string)
 
-    def _run_process(self, command_string, timeout=None):
-        """Run command_string in a subprocess, wait until it finishes."""
-        args = shlex.split(command_string)
-        with open(self.log_debug_err, 'ab') as stderr, open(self.log_debug_out, 'ab') as stdout:
-            try:
-                subprocess.check_call(args, stdout=stdout, stderr=stderr, timeout=timeout)
-            except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
-                return
+    @staticmethod
+    def _content_key(file):
+        """
+        Key of the verdicts and outputs reused for identical files: the sha256
+        digest of the file, or its tree digest. Not sha1, whose collisions can
+        be crafted to pass a malicious file for a clean one.
+        """
+        if 'sha256' in file.digests:
+            return file.digests['sha256']
+        if 'sha256-tree' in file.digests:
+            return 'tree:' + file.digests['sha256-tree']
+        return None
+
+    def _get_cached_verdict(self, digest):
+        """Returns the verdict cached for the current file, or None."""
+        if self.verdict_cache is None or digest is None:
+            return None
+        return self.verdict_cache.get(digest, self.cur_file.extension)
+
+    def _cache_verdict(self, digest):
+        """Caches the verdict of the current file if it can be replayed on a copy."""
+        if self.verdict_cache is None or digest is None:
+            return
+        # Archives, converted files and metadata files can't be reproduced by a copy
+        if self.cur_file.is_recursive or self.cur_file.has_metadata():
+            return
+        if self.cur_file.copied_from not in (None, self.cur_file.src_path):
+            return
+        self.verdict_cache.set(digest, self.cur_file.extension, self.cur_file.get_verdict())
+
+    def _apply_cached_verdict(self, verdict):
+        """Processes the current file with a cached verdict instead of its handler."""
+        self.cur_file.apply_verdict(verdict)
+        self.cur_file.add_log_details('cached', True)
+        if verdict['copied']:
+            self._safe_copy()
+
+    def _remember_outputs(self, digest):
+        """Remembers the verdict and outputs of the current file for its duplicates."""
+        if not self.dedup or digest is None:
+            return
+        # The content of an archive is a whole tree, it is extracted again
+        if self.cur_file.is_recursive or 'copy_error' in self.cur_file.log_details:
+            return
+        dst_dir = os.path.dirname(self.cur_file.dst_path)
+        filename = os.path.basename(self.cur_file.src_path)
+        dst_path = self.cur_file.dst_path if self.cur_file.copied_from is not None else None
+        extra_outputs = [(os.path.join(dst_dir, prefix + filename + suffix), prefix, suffix)
+                         for prefix, suffix in self.cur_file.extra_outputs]
+        self.unique_outputs[(digest, self.cur_file.extension)] = (
+            self.cur_file.src_path, self.cur_file.get_verdict(), dst_path, extra_outputs)
+
+    def _apply_duplicate(self, digest):
+        """
+        Processes the current file like an identical one already processed
+        by this run: applies its verdict and links its outputs to the paths
+        of the current file. Returns False if there is none or its outputs
+        can't be linked.
+        """
+        if not self.dedup or digest is None:
+            return False
+        outputs = self.unique_outputs.get((digest, self.cur_file.extension))
+        if outputs is None:
+            return False
+        original, verdict, dst_path, extra_outputs = outputs
+        dst_dir, filename = os.path.split(self.cur_file.dst_path)
+        links = [(path, os.path.join(dst_dir, prefix + filename + suffix))
+                 for path, prefix, suffix in extra_outputs]
+        if dst_path is not None:
+            links.append((dst_path, os.path.join(dst_dir, '{}{}{}'.format(
+                verdict['filename_prefix'], filename, verdict['filename_suffix']))))
+        linked = []
+        for src, dst in links:
+            if self.copy_engine.link(src, dst)['error'] is not None:
+                # Removed since (archive bomb...), the handler writes them again
+                for path in linked:
+                    self._safe_remove(path)
+                return False
+            linked.append(dst)
+        self.cur_file.apply_verdict(verdict)
+        self.cur_file.add_log_details('duplicate_of', original)
+        self.cur_file.extra_outputs = [(prefix, suffix) for path, prefix, suffix in extra_outputs]
+        if dst_path is not None:
+            self.cur_file.copied_from = dst_path
         return True
 
     #######################
@@ -252,29 +1119,33 @@ class KittenGroomerFileCheck(KittenGroomerBase):
     # ##### Files that will be converted ######
     def text(self):
         """Process an rtf, ooxml, or plaintext file."""
-        for r in mimes_rtf:
-            if r in self.cur_file.sub_type:
-                self.cur_file.log_string += 'Rich Text file'
-                # TODO: need a way to convert it to plain text
-                self.cur_file.force_ext('.txt')
-                self._safe_copy()
-                return
-        for o in mimes_ooxml:
-            if o in self.cur_file.sub_type:
-                self.cur_file.log_string += 'OOXML File'
-                self._ooxml()
-                return
+        fct = self.subtypes_text.get(self.cur_file.sub_type)
+        if fct is not None:
+            fct()
+            return
         self.cur_file.log_string += 'Text file'
         self.cur_file.force_ext('.txt')
         self._safe_copy()
 
+    def _rtf(self):
+        """Processes a rich text file."""
+        self.cur_file.log_string += 'Rich Text file'
+        # TODO: need a way to convert it to plain text
+        self.cur_file.force_ext('.txt')
+        self._safe_copy()
+
+    def _text_ooxml(self):
+        """Processes an ooxml file with a text mimetype."""
+        self.cur_file.log_string += 'OOXML File'
+        self._ooxml()
+
     def application(self):
         """Processes an application specific file according to its subtype."""
-        for subtype, fct in self.subtypes_application.items():
-            if subtype in self.cur_file.sub_type:
-                fct()
-                self.cur_file.log_string += 'Application file'
-                return
+        fct = self.subtypes_application.get(self.cur_file.sub_type)
+        if fct is not None:
+            fct()
+            self.cur_file.log_string += 'Application file'
+            return
         self.cur_file.log_string += 'Unknown Application file'
         self._unknown_app()
 
@@ -287,45 +1158,35 @@ class KittenGroomerFileCheck(KittenGroomerBase):
     def _winoffice(self):
         """Processes a winoffice file using olefile/oletools."""
         self.cur_file.add_log_details('processing_type', 'WinOffice')
-        # Try as if it is a valid document
-        oid = oletools.oleid.OleID(self.cur_file.src_path)
-        if not olefile.isOleFile(self.cur_file.src_path):
-            # Manual processing, may already count as suspicious
-            try:
-                ole = olefile.OleFileIO(self.cur_file.src_path, raise_defects=olefile.DEFECT_INCORRECT)
-            except:
-                self.cur_file.add_log_details('not_parsable', True)
-                self.cur_file.make_dangerous()
-            if ole.parsing_issues:
-                self.cur_file.add_log_details('parsing_issues', True)
-                self.cur_file.make_dangerous()
-            else:
-                if ole.exists('macros/vba') or ole.exists('Macros') \
-                        or ole.exists('_VBA_PROJECT_CUR') or ole.exists('VBA'):
-                    self.cur_file.add_log_details('macro', True)
-                    self.cur_file.make_dangerous()
-        else:
-            indicators = oid.check()
-            # Encrypted ban be set by multiple checks on the script
-            if oid.encrypted.value:
-                self.cur_file.add_log_details('encrypted', True)
-                self.cur_file.make_dangerous()
-            if oid.macros.value or oid.ole.exists('macros/vba') or oid.ole.exists('Macros') \
-                    or oid.ole.exists('_VBA_PROJECT_CUR') or oid.ole.exists('VBA'):
-                self.cur_file.add_log_details('macro', True)
-                self.cur_file.make_dangerous()
-            for i in indicators:
-                if i.id == 'ObjectPool' and i.value:
-                    # FIXME: Is it suspicious?
-                    self.cur_file.add_log_details('objpool', True)
-                elif i.id == 'flash' and i.value:
-                    self.cur_file.add_log_details('flash', True)
-                    self.cur_file.make_dangerous()
+        try:
+            with olefile.OleFileIO(self.cur_file.open_buffer(),
+                                   raise_defects=olefile.DEFECT_INCORRECT) as ole:
+                indicators = _ole_indicators(ole)
+        except Exception:
+            self.cur_file.add_log_details('not_parsable', True)
+            self.cur_file.make_dangerous()
+            self._safe_copy()
+            return
+        if indicators['encrypted']:
+            self.cur_file.add_log_details('encrypted', True)
+            self.cur_file.make_dangerous()
+        if indicators['macro']:
+            self.cur_file.add_log_details('macro', True)
+            self.cur_file.make_dangerous()
+        if indicators['objpool']:
+            # FIXME: Is it suspicious?
+            self.cur_file.add_log_details('objpool', True)
+        if indicators['flash']:
+            self.cur_file.add_log_details('flash', True)
+            self.cur_file.make_dangerous()
         self._safe_copy()
 
     def _ooxml(self):
         """Processes an ooxml file."""
         self.cur_file.add_log_details('processing_type', 'ooxml')
+        if self._ooxml_is_plain():
+            self._safe_copy()
+            return
         try:
             doc = officedissector.doc.Document(self.cur_file.src_path)
         except Exception:
@@ -350,28 +1211,50 @@ class KittenGroomerFileCheck(KittenGroomerBase):
             self.cur_file.make_dangerous()
         self._safe_copy()
 
+    def _ooxml_is_plain(self):
+        """
+        True if the OOXML file is known to hold no macro, control or embedded
+        object without parsing it with officedissector: a known extension
+        that is not macro enabled, no such part in the central directory
+        and plain content types and relationships.
+        """
+        ext = os.path.splitext(self.cur_file.src_path)[1]
+        if officedissector.doc.FILE_EXTS.get(ext, (None, True))[1]:
+            return False
+        try:
+            with zipfile.ZipFile(self.cur_file.open_buffer()) as archive:
+                features = _zip_features(archive)
+                if features['vba'] or features['activex'] or features['embeddings']:
+                    return False
+                return _ooxml_plain_metadata(archive)
+        except Exception:
+            # officedissector decides on broken files
+            return False
+
     def _libreoffice(self):
         """Processes a libreoffice file."""
         self.cur_file.add_log_details('processing_type', 'libreoffice')
         # As long as there ar no way to do a sanity check on the files => dangerous
         try:
-            lodoc = zipfile.ZipFile(self.cur_file.src_path, 'r')
-        except:
+            with zipfile.ZipFile(self.cur_file.open_buffer()) as lodoc:
+                features = _zip_features(lodoc)
+        except Exception:
             self.cur_file.add_log_details('invalid', True)
             self.cur_file.make_dangerous()
-        for f in lodoc.infolist():
-            fname = f.filename.lower()
-            if fname.startswith('script') or fname.startswith('basic') or \
-                    fname.startswith('object') or fname.endswith('.bin'):
-                self.cur_file.add_log_details('macro', True)
-                self.cur_file.make_dangerous()
+            self._safe_copy()
+            return
+        if features['odf_macro']:
+            self.cur_file.add_log_details('macro', True)
+            self.cur_file.make_dangerous()
         self._safe_copy()
 
     def _pdf(self):
         """Processes a PDF file."""
         self.cur_file.add_log_details('processing_type', 'pdf')
-        xmlDoc = PDFiD(self.cur_file.src_path)
-        oPDFiD = cPDFiD(xmlDoc, True)
+        oPDFiD = _scan_pdf(self.cur_file.open_buffer())
+        if oPDFiD is None:
+            xmlDoc = PDFiD(self.cur_file.src_path)
+            oPDFiD = cPDFiD(xmlDoc, True)
         # TODO: other keywords?
         if oPDFiD.encrypt.count > 0:
             self.cur_file.add_log_details('encrypted', True)
@@ -390,33 +1273,265 @@ class KittenGroomerFileCheck(KittenGroomerBase):
             self.cur_file.make_dangerous()
 
     def _archive(self):
+        """Processes an archive. Archives the stdlib can read are streamed
+        one member at a time through process_file, the others are extracted
+        with 7zip. The recursive archive depth is increased and the sizes
+        announced by the archive headers are checked against the archive
+        budgets before anything is extracted, to protect against archive
+        bombs. The budgets are enforced again while extracting."""
+        archive = self.cur_file
+        archive.add_log_details('processing_type', 'archive')
+        archive.is_recursive = True
+        archive.log_string += 'Archive extracted, processing content.'
+        members, sizes = self._open_archive()
+        if members is None:
+            sizes = self._list_7z()
+        self.recursive_archive_depth += 1
+        self._print_log()
+        budget = ArchiveBudget(os.path.basename(archive.src_path), archive.size,
+                               self.max_archive_size, self.max_archive_entries,
+                               self.max_compression_ratio)
+        self.archive_budgets.append(budget)
+        try:
+            if self.recursive_archive_depth >= self.max_recursive_depth:
+                self._handle_archivebomb()
+            else:
+                if sizes is not None:
+                    # Streamed members are charged as they are extracted
+                    self._check_archive_budgets(sum(sizes), len(sizes), charge=members is None)
+                if members is None:
+                    self._archive_7z(sizes)
+                else:
+                    self._process_archive_members(members)
+        except ArchiveBudgetExceeded as e:
+            # Exceeding the run budget stops the outermost archive
+            if e.budget is not budget and (e.budget is not self.archive_budgets[0] or
+                                           len(self.archive_budgets) > 2):
+                raise
+            self.cur_file = archive
+            # Before make_dangerous renames it
+            self._safe_rmtree(archive.dst_path)
+            self._handle_archivebomb(reason=e.message)
+        finally:
+            self.archive_budgets.pop()
+            self.recursive_archive_depth -= 1
+
+    def _check_archive_budgets(self, size=0, entries=0, charge=True):
+        """Raises ArchiveBudgetExceeded if extracting size more bytes and
+        entries more entries goes over the budget of the run or of one of
+        the archives being processed, charges them otherwise (if charge)."""
+        for budget in self.archive_budgets:
+            budget.check(size, entries)
+        if not charge:
+            return
+        for budget in self.archive_budgets:
+            budget.charge(size, entries)
+
+    def _archive_7z(self, sizes=None):
         """Processes an archive using 7zip. The archive is extracted to a
-        temporary directory and self.processdir is called on that directory.
-        The recursive archive depth is increased to protect against archive
-        bombs."""
-        self.cur_file.add_log_details('processing_type', 'archive')
-        self.cur_file.is_recursive = True
-        self.cur_file.log_string += 'Archive extracted, processing content.'
+        temporary directory and its files are processed from there."""
         tmpdir = self.cur_file.dst_path + '_temp'
         self._safe_mkdir(tmpdir)
         extract_command = '{} -p1 x "{}" -o"{}" -bd -aoa'.format(SEVENZ_PATH, self.cur_file.src_path, tmpdir)
         self._run_process(extract_command)
-        self.recursive_archive_depth += 1
-        self.tree(tmpdir)
-        self.processdir(tmpdir, self.cur_file.dst_path)
-        self.recursive_archive_depth -= 1
-        self._safe_rmtree(tmpdir)
+        try:
+            if sizes is None:
+                # Not listed beforehand, charge what was extracted
+                sizes = [entry.entry.stat().st_size for entry in self._walk_files(tmpdir)]
+                self._check_archive_budgets(sum(sizes), len(sizes))
+            self.tree(tmpdir)
+            for entry in self._list_file_paths(tmpdir, self.cur_file.dst_path):
+                self.process_file(*entry)
+        finally:
+            self._safe_rmtree(tmpdir)
 
-    def _handle_archivebomb(self, src_dir):
+    def _list_7z(self):
+        """Returns the uncompressed sizes of the files in the current archive
+        according to the 7zip listing, or None if it can't be listed."""
+        args = [SEVENZ_PATH, 'l', '-slt', '-p1', self.cur_file.src_path]
+        try:
+            result = self.tool_runner.run(args, 60, subprocess.PIPE, subprocess.DEVNULL)
+        except OSError:
+            return None
+        if result['returncode'] != 0:
+            return None
+        output = result['output']
+        # The archive properties come before the separator, then one block per entry
+        _, _, entries = output.partition(b'\n----------\n')
+        sizes = []
+        for entry in entries.split(b'\n\n'):
+            properties = dict(line.partition(b' = ')[::2] for line in entry.splitlines())
+            if not properties or properties.get(b'Folder') == b'+':
+                continue
+            try:
+                sizes.append(int(properties.get(b'Size', b'0') or 0))
+            except ValueError:
+                return None
+        return sizes
+
+    def _open_archive(self):
+        """Returns an iterator over the (name, file object) of the regular
+        files in the current archive and the list of their uncompressed
+        sizes if the headers announce them, or (None, None) if the stdlib
+        can't read it."""
+        buf = self.cur_file.open_buffer()
+        if zipfile.is_zipfile(buf):
+            archive = zipfile.ZipFile(buf)
+            infos = [info for info in archive.infolist() if not info.is_dir()]
+            if any(info.flag_bits & 0x1 for info in infos):
+                # Encrypted, let 7zip deal with it
+                return None, None
+            return self._iter_zip(archive, infos), [info.file_size for info in infos]
+        try:
+            archive = tarfile.open(fileobj=self.cur_file.open_buffer(), mode='r|*')
+        except tarfile.TarError:
+            pass
+        else:
+            return self._iter_tar(archive), None
+        header = self.cur_file.open_buffer().read(8)
+        for magic_number, open_stream in compressed_streams:
+            if header.startswith(magic_number):
+                return self._iter_stream(open_stream(self.cur_file.open_buffer())), None
+        return None, None
+
+    def _iter_zip(self, archive, infos):
+        for info in infos:
+            with archive.open(info) as member:
+                yield info.filename, member
+
+    def _iter_tar(self, archive):
+        for info in archive:
+            if info.isdir():
+                continue
+            if not info.isfile():
+                self.log_name.warning('Skipping {} in archive: not a regular file.', info.name)
+                continue
+            yield info.name, archive.extractfile(info)
+
+    def _iter_stream(self, stream):
+        # Named like 7zip does: without the compression extension
+        name, ext = os.path.splitext(os.path.basename(self.cur_file.src_path))
+        if ext.lower() == '.tgz':
+            name += '.tar'
+        yield name or 'content', stream
+
+    def _make_scratch_dir(self):
+        """
+        Creates the scratch directory of the run, readable by this user only.
+        scratch_root may be shared (/tmp): raises KittenGroomerError if the
+        directory exists but is not a private directory of this user, like
+        one created beforehand by someone else, or a symlink.
+        """
+        try:
+            os.mkdir(self.scratch_dir, 0o700)
+        except FileExistsError:
+            pass
+        st = os.lstat(self.scratch_dir)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise KittenGroomerError('{} is not a private directory of this user'.format(
+                self.scratch_dir))
+
+    def _process_archive_members(self, members):
+        """Extracts the members of the current archive one at a time to a
+        scratch directory out of the destination, processes and removes them.
+        The scratch path only depends on the archive, so resumed runs find
+        the members they already processed."""
+        archive = self.cur_file
+        self._make_scratch_dir()
+        scratch_dir = os.path.join(self.scratch_dir, hashlib.sha1(
+            archive.dst_path.encode(errors='surrogateescape')).hexdigest())
+        content = ['#' * 80 + '\n', '   +- {}/\n'.format(os.path.basename(archive.src_path))]
+        # In a worker, the members that are not archives are left in the
+        # scratch directory for the other workers (see _processdir_parallel)
+        # and queued as (task, None), as long as they fit in queue_budget.
+        # The nested archives and the members beyond it are processed here
+        # and queued as (None, log lines), like the lines of the archive
+        # itself, so that processing.log keeps the order of a sequential run.
+        take_log_lines, self.take_log_lines = self.take_log_lines, None
+        if take_log_lines is not None:
+            archive.queued_members.append((None, take_log_lines()))
+        try:
+            for name, member in members:
+                relative_path = self._safe_member_path(name)
+                if relative_path is None:
+                    continue
+                srcpath = os.path.join(scratch_dir, relative_path)
+                if srcpath in self.processed:
+                    continue
+                self._check_archive_budgets(entries=1)
+                digest = self._extract_member(member, srcpath)
+                content.append('   |  +-- {}\t- {}\n'.format(relative_path, digest))
+                dstpath = os.path.join(archive.dst_path, relative_path)
+                size = os.lstat(srcpath).st_size
+                if (take_log_lines is not None and size <= self.queue_budget and
+                        not self._is_archive(self.sniffed_mimetypes[srcpath])):
+                    self.queue_budget -= size
+                    archive.queued_members.append(((
+                        srcpath, dstpath, relative_path, self.recursive_archive_depth,
+                        self.sniffed_mimetypes.pop(srcpath), self.digests.pop(srcpath), 0), None))
+                    continue
+                self.process_file(srcpath, dstpath, relative_path)
+                self._safe_remove(srcpath)
+                if take_log_lines is not None:
+                    archive.queued_members.append((None, take_log_lines()))
+        except ARCHIVE_ERRORS as e:
+            self.log_name.warning('Error while reading archive {}: {}', archive.src_path, e)
+        except ArchiveBudgetExceeded:
+            # None of the members are kept
+            archive.queued_members[:] = [(task, lines) for task, lines in archive.queued_members
+                                         if task is None]
+            raise
+        finally:
+            self.cur_file = archive
+            if archive.has_queued_members():
+                archive.scratch_dir = scratch_dir
+            else:
+                self._safe_rmtree(scratch_dir)
+            with open(self.log_content, 'ab') as lf:
+                lf.write(''.join(content).encode(errors='ignore'))
+
+    def _is_archive(self, mimetype):
+        """Returns True if files of mimetype are processed as archives."""
+        main_type, _, sub_type = mimetype.partition('/')
+        return main_type == 'application' and self.subtypes_application.get(sub_type) == self._archive
+
+    def _safe_member_path(self, name):
+        """Returns the path of an archive member relative to the archive,
+        without any absolute or parent directory part."""
+        parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+        if not parts:
+            return None
+        relative_path = os.path.join(*parts)
+        if relative_path != name:
+            self.log_name.warning('Unsafe path in archive: {} extracted as {}', name, relative_path)
+        return relative_path
+
+    def _extract_member(self, member, path):
+        """Writes an archive member to path, remembering its digests and
+        mimetype like tree() does for the source files. Returns the sha1 hash."""
+        self._safe_mkdir(os.path.dirname(path))
+        hashes = self.hasher.new()
+        with open(path, 'wb') as f:
+            buf = member.read(mime_detector.header_size)
+            self.sniffed_mimetypes[path] = mime_detector.from_buffer(buf)
+            while buf:
+                self._check_archive_budgets(len(buf))
+                hashes.update(buf)
+                f.write(buf)
+                buf = member.read(0x100000)
+        self.digests[path] = hashes.hexdigests()
+        return self.digests[path]['sha1']
+
+    def _handle_archivebomb(self, reason=None):
         self.cur_file.make_dangerous()
         self.cur_file.add_log_details('Archive Bomb', True)
         self.log_name.warning('ARCHIVE BOMB.')
-        self.log_name.warning('The content of the archive contains recursively other archives.')
+        if reason is None:
+            self.log_name.warning('The content of the archive contains recursively other archives.')
+        else:
+            self.cur_file.add_log_details('archive_budget', reason)
+            self.log_name.warning('The archive goes over its budget ({}).', reason)
         self.log_name.warning('This is a bad sign so the archive is not extracted to the destination key.')
-        self._safe_rmtree(src_dir)
-        if src_dir.endswith('_temp'):
-            bomb_path = src_dir[:-len('_temp')]
-            self._safe_remove(bomb_path)
 
     def _unknown_app(self):
         """Processes an unknown file."""
@@ -431,7 +1546,18 @@ class KittenGroomerFileCheck(KittenGroomerBase):
     #######################
     # Metadata extractors
     def _metadata_exif(self, metadata_file):
-        img = open(self.cur_file.src_path, 'rb')
+        """Writes the Exif tags of a JPEG or TIFF image. For a JPEG, only its
+        Exif segment is given to exifread, for a TIFF, exifread follows the
+        offsets of the IFDs in the shared buffer."""
+        buf = self.cur_file.open_buffer()
+        if self.cur_file.mimetype == 'image/jpeg':
+            exif = _jpeg_exif(buf)
+            if exif is None:
+                self.cur_file.add_log_details('metadata', 'exif')
+                return True
+            img = io.BytesIO(exif)
+        else:
+            img = buf
         tags = None
 
         try:
@@ -441,11 +1567,12 @@ class KittenGroomerFileCheck(KittenGroomerBase):
             print(e)
         if tags is None:
             try:
-                tags = exifread.process_file(img, debug=True)
+                # Without the maker notes, from the start again
+                img.seek(0)
+                tags = exifread.process_file(img, details=False, debug=True)
             except Exception as e:
                 print("Failed to get any metadata for file {}.".format(self.cur_file.src_path))
                 print(e)
-                img.close()
                 return False
 
         for tag in sorted(tags.keys()):
@@ -462,19 +1589,15 @@ class KittenGroomerFileCheck(KittenGroomerBase):
                         printable = str(value)
                 metadata_file.write("Key: {}\tValue: {}\n".format(tag, printable))
         self.cur_file.add_log_details('metadata', 'exif')
-        img.close()
         return True
 
     def _metadata_png(self, metadataFile):
-        warnings.simplefilter('error', Image.DecompressionBombWarning)
+        """Writes the metadata of a PNG image, read from the shared buffer."""
         try:
-            img = Image.open(self.cur_file.src_path)
-            for tag in sorted(img.info.keys()):
-                # These are long and obnoxious/binary
-                if tag not in ('icc_profile'):
-                    metadataFile.write("Key: {}\tValue: {}\n".format(tag, img.info[tag]))
+            for tag, value in sorted(_png_metadata(self.cur_file.open_buffer()).items()):
+                metadataFile.write("Key: {}\tValue: {}\n".format(tag, value))
             self.cur_file.add_log_details('metadata', 'png')
-            img.close()
+            return True
         # Catch decompression bombs
         except Exception as e:
             print("Caught exception processing metadata for {}".format(self.cur_file.src_path))
@@ -511,54 +1634,203 @@ class KittenGroomerFileCheck(KittenGroomerBase):
     def image(self):
         """Processes an image.
 
-        Extracts metadata if metadata is present. Creates a temporary
-        directory, opens the using PIL.Image, saves it to the temporary
-        directory, and copies it to the destination."""
+        Checks the size of the image read from its header against the
+        image budget. Extracts metadata if metadata is present. Opens the
+        image using PIL.Image and saves its pixels, without the metadata,
+        to a temporary file next to the destination, which is then renamed
+        to the destination."""
+        # Opened once for the check and the conversion, PIL only reads the header here
+        try:
+            image = Image.open(self.cur_file.open_buffer())
+            header = _image_header(image)
+        except Exception:
+            # Not an image PIL can read, the conversion below fails too
+            image = header = None
+        try:
+            if header is not None:
+                self.image_budget.charge(header)
+        except KittenGroomerError as e:
+            print("Image over budget (possible decompression bomb?) in file {}.".format(self.cur_file.src_path))
+            print(e)
+            self.cur_file.add_log_details('image_budget', e.message)
+            self.cur_file.make_dangerous()
+            self._safe_copy()
+            self.cur_file.log_string += 'Image file'
+            self.cur_file.add_log_details('processing_type', 'image')
+            return
+
         if self.cur_file.has_metadata():
             self.extract_metadata()
 
-        # FIXME make sure this works for png, gif, tiff
-        # Create a temp directory
+        # Unique so that workers do not share it, hidden until renamed
         dst_dir, filename = os.path.split(self.cur_file.dst_path)
-        tmpdir = os.path.join(dst_dir, 'temp')
-        tmppath = os.path.join(tmpdir, filename)
-        self._safe_mkdir(tmpdir)
+        self._safe_mkdir(dst_dir)
+        name, ext = os.path.splitext(filename)
+        tmppath = os.path.join(dst_dir, '.{}.{}{}'.format(name, os.urandom(4).hex(), ext))
 
         # Do our image conversions
-        warnings.simplefilter('error', Image.DecompressionBombWarning)
         try:
-            imIn = Image.open(self.cur_file.src_path)
-            imOut = Image.frombytes(imIn.mode, imIn.size, imIn.tobytes())
-            imOut.save(tmppath)
-
-            # Copy the file back out and cleanup
-            self._safe_copy(tmppath)
-            self._safe_rmtree(tmpdir)
+            if image is None:
+                image = Image.open(self.cur_file.open_buffer())
+            self._reencode_image(image, tmppath)
+            os.replace(tmppath, self.cur_file.dst_path)
+            self.cur_file.copied_from = tmppath
 
         # Catch decompression bombs
         except Exception as e:
             print("Caught exception (possible decompression bomb?) while translating file {}.".format(self.cur_file.src_path))
             print(e)
+            self._safe_remove(tmppath)
             self.cur_file.make_dangerous()
             self._safe_copy()
 
         self.cur_file.log_string += 'Image file'
         self.cur_file.add_log_details('processing_type', 'image')
 
+    def _reencode_image(self, image, path):
+        """Saves the pixels of all the frames of image to path.
+
+        TIFF pages are written one at a time, the other writers get every
+        frame at once. Images needing more than max_image_memory bytes to
+        decode are refused before decoding."""
+        n_frames = getattr(image, 'n_frames', 1)
+        # The writers of multi-frame images other than TIFF keep every frame
+        retained = n_frames if n_frames > 1 and image.format != 'TIFF' else 1
+        self._check_image_memory(image, retained)
+        if n_frames == 1:
+            self._stripped_frame(image).save(path)
+        elif image.format == 'TIFF':
+            with open(path, 'w+b') as f, TiffImagePlugin.AppendingTiffWriter(f) as tf:
+                for frame in ImageSequence.Iterator(image):
+                    # Pages of a TIFF can have different sizes
+                    self._check_image_memory(frame)
+                    self._stripped_frame(frame).save(tf, format='TIFF')
+                    tf.newFrame()
+        else:
+            # A list, the PNG writer goes through append_images twice
+            frames = [self._stripped_frame(frame) for frame in ImageSequence.Iterator(image)]
+            frames[0].save(path, save_all=True, append_images=frames[1:])
+
+    def _check_image_memory(self, image, frames=1):
+        # PIL stores pixels with more than one band on 4 bytes
+        width, height = image.size
+        needed = width * height * 4 * frames
+        if needed > self.max_image_memory:
+            raise KittenGroomerError('Decoding the image needs {} bytes, more than {}'.format(
+                needed, self.max_image_memory))
+
+    @staticmethod
+    def _stripped_frame(frame):
+        """Returns a copy of the decoded pixels of frame, without its metadata.
+
+        Some decoders reuse the pixels of a frame for the next one, so the
+        frames kept by the writer are detached from the image."""
+        stripped = frame.copy()
+        stripped.info = {key: frame.info[key] for key in ('transparency', 'duration', 'loop')
+                         if key in frame.info}
+        return stripped
+
     #######################
 
-    def process_file(self, srcpath, dstpath, relative_path):
-        self.cur_file = File(srcpath, dstpath)
+    def process_file(self, srcpath, dstpath, relative_path, entry=None):
+        """Process a single file, returns the File object holding its results."""
+        start = time.perf_counter()
+        nested_time, self._nested_time = self._nested_time, 0.0
+        file = self.cur_file = File(srcpath, dstpath, self.sniffed_mimetypes.pop(srcpath, None),
+                                    self.digests.pop(srcpath, None), entry)
+        size = file.size
+        digest = self._content_key(file)
         self.log_name.info('Processing {} ({}/{})',
                            relative_path,
                            self.cur_file.main_type,
                            self.cur_file.sub_type)
         if not self.cur_file.is_dangerous():
-            self.mime_processing_options.get(self.cur_file.main_type, self.unknown)()
+            verdict = self._get_cached_verdict(digest)
+            if verdict is not None:
+                self._apply_cached_verdict(verdict)
+            elif not self._apply_duplicate(digest):
+                self._run_handler()
+                # Archives replace cur_file while processing their content
+                self.cur_file = file
+                self._cache_verdict(digest)
+                self._remember_outputs(digest)
         else:
             self._safe_copy()
-        if not self.cur_file.is_recursive:
+        if not file.is_recursive:
             self._print_log()
+        file.close()
+        if not file.has_queued_members():
+            # Otherwise once its members are processed, see _processdir_parallel
+            self.journal.record(srcpath, file.dst_path, file.get_verdict())
+        elapsed = time.perf_counter() - start
+        # Without the archive members processed meanwhile
+        self.timings.append((file.mimetype, size, elapsed - self._nested_time))
+        self._nested_time = nested_time + elapsed
+        return file
+
+    def _run_handler(self):
+        """
+        Runs the handler of the current file under the watchdog, with the
+        budget of its type in handler_timeouts. Killed when it goes over it
+        or over handler_memory bytes of resident memory, the file is made
+        dangerous with a timeout or oom log detail and copied as is.
+
+        The handlers in unwatched_handlers run inline.
+        """
+        handler = self.mime_processing_options.get(self.cur_file.main_type, self.unknown)
+        if self.cur_file.main_type == 'application':
+            target = self.subtypes_application.get(self.cur_file.sub_type) or handler
+        else:
+            target = handler
+        timeout = self.handler_timeouts.get(
+            self.cur_file.mimetype,
+            self.handler_timeouts.get(self.cur_file.main_type, self.default_handler_timeout))
+        if self.watchdog is None or target.__name__ in self.unwatched_handlers:
+            handler()
+            return
+        result = self.watchdog.run(lambda: self._handler_in_child(handler), timeout)
+        if result['result'] is not None:
+            state, pixels, unsynced = result['result']
+            for name, value in state.items():
+                setattr(self.cur_file, name, value)
+            self.image_budget.pixels += pixels
+            self.copy_engine.add_unsynced(unsynced)
+            return
+        if result['timed_out']:
+            self.cur_file.add_log_details('timeout', timeout)
+        elif result['oom']:
+            self.cur_file.add_log_details('oom', self.handler_memory)
+        else:
+            self.cur_file.add_log_details('handler_error', result['error'].strip().splitlines()[-1])
+        self._remove_partial_outputs(self.cur_file.dst_path)
+        self.cur_file.make_dangerous()
+        self._safe_copy()
+
+    def _handler_in_child(self, handler):
+        """Runs handler in the watchdog child, returns what it changed."""
+        pixels = self.image_budget.pixels
+        # Those of the parent are flushed by the parent
+        self.copy_engine.take_unsynced()
+        handler()
+        self.cur_file.close()
+        state = {name: getattr(self.cur_file, name) for name in self.handler_state}
+        return state, self.image_budget.pixels - pixels, self.copy_engine.take_unsynced()
+
+    def _remove_partial_outputs(self, dst_path):
+        """Removes what a killed handler may have written for dst_path."""
+        dst_dir, filename = os.path.split(dst_path)
+        if not os.path.isdir(dst_dir):
+            return
+        name, ext = os.path.splitext(filename)
+        outputs = {filename}
+        if not os.path.exists(self.cur_file.src_path + '.metadata.txt'):
+            outputs.add(filename + '.metadata.txt')
+        # Temporary files of the copy engine and of the image conversion
+        temporary = re.compile(r'\.(?:{}\.[0-9a-f]{{8}}\.tmp|{}\.[0-9a-f]{{8}}{})$'.format(
+            re.escape(filename), re.escape(name), re.escape(ext)))
+        for candidate in os.listdir(dst_dir):
+            if candidate in outputs or temporary.match(candidate):
+                self._safe_remove(os.path.join(dst_dir, candidate))
 
     def processdir(self, src_dir=None, dst_dir=None):
         """Main function coordinating file processing."""
@@ -566,19 +1838,164 @@ class KittenGroomerFileCheck(KittenGroomerBase):
             src_dir = self.src_root_dir
         if dst_dir is None:
             dst_dir = self.dst_root_dir
-
-        if self.recursive_archive_depth > 0:
-            self._print_log()
-
-        if self.recursive_archive_depth >= self.max_recursive_depth:
-            self._handle_archivebomb(src_dir)
-
-        for srcpath in self._list_all_files(src_dir):
-            dstpath = srcpath.replace(src_dir, dst_dir)
-            relative_path = srcpath.replace(src_dir + '/', '')
-            # which path do we want in the log?
-            self.process_file(srcpath, dstpath, relative_path)
+        # Archives are processed by _archive, which checks their depth and budgets
+        if self.workers > 1:
+            self._processdir_parallel(src_dir, dst_dir)
+        else:
+            for entry in self._list_file_paths(src_dir, dst_dir):
+                self.process_file(*entry)
+        # The copies are on disk before the last journal entries
+        self.copy_engine.close()
+        self.journal.close()
+        self._learn_costs()
+        # Kept if interrupted, for the resumed run
+        self._safe_rmtree(self.scratch_dir)
+
+    def _learn_costs(self):
+        """Teaches the timings of the files processed so far to the cost model and saves it."""
+        for mimetype, size, duration in self.timings:
+            self.cost_model.record(mimetype, size, duration)
+        self.timings = []
+        self.cost_model.save()
+
+    def _list_file_paths(self, src_dir, dst_dir):
+        """
+        Generate (srcpath, dstpath, relative_path, entry) for all the files
+        in src_dir, the arguments of process_file.
+
+        Files already processed by the run being resumed are skipped. The
+        content of an archive is recorded before the archive itself, so
+        an interrupted archive is extracted again but only its remaining
+        files are processed.
+        """
+        for entry in self._walk_files(src_dir, dst_dir):
+            if entry.path in self.processed:
+                continue
+            yield entry.path, entry.dst_path, entry.relative_path, entry.entry
+
+    def _processdir_parallel(self, src_dir, dst_dir):
+        """
+        Process the files of src_dir in a pool of self.workers processes.
+
+        Every worker holds its own copy of the groomer, so cur_file is only
+        ever the file processed by that worker. The files are handed out
+        from the longest to the shortest expected processing time (see
+        CostModel), so that a big file found last does not keep one worker
+        busy long after the others are done. The members of an archive
+        processed by a worker join the queue, except nested archives which
+        are processed by that worker, and the members beyond max_queued_size
+        bytes waiting in the scratch directories. The log lines of each file are sent
+        back and written in the order of a sequential run, so
+        processing.log is the same.
+        """
+        scheduler = WorkScheduler(self.cost_model)
+        for srcpath, dstpath, relative_path, entry in self._list_file_paths(src_dir, dst_dir):
+            # An os.DirEntry can't be sent to the workers
+            scheduler.add((srcpath, dstpath, relative_path, 0, None, None, 0),
+                          self.sniffed_mimetypes.get(srcpath), entry.stat(follow_symlinks=False).st_size)
+        running = {}
+        # Bytes archives being processed may queue, by future
+        granted = {}
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                     initargs=(self,)) as executor:
+                with open(self.log_processing, 'a') as lf:
+                    while scheduler.has_tasks() or running:
+                        # Some tasks ahead so that the workers don't wait for the next one
+                        while scheduler.has_tasks() and len(running) < 2 * self.workers:
+                            task_id, task = scheduler.pop()
+                            if task[3] == 0 and self._is_archive(self.sniffed_mimetypes.get(task[0], '')):
+                                queue_size = max(0, self.max_queued_size - scheduler.queued_size -
+                                                 sum(granted.values()))
+                                task = task[:6] + (queue_size,)
+                            future = executor.submit(_process_file_in_worker, task)
+                            running[future] = task_id
+                            granted[future] = task[6]
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            granted.pop(future)
+                            lines, members, journal_entry, timings, content = future.result()
+                            self.timings.extend(timings)
+                            for srcpath, dstpath, verdict, scratch_dir in scheduler.done(
+                                    running.pop(future), lines, members, journal_entry, content):
+                                self.journal.record(srcpath, dstpath, verdict)
+                                self._safe_rmtree(scratch_dir)
+                        lf.write(scheduler.take_lines())
+                        lf.flush()
+                        content = scheduler.take_content()
+                        if content:
+                            with open(self.log_content, 'ab') as cf:
+                                cf.write(content)
+        finally:
+            # Interrupted, a resumed run extracts the queued members again
+            journal_entries = scheduler.pending_archives()
+            for future in running:
+                # Completed while the pool was shut down
+                if not future.cancelled() and future.exception() is None and future.result()[2]:
+                    journal_entries.append(future.result()[2])
+            for srcpath, dstpath, verdict, scratch_dir in journal_entries:
+                self._safe_rmtree(scratch_dir)
 
 
 if __name__ == '__main__':
-    main(KittenGroomerFileCheck, 'File sanitizer used in CIRCLean. Renames potentially dangerous files.')
+    parser = get_parser('File sanitizer used in CIRCLean. Renames potentially dangerous files.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of files processed in parallel (default: 1)')
+    parser.add_argument('--cache', type=str,
+                        help='SQLite file caching the verdicts of already seen files')
+    parser.add_argument('--cache-size', type=int, default=100000,
+                        help='Maximum number of verdicts kept in the cache (default: 100000)')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='Remove every verdict from the cache before the run')
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false',
+                        help='Process every copy of the same file instead of linking the outputs '
+                             'of the first one')
+    parser.add_argument('--cost-model', type=str,
+                        help='JSON file keeping the processing costs by mimetype learned by the runs, '
+                             'used to start the longest files first with several workers')
+    parser.add_argument('--scratch-dir', type=str,
+                        help='Directory the archive members are extracted to before being processed '
+                             '(default: the temporary directory of the system)')
+    parser.add_argument('--max-queued-size', type=int, default=0x10000000,
+                        help='Maximum size in bytes of the archive members extracted ahead for the '
+                             'other workers, the others are processed by the worker of their '
+                             'archive (default: 256MiB)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume an interrupted run, skipping the files in its journal')
+    parser.add_argument('--max-archive-size', type=int, default=0x100000000,
+                        help='Maximum uncompressed size of an archive in bytes (default: 4GiB)')
+    parser.add_argument('--max-archive-entries', type=int, default=100000,
+                        help='Maximum number of files in an archive (default: 100000)')
+    parser.add_argument('--max-compression-ratio', type=int, default=100,
+                        help='Maximum compression ratio of an archive (default: 100)')
+    parser.add_argument('--max-run-size', type=int,
+                        help='Maximum size in bytes extracted from all the archives of the run')
+    parser.add_argument('--max-image-memory', type=int, default=0x40000000,
+                        help='Maximum memory in bytes needed to decode an image (default: 1GiB)')
+    parser.add_argument('--max-image-pixels', type=int, default=MAX_IMAGE_PIXELS,
+                        help='Maximum number of pixels in an image frame, PIL refuses more than '
+                             'twice its default anyway (default: {})'.format(MAX_IMAGE_PIXELS))
+    parser.add_argument('--max-run-pixels', type=int,
+                        help='Maximum number of pixels decoded from all the images of the run')
+    parser.add_argument('--fsync', choices=CopyEngine.fsync_policies, default='end',
+                        help='When the copies are flushed to disk: after each file, every 100 '
+                             'files, at the end of the run or never (default: end)')
+    parser.add_argument('--digests', dest='digest_algorithms', default=('sha1',),
+                        type=lambda value: tuple(value.split(',')),
+                        help='Comma separated hashlib algorithms computed for every file, sha1 is '
+                             'always included (example: sha1,sha256,blake2b)')
+    parser.add_argument('--tree-hash-size', type=int,
+                        help='Hash the files of at least this size in bytes by chunks on several '
+                             'cores, the digests besides sha1 are then tree digests')
+    parser.add_argument('--no-watchdog', dest='watchdog', action='store_false',
+                        help='Run the handlers in the groomer process, without time and memory limits')
+    parser.add_argument('--handler-timeout', type=float,
+                        help='Seconds before a handler is killed and its file made dangerous, for '
+                             'all the types (default: {}, other types {})'.format(
+                                 ', '.join('{} {}'.format(key, value) for key, value in
+                                           sorted(KittenGroomerFileCheck.handler_timeouts.items())),
+                                 KittenGroomerFileCheck.default_handler_timeout))
+    parser.add_argument('--handler-memory', type=int, default=0x80000000,
+                        help='Resident memory in bytes before a handler is killed and its file made '
+                             'dangerous (default: 2GiB)')
+    main(KittenGroomerFileCheck, parser=parser)
@@ -2,11 +2,17 @@
 # -*- coding: utf-8 -*-
 import os
 import mimetypes
-import shlex
+import queue
+import shutil
+import signal
+import socket
 import subprocess
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from kittengroomer import FileBase, KittenGroomerBase, main
+from kittengroomer import FileBase, KittenGroomerBase, SubtypeDispatcher, main, get_parser
 
 UNOCONV = '/usr/bin/unoconv'
 LIBREOFFICE = '/usr/bin/libreoffice'
@@ -41,9 +47,9 @@ propertype = {'.gz': 'application/gzip'}
 
 class File(FileBase):
 
-    def __init__(self, src_path, dst_path):
+    def __init__(self, src_path, dst_path, entry=None):
         ''' Init file object, set the mimetype '''
-        super(File, self).__init__(src_path, dst_path)
+        super(File, self).__init__(src_path, dst_path, entry=entry)
 
         self.is_recursive = False
         if not self.has_mimetype():
@@ -89,9 +95,120 @@ class File(FileBase):
             pass
 
 
+class _Listener(object):
+    '''A LibreOffice instance started by unoconv, with its own port and profile'''
+
+    def __init__(self, port):
+        self.port = port
+        self.profile = tempfile.mkdtemp(prefix='unoconv_profile_')
+        self.process = None
+        self.ready = False
+        self.documents = 0
+
+    def start(self, log_file):
+        command = [UNOCONV, '--listener', '--port', str(self.port), '--user-profile', self.profile]
+        self.process = subprocess.Popen(command, stdout=log_file, stderr=log_file,
+                                        start_new_session=True)
+        self.ready = False
+        self.documents = 0
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            # Kills LibreOffice with its unoconv parent
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        self.process = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def wait_ready(self, timeout):
+        '''Wait until the listener accepts connections, returns False if it doesn't in time'''
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.is_alive():
+                return False
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+            except OSError:
+                time.sleep(0.1)
+                continue
+            self.ready = True
+            return True
+        return False
+
+
+class ConverterPool(object):
+    '''
+        Pool of warm unoconv listeners converting documents in parallel.
+
+        Requests go to the idle listeners in turn. A listener that died or
+        hung is restarted, and listeners are recycled after max_documents
+        conversions.
+    '''
+
+    def __init__(self, runner, size=None, base_port=2002, max_documents=50,
+                 startup_timeout=60, timeout=300, log_file=os.devnull):
+        self.runner = runner
+        self.size = size or os.cpu_count() or 1
+        self.max_documents = max_documents
+        self.startup_timeout = startup_timeout
+        self.timeout = timeout
+        self._log = open(log_file, 'ab')
+        self._listeners = [_Listener(base_port + i) for i in range(self.size)]
+        self._idle = queue.Queue()
+        for listener in self._listeners:
+            # All the instances start at once, they are probed when first used
+            listener.start(self._log)
+            self._idle.put(listener)
+
+    def _acquire(self):
+        listener = self._idle.get()
+        for attempt in range(2):
+            if not listener.is_alive() or listener.documents >= self.max_documents:
+                listener.stop()
+                listener.start(self._log)
+            if listener.ready or listener.wait_ready(self.startup_timeout):
+                return listener
+            listener.stop()
+        self._idle.put(listener)
+        return None
+
+    def convert(self, src_path, dst_path, stdout=None, stderr=None):
+        '''Convert src_path to the PDF dst_path, returns the result of the runner or None'''
+        listener = self._acquire()
+        if listener is None:
+            return None
+        command = [UNOCONV, '--no-launch', '--port', str(listener.port), '--format', 'pdf',
+                   '-eSelectPdfVersion=1', '--output', dst_path, src_path]
+        try:
+            result = self.runner.run(command, self.timeout, stdout, stderr)
+        except Exception:
+            listener.stop()
+            self._idle.put(listener)
+            raise
+        listener.documents += 1
+        if result['timed_out']:
+            # Probably hung on this document, start again with a fresh instance
+            listener.stop()
+        self._idle.put(listener)
+        return result
+
+    def close(self):
+        for listener in self._listeners:
+            listener.stop()
+            shutil.rmtree(listener.profile, ignore_errors=True)
+        self._log.close()
+
+
 class KittenGroomer(KittenGroomerBase):
 
-    def __init__(self, root_src=None, root_dst=None, max_recursive=2, debug=False):
+    def __init__(self, root_src=None, root_dst=None, max_recursive=2, debug=False, converters=None,
+                 pdfa_workers=None):
         '''
             Initialize the basics of the conversion process
         '''
@@ -112,7 +229,8 @@ class KittenGroomer(KittenGroomerBase):
             (mimes_compressed, self._archive),
             (mimes_data, self._binary_app),
         ]
-        self.subtypes_application = self._init_subtypes_application(subtypes_apps)
+        # Patterns are tried in this order, the first match wins
+        self.subtypes_application = SubtypeDispatcher(subtypes_apps)
 
         self.mime_processing_options = {
             'text': self.text,
@@ -127,20 +245,15 @@ class KittenGroomer(KittenGroomerBase):
             'inode': self.inode,
         }
 
-        unoconv_listener = UNOCONV + ' --listener'
-        self._run_process(unoconv_listener, background=True)
+        self.converter_pool = ConverterPool(self.tool_runner, converters, log_file=self.log_debug_err)
+        # Office conversions run in the background, one per listener
+        self.converter_executor = ThreadPoolExecutor(self.converter_pool.size)
+        # So do the PDF/A normalizations, with pdfa_workers gs at once
+        self.pdfa_executor = ThreadPoolExecutor(pdfa_workers or os.cpu_count() or 1)
+        self.conversions = []
+        self._conversions_lock = threading.Lock()
 
     # ##### Helpers #####
-    def _init_subtypes_application(self, subtypes_application):
-        '''
-            Create the Dict to pick the right function based on the sub mime type
-        '''
-        to_return = {}
-        for list_subtypes, fct in subtypes_application:
-            for st in list_subtypes:
-                to_return[st] = fct
-        return to_return
-
     def _print_log(self):
         '''
             Print the logs related to the current file being processed
@@ -153,28 +266,21 @@ class KittenGroomer(KittenGroomerBase):
         else:
             tmp_log.debug(self.cur_file.log_string)
 
-    def _run_process(self, command_line, timeout=0, background=False):
-        '''Run subprocess, wait until it finishes'''
-        if timeout != 0:
-            deadline = time.time() + timeout
-        else:
-            deadline = None
-        args = shlex.split(command_line)
-        with open(self.log_debug_err, 'ab') as stderr, open(self.log_debug_out, 'ab') as stdout:
-            p = subprocess.Popen(args, stdout=stdout, stderr=stderr)
-        if background:
-            # FIXME: This timer is here to make sure the unoconv listener is properly started.
-            time.sleep(10)
-            return True
-        while True:
-            code = p.poll()
-            if code is not None:
-                break
-            if deadline is not None and time.time() > deadline:
-                p.kill()
-                break
-            time.sleep(1)
-        return True
+    def _queue_conversion(self, executor, fn, src_path, *args):
+        '''Run fn(src_path, *args) with executor, _wait_conversions waits for it'''
+        conversion = executor.submit(fn, src_path, *args)
+        with self._conversions_lock:
+            self.conversions.append((src_path, conversion))
+
+    def _wait_conversions(self):
+        '''Wait until the conversions started so far are done, a failed one is only logged'''
+        with self._conversions_lock:
+            conversions, self.conversions = self.conversions, []
+        for src_path, conversion in conversions:
+            try:
+                conversion.result()
+            except Exception as e:
+                self.log_name.warning('Conversion of {} failed: {!r}', src_path, e)
 
     #######################
 
@@ -216,11 +322,11 @@ class KittenGroomer(KittenGroomerBase):
 
     def application(self):
         ''' Everything can be there, using the subtype to decide '''
-        for subtype, fct in list(self.subtypes_application.items()):
-            if subtype in self.cur_file.sub_type:
-                fct()
-                self.cur_file.log_string += 'Application file'
-                return
+        fct = self.subtypes_application.get(self.cur_file.sub_type)
+        if fct is not None:
+            fct()
+            self.cur_file.log_string += 'Application file'
+            return
         self.cur_file.log_string += 'Unknown Application file'
         self._unknown_app()
 
@@ -231,40 +337,62 @@ class KittenGroomer(KittenGroomerBase):
         self._safe_copy()
 
     def _office_related(self):
-        '''Way to process all the files LibreOffice can handle'''
+        '''Way to process all the files LibreOffice can handle, the conversion runs in the background'''
         self.cur_file.add_log_details('processing_type', 'office')
         dst_dir, filename = os.path.split(self.cur_file.dst_path)
-        tmpdir = os.path.join(dst_dir, 'temp')
+        self._safe_mkdir(dst_dir)
+        # One directory per conversion, several of them run at once
+        tmpdir = tempfile.mkdtemp(prefix='temp', dir=dst_dir)
         name, ext = os.path.splitext(filename)
         tmppath = os.path.join(tmpdir, name + '.pdf')
-        self._safe_mkdir(tmpdir)
-        lo_command = '{} --format pdf -eSelectPdfVersion=1 --output "{}" "{}"'.format(
-            UNOCONV, tmppath, self.cur_file.src_path)
-        self._run_process(lo_command)
-        self._pdfa(tmppath)
-        self._safe_rmtree(tmpdir)
-
-    def _pdfa(self, tmpsrcpath):
+        self._queue_conversion(self.converter_executor, self._convert_office,
+                               self.cur_file.src_path, tmppath, self.cur_file.dst_path, tmpdir)
+
+    def _convert_office(self, src_path, tmppath, dst_path, tmpdir):
+        '''Convert an office document to PDF then HTML, runs in a converter thread'''
+        try:
+            with open(self.log_debug_err, 'ab') as stderr, open(self.log_debug_out, 'ab') as stdout:
+                result = self.converter_pool.convert(src_path, tmppath, stdout, stderr)
+                if result is None or result['returncode'] != 0:
+                    self.log_name.warning('Conversion of {} to PDF failed.', src_path)
+                    return
+                self._pdfa(tmppath, dst_path, stdout, stderr)
+        finally:
+            self._safe_rmtree(tmpdir)
+
+    def _pdfa(self, tmpsrcpath, dst_path, stdout=None, stderr=None):
         '''Way to process PDF/A file'''
-        pdf_command = '{} --dest-dir / "{}" "{}"'.format(PDF2HTMLEX, tmpsrcpath, self.cur_file.dst_path + '.html')
-        self._run_process(pdf_command)
+        pdf_command = [PDF2HTMLEX, '--dest-dir', '/', tmpsrcpath, dst_path + '.html']
+        return self.tool_runner.run(pdf_command, stdout=stdout, stderr=stderr)
 
     def _pdf(self):
-        '''Way to process PDF file'''
+        '''Way to process PDF file, the conversion runs in the background'''
         self.cur_file.add_log_details('processing_type', 'pdf')
         dst_dir, filename = os.path.split(self.cur_file.dst_path)
-        tmpdir = os.path.join(dst_dir, 'temp')
+        self._safe_mkdir(dst_dir)
+        tmpdir = tempfile.mkdtemp(prefix='temp', dir=dst_dir)
         tmppath = os.path.join(tmpdir, filename)
-        self._safe_mkdir(tmpdir)
+        self._queue_conversion(self.pdfa_executor, self._convert_pdf,
+                               self.cur_file.src_path, tmppath, self.cur_file.dst_path, tmpdir)
+
+    def _convert_pdf(self, src_path, tmppath, dst_path, tmpdir):
+        '''Normalize a PDF to PDF/A then convert it to HTML, runs in a PDF/A worker thread'''
         # The magic comes from here: http://svn.ghostscript.com/ghostscript/trunk/gs/doc/Ps2pdf.htm#PDFA
-        curdir = os.getcwd()
-        os.chdir(self.resources_path)
-        gs_command = '{} -dPDFA -dQUIET -dSAFER -dBATCH -dNOPAUSE -dNOOUTERSAVE -sProcessColorModel=DeviceCMYK -sDEVICE=pdfwrite -sPDFACompatibilityPolicy=1 -sOutputFile="{}" ./PDFA_def.ps "{}"'.format(
-            GS, os.path.join(curdir, tmppath), os.path.join(curdir, self.cur_file.src_path))
-        self._run_process(gs_command)
-        os.chdir(curdir)
-        self._pdfa(tmppath)
-        self._safe_rmtree(tmpdir)
+        gs_command = [GS, '-dPDFA', '-dQUIET', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-dNOOUTERSAVE',
+                      '-sProcessColorModel=DeviceCMYK', '-sDEVICE=pdfwrite',
+                      '-sPDFACompatibilityPolicy=1', '-sOutputFile=' + os.path.abspath(tmppath),
+                      os.path.join(self.resources_path, 'PDFA_def.ps'), os.path.abspath(src_path)]
+        try:
+            with open(self.log_debug_err, 'ab') as stderr, open(self.log_debug_out, 'ab') as stdout:
+                # PDFA_def.ps finds its ICC profile relative to the working directory
+                result = self.tool_runner.run(gs_command, stdout=stdout, stderr=stderr,
+                                              cwd=self.resources_path)
+                if result['returncode'] != 0:
+                    self.log_name.warning('Conversion of {} to PDF/A failed.', src_path)
+                    return
+                self._pdfa(tmppath, dst_path, stdout, stderr)
+        finally:
+            self._safe_rmtree(tmpdir)
 
     def _archive(self):
         '''Way to process Archive'''
@@ -276,10 +404,16 @@ class KittenGroomer(KittenGroomerBase):
         extract_command = '{} -p1 x "{}" -o"{}" -bd -aoa'.format(SEVENZ, self.cur_file.src_path, tmpdir)
         self._run_process(extract_command)
         self.recursive += 1
-        self.tree(tmpdir)
-        self.processdir(tmpdir, self.cur_file.dst_path)
-        self.recursive -= 1
-        self._safe_rmtree(tmpdir)
+        try:
+            self.tree(tmpdir)
+            self.processdir(tmpdir, self.cur_file.dst_path)
+        finally:
+            self.recursive -= 1
+            try:
+                # The office conversions read their source from tmpdir
+                self._wait_conversions()
+            finally:
+                self._safe_rmtree(tmpdir)
 
     def _unknown_app(self):
         '''Way to process an unknown file'''
@@ -339,17 +473,34 @@ class KittenGroomer(KittenGroomerBase):
                 archbomb_path = src_dir[:-len('_temp')]
                 self._safe_remove(archbomb_path)
 
-        for srcpath in self._list_all_files(src_dir):
-            self.cur_file = File(srcpath, srcpath.replace(src_dir, dst_dir))
+        try:
+            for entry in self._walk_files(src_dir, dst_dir):
+                self.cur_file = File(entry.path, entry.dst_path, entry.entry)
+
+                self.log_name.info('Processing {} ({}/{})', entry.relative_path,
+                                   self.cur_file.main_type, self.cur_file.sub_type)
+                if not self.cur_file.is_dangerous():
+                    self.mime_processing_options.get(self.cur_file.main_type, self.unknown)()
+                else:
+                    self._safe_copy()
+                if not self.cur_file.is_recursive:
+                    self._print_log()
+        finally:
+            if self.recursive == 0:
+                # The LibreOffice listeners outlive us if the pool isn't closed
+                try:
+                    self._wait_conversions()
+                    self.converter_executor.shutdown()
+                    self.pdfa_executor.shutdown()
+                finally:
+                    self.converter_pool.close()
+                    self.copy_engine.close()
 
-            self.log_name.info('Processing {} ({}/{})', srcpath.replace(src_dir + '/', ''),
-                               self.cur_file.main_type, self.cur_file.sub_type)
-            if not self.cur_file.is_dangerous():
-                self.mime_processing_options.get(self.cur_file.main_type, self.unknown)()
-            else:
-                self._safe_copy()
-            if not self.cur_file.is_recursive:
-                self._print_log()
 
 if __name__ == '__main__':
-    main(KittenGroomer, 'Generic version of the KittenGroomer. Convert and rename files.')
+    parser = get_parser('Generic version of the KittenGroomer. Convert and rename files.')
+    parser.add_argument('--converters', type=int,
+                        help='Number of LibreOffice instances converting documents (default: number of CPUs)')
+    parser.add_argument('--pdfa-workers', type=int,
+                        help='Number of PDF/A normalizations running at once (default: number of CPUs)')
+    main(KittenGroomer, parser=parser)
@@ -1,4 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from .helpers import FileBase, KittenGroomerBase, main
+from .helpers import (CopyEngine, CostModel, FileBase, Hasher, KittenGroomerBase,
+                      KittenGroomerError, Journal, MimeDetector, SubtypeDispatcher, ToolRunner,
+                      VerdictCache, Watchdog, main, get_parser, mime_detector)
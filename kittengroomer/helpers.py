@@ -8,11 +8,31 @@ desired behavior.
 """
 
 
+import io
 import os
 import sys
+import json
+import mmap
+import stat
+import errno
+import time
+import shlex
+import pickle
+import select
+import signal
+import asyncio
 import hashlib
 import shutil
+import sqlite3
 import argparse
+import threading
+import traceback
+import collections
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import resource
+except ImportError:
+    resource = None
 
 import magic
 from twiggy import quick_setup, log
@@ -32,6 +52,180 @@ class ImplementationRequired(KittenGroomerError):
     pass
 
 
+class MimeDetector(object):
+    """
+    Determines mimetypes with libmagic from the first bytes of files.
+
+    Every thread (and process) gets its own magic.Magic handle, so there is
+    no contention on the lock of a shared handle. Files are read here,
+    libmagic only ever sees a buffer of at most header_size bytes.
+    """
+
+    header_size = 0x100000
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _get_magic(self):
+        handle = getattr(self._local, 'magic', None)
+        if handle is None:
+            handle = self._local.magic = magic.Magic(mime=True)
+        return handle
+
+    def from_buffer(self, buf):
+        """Returns the mimetype of a buffer holding the beginning of a file."""
+        if not buf:
+            # What libmagic says about an empty file
+            return 'inode/x-empty'
+        mimetype = self._get_magic().from_buffer(bytes(buf[:self.header_size]))
+        if isinstance(mimetype, bytes):
+            mimetype = mimetype.decode('utf-8')
+        return mimetype
+
+    def from_file(self, path):
+        """Returns the mimetype of the file at path (str or bytes)."""
+        with open(path, 'rb') as f:
+            return self.from_buffer(f.read(self.header_size))
+
+    def from_files(self, paths):
+        """Returns the mimetypes of many files, with a single libmagic handle."""
+        return [self.from_file(path) for path in paths]
+
+
+mime_detector = MimeDetector()
+
+
+class _MultiHash(object):
+    """hashlib objects of several algorithms, updated together."""
+
+    def __init__(self, algorithms):
+        self._hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+    def update(self, buf):
+        for h in self._hashes.values():
+            h.update(buf)
+
+    def hexdigests(self):
+        return {algorithm: h.hexdigest() for algorithm, h in self._hashes.items()}
+
+
+class Hasher(object):
+    """
+    Computes the digests of files with several hashlib algorithms in a
+    single read. sha1 is always computed: it identifies the files in
+    content.log.
+
+    If tree_min_size is set, the files of at least that size are hashed by
+    a pool of threads, chunk_size bytes each, and the digest of the other
+    algorithms is the digest of the concatenated digests of the chunks,
+    named '<algorithm>-tree'. sha1 is still the digest of the whole file.
+    """
+
+    chunk_size = 0x4000000
+    read_size = 0x100000
+
+    def __init__(self, algorithms=('sha1',), tree_min_size=None, workers=None):
+        self.algorithms = ('sha1',) + tuple(a for a in algorithms if a != 'sha1')
+        # Raises ValueError for unknown algorithms
+        self.new()
+        self.tree_min_size = tree_min_size
+        self.workers = workers or os.cpu_count() or 1
+
+    def new(self):
+        """Returns an object hashing a stream with all the algorithms (update, hexdigests)."""
+        return _MultiHash(self.algorithms)
+
+    def hash_file(self, path, header_size=0):
+        """Returns the digests of the file at path by algorithm, and its first header_size bytes."""
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if (self.tree_min_size is not None and size >= max(self.tree_min_size, 1) and
+                    len(self.algorithms) > 1):
+                return self._hash_tree(f, size, header_size)
+            hashes = self.new()
+            buf = f.read(header_size or self.read_size)
+            header = buf[:header_size]
+            while buf:
+                hashes.update(buf)
+                buf = f.read(self.read_size)
+        return hashes.hexdigests(), header
+
+    def _hash_tree(self, f, size, header_size):
+        algorithms = self.algorithms[1:]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            view = memoryview(buf)
+
+            def hash_chunk(offset):
+                with view[offset:offset + self.chunk_size] as chunk:
+                    return [hashlib.new(algorithm, chunk).digest() for algorithm in algorithms]
+            try:
+                with ThreadPoolExecutor(self.workers) as executor:
+                    chunks = executor.map(hash_chunk, range(0, size, self.chunk_size))
+                    # hashlib releases the GIL, sha1 runs along the chunks
+                    digests = {'sha1': hashlib.sha1(view).hexdigest()}
+                    chunks = list(chunks)
+                for i, algorithm in enumerate(algorithms):
+                    tree = hashlib.new(algorithm, b''.join(chunk[i] for chunk in chunks))
+                    digests[algorithm + '-tree'] = tree.hexdigest()
+                return digests, bytes(view[:header_size])
+            finally:
+                view.release()
+
+
+class SubtypeDispatcher(object):
+    """
+    Picks the handler of a mime subtype from (list of patterns, handler) pairs.
+
+    A subtype matches a pattern if it contains it. When several patterns
+    match, the first one in the declarations wins. The handler found for a
+    subtype is cached, so every distinct subtype is only matched once.
+    """
+
+    def __init__(self, declarations):
+        self.patterns = tuple((pattern, handler)
+                              for patterns, handler in declarations
+                              for pattern in patterns)
+        self._cache = {}
+
+    def get(self, subtype, default=None):
+        """Returns the handler for subtype, or default if no pattern matches."""
+        try:
+            handler = self._cache[subtype]
+        except KeyError:
+            handler = self._cache[subtype] = self._match(subtype)
+        if handler is None:
+            return default
+        return handler
+
+    def _match(self, subtype):
+        for pattern, handler in self.patterns:
+            if pattern in subtype:
+                return handler
+        return None
+
+
+class _MappedFile(mmap.mmap):
+    """Read-only memory map with the methods some readers expect from a file."""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def __iter__(self):
+        # Lines, like a file, instead of single bytes
+        return iter(self.readline, b'')
+
+
+# A file found by KittenGroomerBase._walk_files: its source path, its path
+# relative to the walked directory, its destination path and its os.DirEntry
+WalkEntry = collections.namedtuple('WalkEntry', ['path', 'relative_path', 'dst_path', 'entry'])
+
+
 class FileBase(object):
     """
     Base object for individual files in the source directory. Contains file
@@ -39,41 +233,89 @@ class FileBase(object):
     or methods relevant to a given implementation.
     """
 
-    def __init__(self, src_path, dst_path):
-        """Initialized with the source path and expected destination path."""
+    def __init__(self, src_path, dst_path, mimetype=None, digests=None, entry=None):
+        """
+        Initialized with the source path and expected destination path.
+
+        If the mimetype is already known (see KittenGroomerBase.tree), pass
+        it so libmagic does not have to read the file again. Same for the
+        digests of the file, by algorithm (see Hasher), and for its
+        os.DirEntry (see KittenGroomerBase._walk_files), which caches the
+        type and stat of the file.
+        """
         self.src_path = src_path
         self.dst_path = dst_path
+        self.digests = digests or {}
+        self.entry = entry
         self.log_details = {'filepath': self.src_path}
         self.log_string = ''
+        # What make_* and force_ext added around the destination filename
+        self.filename_prefix = ''
+        self.filename_suffix = ''
+        # Last file copied to dst_path by KittenGroomerBase._safe_copy
+        self.copied_from = None
+        # Other files written next to dst_path, as (prefix, suffix) around its original filename
+        self.extra_outputs = []
+        self._buffer = None
         self._determine_extension()
-        self._determine_mimetype()
+        self._determine_mimetype(mimetype)
 
     def _determine_extension(self):
         _, ext = os.path.splitext(self.src_path)
         self.extension = ext.lower()
 
-    def _determine_mimetype(self):
-        if os.path.islink(self.src_path):
+    def _determine_mimetype(self, mimetype=None):
+        if self.entry is not None:
+            is_link = self.entry.is_symlink()
+        else:
+            is_link = os.path.islink(self.src_path)
+        if is_link:
             # magic will throw an IOError on a broken symlink
             self.mimetype = 'inode/symlink'
+        elif mimetype is not None:
+            self.mimetype = mimetype
         else:
-            try:
-                mt = magic.from_file(self.src_path, mime=True)
-                # magic will always return something, even if it's just 'data'
-            except UnicodeEncodeError as e:
-                # FIXME: The encoding of the file is broken (possibly UTF-16)
-                mt = ''
-                self.log_details.update({'UnicodeError': e})
-            try:
-                self.mimetype = mt.decode("utf-8")
-            except:
-                self.mimetype = mt
+            # magic will always return something, even if it's just 'data'
+            self.mimetype = mime_detector.from_file(self.src_path)
         if self.mimetype and '/' in self.mimetype:
             self.main_type, self.sub_type = self.mimetype.split('/')
         else:
             self.main_type = ''
             self.sub_type = ''
 
+    @property
+    def size(self):
+        """
+        Size of the source file (of the link itself for a symlink), from the
+        stat cached by its os.DirEntry if any.
+        """
+        if self.entry is not None:
+            return self.entry.stat(follow_symlinks=False).st_size
+        return os.lstat(self.src_path).st_size
+
+    def open_buffer(self):
+        """
+        Returns a read-only view of the content of the file, at position 0.
+
+        The file is mapped in memory on first use and the same map is shared
+        by every handler (and by _safe_copy), call close() when done.
+        """
+        if self._buffer is None:
+            with open(self.src_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    # mmap refuses to map empty files
+                    self._buffer = io.BytesIO()
+                else:
+                    self._buffer = _MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buffer.seek(0)
+        return self._buffer
+
+    def close(self):
+        """Releases the buffer returned by open_buffer."""
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
     def has_mimetype(self):
         """
         Returns True if file has a full mimetype, else False.
@@ -130,44 +372,761 @@ class FileBase(object):
         if self.is_dangerous():
             return
         self.log_details['dangerous'] = True
-        path, filename = os.path.split(self.dst_path)
-        self.dst_path = os.path.join(path, 'DANGEROUS_{}_DANGEROUS'.format(filename))
+        self._add_to_filename('DANGEROUS_', '_DANGEROUS')
 
     def make_unknown(self):
         """Marks a file as an unknown type and prepends UNKNOWN to filename."""
         if self.is_dangerous() or self.is_binary():
             return
         self.log_details['unknown'] = True
-        path, filename = os.path.split(self.dst_path)
-        self.dst_path = os.path.join(path, 'UNKNOWN_{}'.format(filename))
+        self._add_to_filename(prefix='UNKNOWN_')
 
     def make_binary(self):
         """Marks a file as a binary and appends .bin to filename."""
         if self.is_dangerous():
             return
         self.log_details['binary'] = True
-        path, filename = os.path.split(self.dst_path)
-        self.dst_path = os.path.join(path, '{}.bin'.format(filename))
+        self._add_to_filename(suffix='.bin')
 
     def force_ext(self, ext):
         """If dst_path does not end in ext, appends the ext and updates log."""
         if not self.dst_path.endswith(ext):
             self.log_details['force_ext'] = True
-            self.dst_path += ext
+            self._add_to_filename(suffix=ext)
+
+    def _add_to_filename(self, prefix='', suffix=''):
+        """Adds prefix and suffix to the filename of dst_path."""
+        path, filename = os.path.split(self.dst_path)
+        self.dst_path = os.path.join(path, '{}{}{}'.format(prefix, filename, suffix))
+        self.filename_prefix = prefix + self.filename_prefix
+        self.filename_suffix += suffix
+
+    def get_verdict(self):
+        """
+        Returns a dict with what was decided about the file.
+
+        The paths are not part of it: it can be applied with apply_verdict
+        to another file with the same content and extension.
+        """
+        log_details = dict(self.log_details)
+        del log_details['filepath']
+        return {'log_details': log_details,
+                'log_string': self.log_string,
+                'filename_prefix': self.filename_prefix,
+                'filename_suffix': self.filename_suffix,
+                'copied': self.copied_from is not None}
+
+    def apply_verdict(self, verdict):
+        """Updates the log and destination path with a verdict from get_verdict."""
+        self.log_details.update(verdict['log_details'])
+        self.log_string += verdict['log_string']
+        self._add_to_filename(verdict['filename_prefix'], verdict['filename_suffix'])
+
+
+class VerdictCache(object):
+    """
+    On-disk cache of verdicts (see FileBase.get_verdict), stored in SQLite.
+
+    Entries are keyed by the hash of a file, its extension and the version
+    of the rules that produced them: opening the cache with another
+    ruleset_version drops every entry of the previous versions. Beyond
+    max_entries, the least recently used entries are evicted.
+    """
+
+    # Evicting requires counting the entries, only do it every few writes
+    evict_interval = 100
+
+    def __init__(self, path, ruleset_version, max_entries=100000):
+        self.path = path
+        self.ruleset_version = ruleset_version
+        self.max_entries = max_entries
+        self._db = None
+        self._writes = 0
+        self._connect().execute('DELETE FROM verdicts WHERE version != ?', (ruleset_version,))
+
+    def _connect(self):
+        if self._db is None:
+            # Autocommit: several worker processes may share the file
+            self._db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._db.execute('CREATE TABLE IF NOT EXISTS verdicts (digest TEXT, extension TEXT, '
+                             'version TEXT, verdict TEXT, last_used REAL, '
+                             'PRIMARY KEY (digest, extension, version))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS verdicts_last_used ON verdicts (last_used)')
+        return self._db
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        return state
+
+    def get(self, digest, extension):
+        """Returns the verdict stored for digest and extension, or None."""
+        db = self._connect()
+        key = (digest, extension, self.ruleset_version)
+        row = db.execute('SELECT verdict FROM verdicts WHERE digest = ? AND extension = ? '
+                         'AND version = ?', key).fetchone()
+        if row is None:
+            return None
+        db.execute('UPDATE verdicts SET last_used = ? WHERE digest = ? AND extension = ? '
+                   'AND version = ?', (time.time(),) + key)
+        return json.loads(row[0])
+
+    def set(self, digest, extension, verdict):
+        """Stores verdict for digest and extension."""
+        db = self._connect()
+        # Values that are not JSON serializable (exceptions) are logged as strings
+        db.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)',
+                   (digest, extension, self.ruleset_version,
+                    json.dumps(verdict, default=str), time.time()))
+        self._writes += 1
+        if self._writes % self.evict_interval == 0:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries beyond max_entries."""
+        db = self._connect()
+        count = db.execute('SELECT COUNT(*) FROM verdicts').fetchone()[0]
+        if count > self.max_entries:
+            db.execute('DELETE FROM verdicts WHERE rowid IN (SELECT rowid FROM verdicts '
+                       'ORDER BY last_used LIMIT ?)', (count - self.max_entries,))
+
+    def clear(self):
+        """Removes every entry."""
+        self._connect().execute('DELETE FROM verdicts')
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class CostModel(object):
+    """
+    Estimates the time needed to process a file from its size and mimetype.
+
+    The cost of a mimetype is a time per file plus a time per byte, fitted
+    by least squares on the durations recorded for it. Mimetypes with too
+    few records fall back on their main type, then on every record, then
+    on default coefficients. The sums of the fit are kept in a JSON file
+    between runs when a path is given, only the last max_records records
+    of a mimetype count.
+    """
+
+    default_per_file = 0.001
+    default_per_byte = 1e-8
+    max_records = 1000
+
+    def __init__(self, path=None):
+        self.path = path
+        # [count, sum of sizes, sum of durations, sum of sizes², sum of size * duration]
+        self.sums = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.sums = json.load(f)['sums']
+            except (ValueError, KeyError, TypeError):
+                # Written by another version or cut, learned again
+                self.sums = {}
+
+    def _keys(self, mimetype):
+        main_type = (mimetype or '').partition('/')[0]
+        return [mimetype, main_type + '/*', '*']
+
+    def estimate(self, mimetype, size):
+        """Returns the expected processing time of a file, in seconds."""
+        for key in self._keys(mimetype):
+            coefficients = self._fit(self.sums.get(key))
+            if coefficients is not None:
+                per_file, per_byte = coefficients
+                return per_file + per_byte * size
+        return self.default_per_file + self.default_per_byte * size
+
+    def _fit(self, sums):
+        if sums is None or sums[0] < 2:
+            return None
+        count, sx, sy, sxx, sxy = sums
+        variance = count * sxx - sx * sx
+        if variance <= 0:
+            # All the same size
+            return sy / count, 0.0
+        per_byte = (count * sxy - sx * sy) / variance
+        if per_byte < 0:
+            return sy / count, 0.0
+        return max(0.0, (sy - per_byte * sx) / count), per_byte
+
+    def record(self, mimetype, size, duration):
+        """Learns that processing a file of mimetype and size took duration seconds."""
+        for key in self._keys(mimetype):
+            sums = self.sums.setdefault(key, [0, 0.0, 0.0, 0.0, 0.0])
+            if sums[0] >= self.max_records:
+                # The older records weigh less and less
+                scale = (self.max_records - 1) / sums[0]
+                sums[:] = [value * scale for value in sums]
+            for i, value in enumerate((1, size, duration, size * size, size * duration)):
+                sums[i] += value
+
+    def save(self):
+        """Writes the sums to path, if any."""
+        if self.path is None:
+            return
+        tmppath = '{}.{}.tmp'.format(self.path, os.urandom(4).hex())
+        with open(tmppath, 'w') as f:
+            json.dump({'sums': self.sums}, f)
+        os.replace(tmppath, self.path)
+
+
+class Journal(object):
+    """
+    Append-only record of the files completely processed during a run.
+
+    Each entry is a JSON line written with a single write() on a file
+    opened in append mode, so worker processes can share the journal.
+    Entries are only fsync'ed every fsync_interval records (and by sync).
+    """
+
+    fsync_interval = 100
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._unsynced = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        state['_unsynced'] = 0
+        return state
+
+    def load(self):
+        """Returns the recorded entries by source path, {} if there is no journal."""
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last entry, cut by the interruption
+                    continue
+                entries[entry['src']] = entry
+        return entries
+
+    def record(self, src_path, dst_path, verdict):
+        """Records that src_path has been processed to dst_path."""
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        entry = {'src': src_path, 'dst': dst_path, 'verdict': verdict}
+        os.write(self._fd, (json.dumps(entry, default=str) + '\n').encode())
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """Makes sure all the entries written so far are on disk."""
+        if self._fd is None:
+            if not os.path.exists(self.path):
+                return
+            # Also covers the entries written by other processes
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        os.fsync(self._fd)
+        self._unsynced = 0
+
+    def close(self):
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+
+
+class ToolRunner(object):
+    """
+    Run external tools in asyncio subprocesses, from any thread.
+
+    The event loop runs in a background thread started on first use. At
+    most limits[tool] instances of a tool run at once (default_limit if it
+    isn't listed, the number of CPUs by default), tool being the basename
+    of the executable. A call going over its timeout kills the process
+    group of the tool, so its children are killed too. Subprocesses on a
+    loop outside the main thread need the ThreadedChildWatcher of Python 3.8.
+    """
+
+    def __init__(self, limits=None, default_limit=None, timeout=None):
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit or os.cpu_count() or 1
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._loop = None
+        self._pid = None
+        self._semaphores = {}
+
+    def __getstate__(self):
+        """Drop the event loop, the unpickled runner starts its own."""
+        state = self.__dict__.copy()
+        state.update(_lock=None, _loop=None, _pid=None, _semaphores={})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        with self._lock:
+            # A forked child can't use the thread of its parent
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                self._semaphores = {}
+                threading.Thread(target=self._loop.run_forever, daemon=True).start()
+            return self._loop
+
+    def submit(self, args, timeout=None, stdout=None, stderr=None, cwd=None):
+        """Start the command args, returns a concurrent.futures.Future of its result."""
+        return asyncio.run_coroutine_threadsafe(self._run(args, timeout, stdout, stderr, cwd),
+                                                self._get_loop())
+
+    def run(self, args, timeout=None, stdout=None, stderr=None, cwd=None):
+        """
+        Run the command args and wait until it finishes.
+
+        Returns a dict with the tool, its returncode, the duration of the
+        call in seconds, whether it timed out and its output if stdout is
+        subprocess.PIPE. The command runs in cwd if given, the working
+        directory of the process is never changed.
+        """
+        return self.submit(args, timeout, stdout, stderr, cwd).result()
+
+    async def _run(self, args, timeout, stdout, stderr, cwd):
+        tool = os.path.basename(args[0])
+        if tool not in self._semaphores:
+            self._semaphores[tool] = asyncio.Semaphore(self.limits.get(tool, self.default_limit))
+        if timeout is None:
+            timeout = self.timeout
+        async with self._semaphores[tool]:
+            start = time.monotonic()
+            process = await asyncio.create_subprocess_exec(*args, stdout=stdout, stderr=stderr,
+                                                           cwd=cwd, start_new_session=True)
+            timed_out = False
+            try:
+                output, _ = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                output = None
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                await process.wait()
+        return {'tool': tool, 'returncode': process.returncode,
+                'duration': time.monotonic() - start, 'timed_out': timed_out,
+                'output': output}
+
+
+class Watchdog(object):
+    """
+    Run functions in a forked child process, killed when it goes over its
+    timeout or over max_rss bytes of resident memory.
+
+    The child starts with the state of the parent at the time of the call
+    and only hands back the return value of the function, pickled. The
+    resident memory is read from /proc every poll_interval seconds, and
+    the data segment of the child is limited to max_rss bytes more than
+    at the fork, so that faster allocations fail in the child instead.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, max_rss=None):
+        self.max_rss = max_rss
+
+    @staticmethod
+    def available():
+        """Returns True if functions can be run in a child process here."""
+        return hasattr(os, 'fork')
+
+    def run(self, function, timeout=None):
+        """
+        Run function in a child process and wait until it returns.
+
+        Returns a dict with its result (None if it did not return), its
+        duration in seconds, whether it was killed for going over its
+        timeout (timed_out) or its memory limit (oom), and the traceback or
+        reason of its failure as error, if any.
+        """
+        start = time.monotonic()
+        # Flushed now, so that the child does not write them again
+        sys.stdout.flush()
+        sys.stderr.flush()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self._child(function, write_fd)
+        os.close(write_fd)
+        chunks = []
+        result = {'result': None, 'duration': 0, 'timed_out': False, 'oom': False, 'error': None}
+        try:
+            while True:
+                wait = self.poll_interval
+                if timeout is not None:
+                    wait = min(wait, start + timeout - time.monotonic())
+                    if wait <= 0:
+                        result['timed_out'] = True
+                        break
+                ready, _, _ = select.select([read_fd], [], [], wait)
+                if ready:
+                    chunk = os.read(read_fd, 0x10000)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                elif self.max_rss is not None and self._rss(pid) > self.max_rss:
+                    result['oom'] = True
+                    break
+        finally:
+            os.close(read_fd)
+            if result['timed_out'] or result['oom'] or sys.exc_info()[0] is not None:
+                os.kill(pid, signal.SIGKILL)
+            _, status = os.waitpid(pid, 0)
+            result['duration'] = time.monotonic() - start
+        if result['timed_out'] or result['oom']:
+            return result
+        try:
+            kind, value = pickle.loads(b''.join(chunks))
+        except Exception:
+            # Died before handing back its result (crash, killed by the kernel...)
+            result['error'] = 'child process ended with status {}'.format(status)
+            return result
+        if kind == 'oom':
+            result['oom'] = True
+        elif kind == 'error':
+            result['error'] = value
+        else:
+            result['result'] = value
+        return result
+
+    def _child(self, function, write_fd):
+        """Runs function and writes its result to write_fd, never returns."""
+        status = 0
+        try:
+            if self.max_rss is not None and resource is not None:
+                data_size = self._data_size()
+                if data_size is not None:
+                    limit = data_size + self.max_rss
+                    resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+            try:
+                data = pickle.dumps(('result', function()))
+            except MemoryError:
+                data = pickle.dumps(('oom', None))
+            except BaseException:
+                data = pickle.dumps(('error', traceback.format_exc()))
+            view = memoryview(data)
+            while view:
+                view = view[os.write(write_fd, view):]
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except BaseException:
+            status = 1
+        finally:
+            os._exit(status)
+
+    @staticmethod
+    def _rss(pid):
+        """Resident memory of pid in bytes, 0 if /proc can't tell."""
+        try:
+            with open('/proc/{}/statm'.format(pid), 'rb') as f:
+                return int(f.read().split()[1]) * mmap.PAGESIZE
+        except (OSError, IndexError, ValueError):
+            return 0
+
+    @staticmethod
+    def _data_size():
+        """Size of the data segment of this process in bytes (as RLIMIT_DATA counts it), or None."""
+        try:
+            with open('/proc/self/status', 'rb') as f:
+                for line in f:
+                    if line.startswith(b'VmData:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            pass
+        return None
+
+
+class CopyEngine(object):
+    """
+    Copy files to the destination as fast as the kernel allows.
+
+    The data goes through copy_file_range, sendfile or read/write, the
+    first one that works between the two filesystems, and the holes of
+    sparse files are kept. Each copy is written to a hidden temporary file
+    next to the destination, preallocated, then renamed over it, so the
+    destination never holds a partial file. The directories already created
+    are remembered.
+
+    fsync is when the copies are flushed to disk: 'file' before copy()
+    returns, 'batch' every batch_size copies, 'end' by close(), or 'none'.
+    """
+
+    fsync_policies = ('none', 'file', 'batch', 'end')
+    # Errors of copy_file_range and sendfile meaning they can't copy between these files
+    fallback_errors = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+    # Errors of link meaning the filesystem can't hardlink these files
+    link_errors = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOSYS}
+    chunk_size = 0x800000
+
+    def __init__(self, fsync='end', batch_size=100):
+        if fsync not in self.fsync_policies:
+            raise ValueError('fsync must be one of {}'.format(', '.join(self.fsync_policies)))
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self._dirs = set()
+        # (method, source device, destination device) known not to work
+        self._unsupported = set()
+        # Copies not flushed yet with the 'batch' policy
+        self._unsynced = []
+
+    def makedirs(self, directory):
+        """Make a directory and its parents if they do not exist."""
+        if directory in self._dirs:
+            return
+        # Another worker may create it between the check and the call
+        os.makedirs(directory, exist_ok=True)
+        self._dirs.add(directory)
+
+    def forget(self, directory):
+        """Forget the directories under directory, it is being removed."""
+        prefix = os.path.join(directory, '')
+        self._dirs = {d for d in self._dirs if d != directory and not d.startswith(prefix)}
+
+    def copy(self, src, dst):
+        """
+        Copy src to dst with its permissions. Returns a dict with the src,
+        dst, size and method of the copy, and the error that stopped it, if
+        any, as error (message) and errno.
+        """
+        result = {'src': src, 'dst': dst, 'size': 0, 'method': None, 'error': None, 'errno': None}
+        tmppath = None
+        try:
+            dst_dir, filename = os.path.split(dst)
+            with open(src, 'rb') as fsrc:
+                src_stat = os.fstat(fsrc.fileno())
+                try:
+                    fd, tmppath = self._mkstemp(dst_dir, filename)
+                except FileNotFoundError:
+                    # Removed by another worker since we created it
+                    self.forget(dst_dir)
+                    fd, tmppath = self._mkstemp(dst_dir, filename)
+                try:
+                    result['method'] = self._copy_data(fsrc.fileno(), fd, src_stat)
+                    os.fchmod(fd, stat.S_IMODE(src_stat.st_mode))
+                    if self.fsync == 'file':
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+            os.replace(tmppath, dst)
+            tmppath = None
+            result['size'] = src_stat.st_size
+            self._synced(dst)
+        except OSError as e:
+            result['error'] = e.strerror or str(e)
+            result['errno'] = e.errno
+        finally:
+            if tmppath is not None:
+                try:
+                    os.remove(tmppath)
+                except OSError:
+                    pass
+        return result
+
+    def link(self, src, dst):
+        """
+        Hardlink dst to src, or copy it if the filesystem can't. Returns
+        the same dict as copy, with 'link' as method for a hardlink.
+        """
+        dst_dir, filename = os.path.split(dst)
+        devices = None
+        try:
+            self.makedirs(dst_dir)
+            src_stat = os.stat(src)
+            devices = (src_stat.st_dev, os.stat(dst_dir).st_dev)
+            if ('link',) + devices not in self._unsupported:
+                # Renamed over dst like a copy, link does not replace it
+                tmppath = os.path.join(dst_dir, '.{}.{}.tmp'.format(filename, os.urandom(4).hex()))
+                os.link(src, tmppath)
+                try:
+                    os.replace(tmppath, dst)
+                except OSError:
+                    os.remove(tmppath)
+                    raise
+                self._synced(dst)
+                return {'src': src, 'dst': dst, 'size': src_stat.st_size, 'method': 'link',
+                        'error': None, 'errno': None}
+        except OSError as e:
+            if e.errno not in self.link_errors or devices is None:
+                return {'src': src, 'dst': dst, 'size': 0, 'method': None,
+                        'error': e.strerror or str(e), 'errno': e.errno}
+            self._unsupported.add(('link',) + devices)
+        return self.copy(src, dst)
+
+    def _mkstemp(self, directory, filename):
+        self.makedirs(directory)
+        # Unique so that workers do not share it, hidden until renamed
+        tmppath = os.path.join(directory, '.{}.{}.tmp'.format(filename, os.urandom(4).hex()))
+        return os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), tmppath
+
+    def _copy_data(self, src_fd, dst_fd, src_stat):
+        """Copies the content of src_fd to the empty dst_fd, returns the method used."""
+        size = src_stat.st_size
+        if src_stat.st_blocks * 512 < size:
+            # Sparse: only copy the data segments, truncate to make the last hole
+            segments = list(self._data_segments(src_fd, size))
+        else:
+            segments = [(0, size)] if size else []
+            if size and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(dst_fd, 0, size)
+                except OSError as e:
+                    # Not supported by the filesystem, a full disk is an error
+                    if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+                        raise
+        method = None
+        devices = (src_stat.st_dev, os.fstat(dst_fd).st_dev)
+        for offset, end in segments:
+            method = self._copy_range(src_fd, dst_fd, offset, end, devices)
+        os.ftruncate(dst_fd, size)
+        return method or 'none'
+
+    def _data_segments(self, fd, size):
+        """Yields the (start, end) of the data segments of the file fd."""
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Only a hole until the end
+                    return
+                # SEEK_DATA not supported: everything is data
+                yield offset, size
+                return
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            yield start, end
+            offset = end
+
+    def _copy_range(self, src_fd, dst_fd, offset, end, devices):
+        """Copies src_fd[offset:end] at the same offset of dst_fd, returns the method used."""
+        for method in ('copy_file_range', 'sendfile'):
+            if (method,) + devices in self._unsupported or not hasattr(os, method):
+                continue
+            try:
+                while offset < end:
+                    count = min(end - offset, self.chunk_size)
+                    if method == 'copy_file_range':
+                        copied = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+                    else:
+                        os.lseek(dst_fd, offset, os.SEEK_SET)
+                        copied = os.sendfile(dst_fd, src_fd, offset, count)
+                    if copied == 0:
+                        # Not supported by the filesystem (procfs...) or source truncated
+                        break
+                    offset += copied
+                if offset >= end:
+                    return method
+            except OSError as e:
+                if e.errno not in self.fallback_errors:
+                    raise
+                self._unsupported.add((method,) + devices)
+        while offset < end:
+            buf = os.pread(src_fd, min(end - offset, self.chunk_size), offset)
+            if not buf:
+                raise OSError(errno.EIO, 'Source file truncated while copying')
+            offset += os.pwrite(dst_fd, buf, offset)
+        return 'read'
+
+    def _synced(self, path):
+        """Applies the fsync policy after path has been renamed."""
+        if self.fsync == 'file':
+            self._fsync_dir(os.path.dirname(path))
+        elif self.fsync == 'batch':
+            self._unsynced.append(path)
+            if len(self._unsynced) >= self.batch_size:
+                self.sync()
+
+    def _fsync_dir(self, directory):
+        fd = os.open(directory or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def take_unsynced(self):
+        """Returns the copies not flushed yet with the 'batch' policy and forgets them."""
+        paths, self._unsynced = self._unsynced, []
+        return paths
+
+    def add_unsynced(self, paths):
+        """Flushes paths, copied by another process, with the next batch."""
+        for path in paths:
+            self._synced(path)
+
+    def sync(self):
+        """Flushes the copies not flushed yet with the 'batch' policy."""
+        paths, self._unsynced = self._unsynced, []
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                # Replaced or removed since
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for directory in {os.path.dirname(path) for path in paths}:
+            self._fsync_dir(directory)
+
+    def close(self):
+        """End of the run: flushes everything written by this and the worker processes."""
+        self._unsynced = []
+        if self.fsync in ('batch', 'end'):
+            os.sync()
 
 
 class KittenGroomerBase(object):
     """Base object responsible for copy/sanitization process."""
 
-    def __init__(self, root_src, root_dst, debug=False):
-        """Initialized with path to source and dest directories."""
+    # Maximum number of instances of an external tool running at once, by tool
+    tool_limits = {}
+    # Default timeout of the external tools, in seconds
+    tool_timeout = 3600
+    # Number of threads hashing the files listed by tree(), mostly waiting
+    # for reads: more than the CPUs, like the default of ThreadPoolExecutor
+    hash_workers = min(32, (os.cpu_count() or 1) + 4)
+
+    def __init__(self, root_src, root_dst, debug=False, resume=False, fsync='end',
+                 digest_algorithms=('sha1',), tree_hash_size=None):
+        """
+        Initialized with path to source and dest directories.
+
+        Unless resuming an interrupted run, the logs of the previous run
+        are removed. content.log is always written again. fsync is the
+        policy of the copy engine (see CopyEngine), digest_algorithms and
+        tree_hash_size configure the hasher (see Hasher).
+        """
+        self.copy_engine = CopyEngine(fsync)
+        self.hasher = Hasher(digest_algorithms, tree_hash_size)
         self.src_root_dir = root_src
         self.dst_root_dir = root_dst
         self.log_root_dir = os.path.join(self.dst_root_dir, 'logs')
-        self._safe_rmtree(self.log_root_dir)
+        if not resume:
+            self._safe_rmtree(self.log_root_dir)
         self._safe_mkdir(self.log_root_dir)
         self.log_processing = os.path.join(self.log_root_dir, 'processing.log')
         self.log_content = os.path.join(self.log_root_dir, 'content.log')
+        self.log_journal = os.path.join(self.log_root_dir, 'journal.log')
+        self._safe_remove(self.log_content)
+        # Digests (by algorithm) and mimetypes found by tree(), by path
+        self.digests = {}
+        self.sniffed_mimetypes = {}
         self.tree(self.src_root_dir)
 
         quick_setup(file=self.log_processing)
@@ -184,17 +1143,44 @@ class KittenGroomerBase(object):
         else:
             self.log_debug_err = os.devnull
             self.log_debug_out = os.devnull
+        self.tool_runner = ToolRunner(self.tool_limits, timeout=self.tool_timeout)
+
+    def __getstate__(self):
+        """Drop the twiggy logger so the groomer can be sent to worker processes."""
+        state = self.__dict__.copy()
+        del state['log_name']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.log_name = log.name('files')
 
     def _computehash(self, path):
         """Returns a sha1 hash of a file at a given path."""
-        s = hashlib.sha1()
-        with open(path, 'rb') as f:
-            while True:
-                buf = f.read(0x100000)
-                if not buf:
-                    break
-                s.update(buf)
-        return s.hexdigest()
+        return self._hash_and_sniff(path)[0]
+
+    def _hash_and_sniff(self, path):
+        """Returns the sha1 hash and the mimetype of a file at a given path."""
+        digests, mimetype = self._digests_and_sniff(path)
+        return digests['sha1'], mimetype
+
+    def _digests_and_sniff(self, path):
+        """
+        Returns the digests (by algorithm) and the mimetype of a file at a
+        given path.
+
+        The mimetype is determined by libmagic from the first buffer read
+        for the digests, so the file is only read once.
+        """
+        digests, header = self.hasher.hash_file(path, mime_detector.header_size)
+        return digests, mime_detector.from_buffer(header)
+
+    def _hash_file(self, path):
+        """Returns the hash of a file for the tree, remembering its digests and mimetype."""
+        digests, mimetype = self._digests_and_sniff(path)
+        self.digests[path] = digests
+        self.sniffed_mimetypes[path] = mimetype
+        return digests['sha1']
 
     def tree(self, base_dir, padding='   '):
         """Writes a graphical tree to the log for a given directory."""
@@ -216,26 +1202,71 @@ class KittenGroomerBase(object):
                 elif os.path.isdir(curpath):
                     self.tree(curpath, padding)
                 elif os.path.isfile(curpath):
-                    lf.write('{}+-- {}\t- {}\n'.format(padding, f, self._computehash(curpath)))
+                    lf.write('{}+-- {}\t- {}\n'.format(padding, f, self._hash_file(curpath)))
 
     def __tree_py3(self, base_dir, padding='   '):
-        with open(self.log_content, 'ab') as lf:
-            lf.write(bytes('#' * 80 + '\n', 'UTF-8'))
-            lf.write(bytes('{}+- {}/\n'.format(padding, os.path.basename(os.path.abspath(base_dir)).encode()), 'utf8'))
-            padding += '|  '
-            files = sorted(os.listdir(base_dir))
-            for f in files:
-                curpath = os.path.join(base_dir, f)
-                if os.path.islink(curpath):
-                    lf.write('{}+-- {}\t- Symbolic link to {}\n'.format(padding, f, os.readlink(curpath)).encode(errors='ignore'))
-                elif os.path.isdir(curpath):
-                    self.tree(curpath, padding)
-                elif os.path.isfile(curpath):
-                    lf.write('{}+-- {}\t- {}\n'.format(padding, f, self._computehash(curpath)).encode(errors='ignore'))
+        # The files are hashed ahead by a pool of threads (hashlib releases
+        # the GIL), their lines are written in the order of the walk
+        window = self.hash_workers * 16
+        pending = collections.deque()
+        with open(self.log_content, 'ab', buffering=0) as raw, \
+                ThreadPoolExecutor(self.hash_workers) as executor:
+            # content.log keeps the layout of the recursive version, where
+            # each directory had its own buffered handle, written out when
+            # done with the directory (after its subdirectories)
+            buffer_size = os.fstat(raw.fileno()).st_blksize
+            if buffer_size <= 1:
+                buffer_size = io.DEFAULT_BUFFER_SIZE
+            writers = []
+            for level, line, path in self._tree_lines(base_dir, padding):
+                future = executor.submit(self._digests_and_sniff, path) if path is not None else None
+                pending.append((level, line, path, future))
+                while len(pending) > window:
+                    self._write_tree_line(raw, buffer_size, writers, *pending.popleft())
+            while pending:
+                self._write_tree_line(raw, buffer_size, writers, *pending.popleft())
+            while writers:
+                writers.pop().detach()
+
+    def _tree_lines(self, base_dir, padding, level=0):
+        """
+        Yields the lines of the tree of base_dir as (level, line, path) in a
+        single scandir walk: the hash of the file at path ends the line,
+        path is None for complete lines. The line is None when starting
+        a directory.
+        """
+        yield level, None, None
+        yield level, '#' * 80 + '\n', None
+        yield level, '{}+- {}/\n'.format(padding, os.path.basename(os.path.abspath(base_dir)).encode()), None
+        padding += '|  '
+        with os.scandir(base_dir) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.is_symlink():
+                yield level, '{}+-- {}\t- Symbolic link to {}\n'.format(padding, entry.name, os.readlink(entry.path)), None
+            elif entry.is_dir():
+                yield from self._tree_lines(entry.path, padding, level + 1)
+            elif entry.is_file():
+                yield level, '{}+-- {}\t- '.format(padding, entry.name), entry.path
+
+    def _write_tree_line(self, raw, buffer_size, writers, level, line, path, future):
+        # The handles of the directories done are written out
+        while len(writers) > level + (line is not None):
+            writers.pop().detach()
+        if line is None:
+            writers.append(io.BufferedWriter(raw, buffer_size))
+            return
+        if future is not None:
+            digests, mimetype = future.result()
+            self.digests[path] = digests
+            self.sniffed_mimetypes[path] = mimetype
+            line += digests['sha1'] + '\n'
+        writers[-1].write(line.encode(errors='ignore'))
 
     # ##### Helpers #####
     def _safe_rmtree(self, directory):
         """Remove a directory tree if it exists."""
+        self.copy_engine.forget(directory)
         if os.path.exists(directory):
             shutil.rmtree(directory)
 
@@ -246,24 +1277,27 @@ class KittenGroomerBase(object):
 
     def _safe_mkdir(self, directory):
         """Make a directory if it does not exist."""
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        self.copy_engine.makedirs(directory)
 
     def _safe_copy(self, src=None, dst=None):
-        """Copy a file and create directory if needed."""
+        """
+        Copy a file with the copy engine and create directory if needed.
+
+        Returns True if it was copied, otherwise the error is added to the
+        log details of the current file.
+        """
         if src is None:
             src = self.cur_file.src_path
         if dst is None:
             dst = self.cur_file.dst_path
-        try:
-            dst_path, filename = os.path.split(dst)
-            self._safe_mkdir(dst_path)
-            shutil.copy(src, dst)
-            return True
-        except Exception as e:
-            # TODO: Logfile
-            print(e)
+        result = self.copy_engine.copy(src, dst)
+        if result['error'] is not None:
+            if self.cur_file is not None:
+                self.cur_file.add_log_details('copy_error', result['error'])
             return False
+        if self.cur_file is not None and dst == self.cur_file.dst_path:
+            self.cur_file.copied_from = src
+        return True
 
     def _safe_metadata_split(self, ext):
         """Create a separate file to hold this file's metadata."""
@@ -276,18 +1310,79 @@ class KittenGroomerBase(object):
                                          ext + "': File exists.")
             dst_path, filename = os.path.split(dst)
             self._safe_mkdir(dst_path)
-            return open(dst + ext, 'w+')
+            metadata_file = open(dst + ext, 'w+')
+            self.cur_file.extra_outputs.append((self.cur_file.filename_prefix,
+                                                self.cur_file.filename_suffix + ext))
+            return metadata_file
         except Exception as e:
             # TODO: Logfile
             print(e)
             return False
 
+    def _run_process(self, command_string, timeout=None, cwd=None):
+        """
+        Run command_string with the tool runner, wait until it finishes.
+
+        Its exit status and duration are added to the log details of the
+        current file. Returns True if it succeeded.
+        """
+        args = shlex.split(command_string)
+        with open(self.log_debug_err, 'ab') as stderr, open(self.log_debug_out, 'ab') as stdout:
+            result = self.tool_runner.run(args, timeout, stdout, stderr, cwd)
+        if self.cur_file is not None:
+            self.cur_file.add_log_details(result['tool'], {
+                'returncode': result['returncode'],
+                'duration': round(result['duration'], 3),
+                'timed_out': result['timed_out'],
+            })
+        if result['returncode'] != 0:
+            return
+        return True
+
     def _list_all_files(self, directory):
         """Generate an iterator over all the files in a directory tree."""
-        for root, dirs, files in os.walk(directory):
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                yield filepath
+        for entry in self._walk_files(directory):
+            yield entry.path
+
+    def _walk_files(self, directory, dst_dir=None, by_size=False):
+        """
+        Generate a WalkEntry for every file in a directory tree.
+
+        Like os.walk, the files of a directory come before its
+        subdirectories and symlinks to directories are neither followed nor
+        listed. The names are sorted so that runs (and their logs) are
+        reproducible. dst_path is the path of the file under dst_dir, None
+        without dst_dir. With by_size, all the files are listed first and
+        generated from the largest to the smallest, in walk order for the
+        same size: it stats every file, once, cached by its os.DirEntry.
+        """
+        entries = self._scan_files(directory, '', dst_dir)
+        if by_size:
+            entries = sorted(entries, key=lambda entry: entry.entry.stat(follow_symlinks=False).st_size,
+                             reverse=True)
+        yield from entries
+
+    def _scan_files(self, directory, relative_dir, dst_dir):
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            # Ignored like os.walk does
+            return
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            relative_path = relative_dir + entry.name
+            if not is_dir:
+                dst_path = os.path.join(dst_dir, relative_path) if dst_dir is not None else None
+                yield WalkEntry(entry.path, relative_path, dst_path, entry)
+            elif not entry.is_symlink():
+                subdirs.append((entry.path, relative_path))
+        for path, relative_path in subdirs:
+            yield from self._scan_files(path, relative_path + os.sep, dst_dir)
 
     def _print_log(self):
         """
@@ -307,10 +1402,25 @@ class KittenGroomerBase(object):
         raise ImplementationRequired('Please implement processdir.')
 
 
-def main(kg_implementation, description='Call a KittenGroomer implementation to process files present in the source directory and copy them to the destination directory.'):
+def get_parser(description='Call a KittenGroomer implementation to process files present in the source directory and copy them to the destination directory.'):
+    """Returns the argument parser used by main, add implementation specific options to it."""
     parser = argparse.ArgumentParser(prog='KittenGroomer', description=description)
     parser.add_argument('-s', '--source', type=str, help='Source directory')
     parser.add_argument('-d', '--destination', type=str, help='Destination directory')
-    args = parser.parse_args()
-    kg = kg_implementation(args.source, args.destination)
+    return parser
+
+
+def main(kg_implementation, description='Call a KittenGroomer implementation to process files present in the source directory and copy them to the destination directory.', parser=None):
+    """
+    Parse the command line and run kg_implementation.
+
+    Any option added to parser besides source and destination is passed
+    to kg_implementation as a keyword argument.
+    """
+    if parser is None:
+        parser = get_parser(description)
+    args = vars(parser.parse_args())
+    source = args.pop('source')
+    destination = args.pop('destination')
+    kg = kg_implementation(source, destination, **args)
     kg.processdir()
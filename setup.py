@@ -23,5 +23,6 @@ setup(
         'Topic :: Communications :: File Sharing',
         'Topic :: Security',
     ],
+    python_requires='>=3.8',
     install_requires=['twiggy', 'python-magic'],
 )
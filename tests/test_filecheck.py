@@ -1,13 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
+import json
 import os
+import pickle
+import random
+import re
+import struct
+import tarfile
+import time
+import warnings
+import zipfile
+import zlib
 
 import pytest
 
 from tests.logging import save_logs
 try:
     from bin.filecheck import KittenGroomerFileCheck, File, main
+    from bin.filecheck import EXTENSION_MIMETYPES, MIMETYPE_EXTENSIONS
+    from bin.filecheck import ArchiveBudget, ArchiveBudgetExceeded, WorkScheduler
+    from bin.filecheck import ImageBudget, _image_header, _jpeg_exif, _png_metadata
+    from bin.filecheck import PDF_KEYWORDS, _scan_pdf, _ole_indicators
+    from bin.filecheck import _ooxml_plain_metadata, _ruleset_version, _zip_features
+    import olefile
+    from pdfid import PDFiD, cPDFiD
+    from kittengroomer.helpers import CostModel, Hasher, KittenGroomerError
     NODEPS = False
 except ImportError:
     NODEPS = True
@@ -43,6 +62,778 @@ class TestIntegration:
         test_description = "filecheck_valid"
         save_logs(groomer, test_description)
 
+    def test_filecheck_workers(self, src_invalid, tmpdir):
+        # A parallel run logs the same as a sequential one. Without dedup,
+        # the duplicates found depend on the worker processing each file.
+        logs = []
+        for workers in (1, 2):
+            dst = tmpdir.join('dst{}'.format(workers))
+            groomer = KittenGroomerFileCheck(src_invalid, str(dst), debug=True, workers=workers,
+                                             dedup=False)
+            groomer.processdir()
+            logs.append([normalized_log(path, str(dst))
+                         for path in (groomer.log_processing, groomer.log_content)])
+        test_description = "filecheck_invalid_workers"
+        save_logs(groomer, test_description)
+        assert logs[0] == logs[1]
+
+
+def normalized_log(path, dst):
+    """Lines of a log without what changes from one run to the next."""
+    with open(path) as f:
+        log = f.read()
+    log = log.replace(dst, '<dst>')
+    # Scratch directories of the run and of the archives, named after their destination
+    log = re.sub(r'kittengroomer_[0-9a-f]{40}/[0-9a-f]{40}', 'kittengroomer_<archive>', log)
+    log = re.sub(r"'duration': [0-9.]+", "'duration': 0", log)
+    return [re.sub(r'^\d{4}-\d\d-\d\dT[\d:]+Z:', '', line) for line in log.splitlines()]
+
 
 class TestFileHandling:
     pass
+
+
+@skipif_nodeps
+class TestArchives:
+
+    def test_zip_unsafe_path(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        with zipfile.ZipFile(str(src.join('evil.zip')), 'w') as archive:
+            archive.writestr('../../escape.txt', 'escaped\n')
+            archive.writestr('dir/a.txt', 'a\n')
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst))
+        groomer.processdir()
+        assert dst.join('evil.zip', 'escape.txt').check(file=1)
+        assert dst.join('evil.zip', 'dir', 'a.txt').check(file=1)
+        assert not tmpdir.join('escape.txt').check()
+
+    def test_tar_stream(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        with tarfile.open(str(src.join('t.tar.gz')), 'w:gz') as archive:
+            data = b'text\n'
+            info = tarfile.TarInfo('doc/a.txt')
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+            link = tarfile.TarInfo('doc/link')
+            link.type = tarfile.SYMTYPE
+            link.linkname = '/etc/passwd'
+            archive.addfile(link)
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst))
+        groomer.processdir()
+        assert dst.join('t.tar.gz', 'doc', 'a.txt').read_binary() == b'text\n'
+        assert not dst.join('t.tar.gz', 'doc', 'link').check()
+        assert 't.tar.gz/' in dst.join('logs', 'content.log').read()
+
+    def test_scratch_dir(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        with zipfile.ZipFile(str(src.join('a.zip')), 'w') as archive:
+            archive.writestr('a.txt', 'a\n')
+        scratch = tmpdir.mkdir('scratch')
+        groomer = KittenGroomerFileCheck(str(src), str(tmpdir.join('dst')), scratch_dir=str(scratch))
+        groomer._make_scratch_dir()
+        assert os.stat(groomer.scratch_dir).st_mode & 0o777 == 0o700
+        groomer.processdir()
+        assert tmpdir.join('dst', 'a.zip', 'a.txt').check()
+        assert scratch.listdir() == []
+        # Not followed when someone else prepared it
+        target = tmpdir.mkdir('target')
+        os.symlink(str(target), groomer.scratch_dir)
+        with pytest.raises(KittenGroomerError):
+            KittenGroomerFileCheck(str(src), str(tmpdir.join('dst')), scratch_dir=str(scratch)).processdir()
+        assert target.listdir() == []
+
+    def test_budget_entries(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        with zipfile.ZipFile(str(src.join('many.zip')), 'w') as archive:
+            for i in range(20):
+                archive.writestr('{}.txt'.format(i), 'text\n')
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst), max_archive_entries=10)
+        groomer.processdir()
+        assert not dst.join('many.zip').check()
+        assert 'more than 10 entries' in dst.join('logs', 'processing.log').read()
+
+    def test_budget_exact(self, tmpdir):
+        # The sizes announced by the headers are not charged on top of the extracted ones
+        src = tmpdir.mkdir('src')
+        with zipfile.ZipFile(str(src.join('one.zip')), 'w') as archive:
+            archive.writestr('a.txt', 'a' * 599 + '\n')
+        for max_size, extracted in ((600, True), (599, False)):
+            dst = tmpdir.join('dst{}'.format(max_size))
+            groomer = KittenGroomerFileCheck(str(src), str(dst), max_archive_size=max_size,
+                                             max_archive_entries=1)
+            groomer.processdir()
+            assert dst.join('one.zip', 'a.txt').check() == extracted
+
+    def test_budget_nested(self, tmpdir):
+        # One inner archive (521 bytes holding 401) fits, two don't fit in the outer one
+        inner = io.BytesIO()
+        with zipfile.ZipFile(inner, 'w') as archive:
+            archive.writestr('a.txt', 'a' * 400 + '\n')
+        for count, extracted in ((1, True), (2, False)):
+            src = tmpdir.mkdir('src{}'.format(count))
+            with zipfile.ZipFile(str(src.join('outer.zip')), 'w') as archive:
+                for i in range(count):
+                    archive.writestr('inner{}.zip'.format(i), inner.getvalue())
+            dst = tmpdir.join('dst{}'.format(count))
+            groomer = KittenGroomerFileCheck(str(src), str(dst), max_recursive_depth=3,
+                                             max_archive_size=1500)
+            groomer.processdir()
+            assert dst.join('outer.zip').check() == extracted
+        assert 'outer.zip: more than 1500 bytes' in dst.join('logs', 'processing.log').read()
+
+
+@skipif_nodeps
+class TestImages:
+
+    def test_multi_frame(self, tmpdir):
+        from PIL import Image
+        src = tmpdir.mkdir('src')
+        frames = [Image.new('RGB', (40, 40), color) for color in ('red', 'green', 'blue')]
+        frames[0].save(str(src.join('anim.gif')), save_all=True, append_images=frames[1:],
+                       comment=b'metadata')
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst))
+        groomer.processdir()
+        image = Image.open(str(dst.join('anim.gif')))
+        assert image.n_frames == 3
+        assert 'comment' not in image.info
+        # Written to a temporary file renamed to the destination
+        assert sorted(os.listdir(str(dst))) == ['anim.gif', 'logs']
+
+    @pytest.mark.parametrize('name', ['anim.gif', 'anim.webp', 'anim.png'])
+    def test_frame_pixels(self, tmpdir, name):
+        from PIL import Image, ImageSequence
+        src = tmpdir.mkdir('src')
+        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+        frames = [Image.new('RGB', (40, 40), color) for color in colors]
+        frames[0].save(str(src.join(name)), save_all=True, append_images=frames[1:],
+                       duration=100, lossless=True)
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst))
+        groomer.processdir()
+        image = Image.open(str(dst.join(name)))
+        assert image.n_frames == 3
+        pixels = [frame.convert('RGB').getpixel((20, 20)) for frame in ImageSequence.Iterator(image)]
+        # Written again as lossy WebP
+        assert all(abs(a - b) <= 8 for pixel, color in zip(pixels, colors)
+                   for a, b in zip(pixel, color))
+
+    def test_memory_ceiling(self, tmpdir):
+        from PIL import Image
+        src = tmpdir.mkdir('src')
+        Image.new('L', (1000, 1000)).save(str(src.join('big.png')))
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst), max_image_memory=1000 * 1000)
+        groomer.processdir()
+        assert dst.join('DANGEROUS_big.png_DANGEROUS').check(file=1)
+
+
+@skipif_nodeps
+class TestImageBudget:
+
+    def test_header(self):
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.new('RGBA', (30, 20)).save(buf, 'PNG')
+        buf.seek(0)
+        assert _image_header(Image.open(buf)) == {'pixels': 600, 'frames': 1}
+
+    def test_limits(self):
+        budget = ImageBudget(max_pixels=100, max_run_pixels=150)
+        budget.charge({'pixels': 100, 'frames': 1})
+        with pytest.raises(KittenGroomerError):
+            budget.charge({'pixels': 101, 'frames': 1})
+        with pytest.raises(KittenGroomerError):
+            budget.charge({'pixels': 30, 'frames': 2})
+        budget = pickle.loads(pickle.dumps(budget))
+        budget.charge({'pixels': 50, 'frames': 1})
+        assert budget.pixels == 150
+
+    def test_warning_filters_untouched(self, tmpdir):
+        from PIL import Image
+        src = tmpdir.mkdir('src')
+        Image.new('L', (100, 100)).save(str(src.join('small.png')))
+        Image.new('L', (100, 200)).save(str(src.join('tall.png')))
+        filters = list(warnings.filters)
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst), max_image_pixels=10000)
+        groomer.processdir()
+        assert warnings.filters == filters
+        assert dst.join('small.png').check(file=1)
+        assert dst.join('DANGEROUS_tall.png_DANGEROUS').check(file=1)
+
+    def test_default_limit(self, tmpdir):
+        from PIL import Image
+        groomer = KittenGroomerFileCheck(str(tmpdir.mkdir('src')), str(tmpdir.join('dst')))
+        budget = groomer.image_budget
+        budget.charge({'pixels': Image.MAX_IMAGE_PIXELS, 'frames': 1})
+        with pytest.raises(KittenGroomerError):
+            budget.charge({'pixels': Image.MAX_IMAGE_PIXELS + 1, 'frames': 1})
+
+    def test_pil_limit_kept(self, tmpdir, monkeypatch):
+        from PIL import Image
+        assert Image.MAX_IMAGE_PIXELS is not None
+        src = tmpdir.mkdir('src')
+        Image.new('L', (100, 100)).save(str(src.join('small.png')))
+        Image.new('L', (100, 200)).save(str(src.join('tall.png')))
+        # Refused by PIL even though the budget of the groomer is larger
+        monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 5000)
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst), max_image_pixels=10 ** 6)
+        groomer.processdir()
+        assert dst.join('small.png').check(file=1)
+        assert dst.join('DANGEROUS_tall.png_DANGEROUS').check(file=1)
+
+
+def png_chunk(chunk_type, data):
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+
+@skipif_nodeps
+class TestMetadata:
+
+    def test_jpeg_exif(self):
+        from PIL import Image
+        exif = Image.Exif()
+        exif[0x010F] = 'CameraCorp'
+        buf = io.BytesIO()
+        Image.new('RGB', (8, 8)).save(buf, 'JPEG', exif=exif)
+        assert _jpeg_exif(buf.getvalue()) == exif.tobytes()[6:]
+
+    def test_jpeg_exif_stops_at_image_data(self):
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.new('RGB', (8, 8)).save(buf, 'JPEG')
+        data = buf.getvalue()
+        start_of_scan = data.index(b'\xff\xda')
+        # An Exif segment after the start of the image data is pixel data
+        segment = b'\xff\xe1\x00\x10Exif\x00\x00II*\x00\x08\x00\x00\x00'
+        assert _jpeg_exif(data[:start_of_scan + 2] + segment + data[start_of_scan + 2:]) is None
+
+    def test_png_metadata(self):
+        png = (b'\x89PNG\r\n\x1a\n' +
+               png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)) +
+               png_chunk(b'tEXt', b'Author\x00someone') +
+               png_chunk(b'zTXt', b'Comment\x00\x00' + zlib.compress(b'zipped')) +
+               png_chunk(b'iTXt', b'Title\x00\x01\x00fr\x00Titre\x00' + zlib.compress('été'.encode())) +
+               png_chunk(b'IDAT', zlib.compress(b'\x00\x00')) +
+               png_chunk(b'tEXt', b'After\x00pixels') +
+               png_chunk(b'IEND', b''))
+        assert _png_metadata(png) == {'Author': 'someone', 'Comment': 'zipped', 'Title': 'été'}
+
+    @pytest.mark.parametrize('depth,color_type,transparency', [
+        (8, 2, struct.pack('>HHH', 1, 2, 3)),
+        (16, 0, struct.pack('>H', 300)),
+        (1, 0, struct.pack('>H', 1)),
+        (8, 3, b'\xff\xff\x00\xff'),
+        (8, 3, b'\xff\x80\x00'),
+    ])
+    def test_png_metadata_like_pil(self, depth, color_type, transparency):
+        from PIL import Image
+        png = (b'\x89PNG\r\n\x1a\n' +
+               png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, depth, color_type, 0, 0, 1)) +
+               png_chunk(b'gAMA', struct.pack('>I', 45455)) +
+               png_chunk(b'cHRM', struct.pack('>8I', 31270, 32900, 64000, 33000,
+                                              30000, 60000, 15000, 6000)) +
+               png_chunk(b'sRGB', b'\x00') +
+               png_chunk(b'iCCP', b'profile\x00\x00' + zlib.compress(b'icc')) +
+               png_chunk(b'pHYs', struct.pack('>IIB', 3780, 3780, 1)) +
+               png_chunk(b'PLTE', b'\x00' * 12) +
+               png_chunk(b'tRNS', transparency) +
+               png_chunk(b'eXIf', b'MM\x00*\x00\x00\x00\x08\x00\x00') +
+               png_chunk(b'tEXt', b'Author\x00someone') +
+               png_chunk(b'tEXt', b'Author\x00someone else') +
+               png_chunk(b'iTXt', b'XML:com.adobe.xmp\x00\x00\x00\x00\x00<x:xmpmeta/>') +
+               png_chunk(b'IDAT', zlib.compress(b'\x00' * 8)) +
+               png_chunk(b'IEND', b''))
+        info = Image.open(io.BytesIO(png)).info
+        assert info['Author'] == 'someone else'
+        assert _png_metadata(png) == info
+
+    def test_png_metadata_bomb(self):
+        png = (b'\x89PNG\r\n\x1a\n' +
+               png_chunk(b'zTXt', b'Bomb\x00\x00' + zlib.compress(b'\x00' * 0x200000)))
+        with pytest.raises(KittenGroomerError):
+            list(_png_metadata(png))
+
+
+def ole_file(entries):
+    """
+    Builds a minimal OLE file. entries maps paths ('a/b') to the content of
+    a stream, or to None for a storage. Streams are padded to 4096 bytes,
+    out of the mini stream.
+    """
+    sector = 512
+    nodes = [('Root Entry', 5, None, [])]
+    index = {'': 0}
+    for path, content in entries.items():
+        parent, _, name = path.rpartition('/')
+        index[path] = len(nodes)
+        nodes[index[parent]][3].append(len(nodes))
+        if content is not None:
+            content = content.ljust(4096, b'\x00')
+        nodes.append((name, 1 if content is None else 2, content, []))
+    dir_sectors = (len(nodes) + 3) // 4
+    fat = [0xFFFFFFFD] + list(range(2, dir_sectors + 1)) + [0xFFFFFFFE]
+    data = b''
+    starts = {}
+    for i, (name, kind, content, kids) in enumerate(nodes):
+        if content is not None:
+            starts[i] = len(fat)
+            count = len(content) // sector
+            fat += list(range(len(fat) + 1, len(fat) + count)) + [0xFFFFFFFE]
+            data += content
+    assert len(fat) <= sector // 4
+    directory = b''
+    for i, (name, kind, content, kids) in enumerate(nodes):
+        encoded = (name + '\x00').encode('utf-16-le')
+        siblings = [k for n in nodes for k in n[3] if i in n[3]]
+        right = siblings[siblings.index(i) + 1] if i in siblings[:-1] else 0xFFFFFFFF
+        directory += struct.pack('<64sHBBIII16sIQQIQ', encoded, len(encoded), kind, 1,
+                                 0xFFFFFFFF, right, kids[0] if kids else 0xFFFFFFFF,
+                                 b'', 0, 0, 0, starts.get(i, 0xFFFFFFFE),
+                                 len(content) if content else 0)
+    directory = directory.ljust(dir_sectors * sector, b'\x00')
+    header = struct.pack('<8s16sHHHHH6sIIIIIIIII', b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', b'',
+                         0x3E, 3, 0xFFFE, 9, 6, b'', 0, 1, 1, 0, 4096,
+                         0xFFFFFFFE, 0, 0xFFFFFFFE, 0)
+    header += struct.pack('<I', 0) + b'\xff' * 4 * 108
+    fat_sector = struct.pack('<{}I'.format(len(fat)), *fat).ljust(sector, b'\xff')
+    return header + fat_sector + directory + data
+
+
+@skipif_nodeps
+class TestOLE:
+
+    def indicators(self, entries):
+        with olefile.OleFileIO(ole_file(entries), raise_defects=olefile.DEFECT_INCORRECT) as ole:
+            return _ole_indicators(ole)
+
+    def test_clean(self):
+        assert self.indicators({'WordDocument': b'text', 'Data': b'data'}) == {
+            'encrypted': False, 'macro': False, 'objpool': False, 'flash': False}
+
+    def test_indicators(self):
+        flash = b'FWS\x0a' + struct.pack('<i', 2000) + b'\x00' * 1992
+        indicators = self.indicators({'Macros': None, 'Macros/VBA': None,
+                                      'Macros/VBA/dir': b'vba', 'ObjectPool': None,
+                                      'ObjectPool/_1': flash})
+        assert indicators == {'encrypted': False, 'macro': True, 'objpool': True, 'flash': True}
+
+    def test_encrypted(self):
+        assert self.indicators({'EncryptionInfo': b'info', 'EncryptedPackage': b'data'})['encrypted']
+        fib = b'\xec\xa5' + b'\x00' * 8 + struct.pack('<H', 0x0100)
+        assert self.indicators({'WordDocument': fib})['encrypted']
+        # Excel BOF record followed by a FILEPASS record (XOR obfuscation)
+        bof = struct.pack('<HHHHHHII', 0x0809, 16, 0x0600, 0x0005, 0, 0, 0, 0)
+        filepass = struct.pack('<HHHHH', 0x002F, 6, 0, 0, 0)
+        assert self.indicators({'Workbook': bof + filepass})['encrypted']
+        assert not self.indicators({'Workbook': bof})['encrypted']
+        assert self.indicators({'PowerPoint Document': b'ppt', 'Current User': b'user',
+                                'EncryptedSummary': b'summary'})['encrypted']
+
+    def test_winoffice(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('macro.doc').write_binary(ole_file({'WordDocument': b'text', '_VBA_PROJECT_CUR': None}))
+        src.join('broken.doc').write_binary(b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1' + b'\x00' * 600)
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst))
+        groomer.processdir()
+        assert dst.join('DANGEROUS_macro.doc_DANGEROUS').check(file=1)
+        assert dst.join('DANGEROUS_broken.doc_DANGEROUS').check(file=1)
+
+
+def ooxml_file(parts=(), rels=(), content_types=''):
+    """Builds a minimal .docx, with more parts and relationships of word/document.xml."""
+    relationship = '<Relationship Id="rId{}" Type="http://schemas.openxmlformats.org/' \
+                   'officeDocument/2006/relationships/{}" Target="{}"/>'
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as archive:
+        archive.writestr('[Content_Types].xml', (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" '
+            'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>' + content_types +
+            '</Types>'))
+        archive.writestr('_rels/.rels', '<Relationships>' +
+                         relationship.format(1, 'officeDocument', 'word/document.xml') +
+                         '</Relationships>')
+        archive.writestr('word/document.xml', '<document/>')
+        archive.writestr('word/_rels/document.xml.rels', '<Relationships>' + ''.join(
+            relationship.format(i + 2, *rel) for i, rel in enumerate(rels)) + '</Relationships>')
+        for name, data in parts:
+            archive.writestr(name, data)
+    return buf.getvalue()
+
+
+@skipif_nodeps
+class TestZipContainers:
+
+    def plain(self, data):
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            return _ooxml_plain_metadata(archive)
+
+    def test_plain(self):
+        assert self.plain(ooxml_file([('word/styles.xml', b'<styles/>')], [('styles', 'styles.xml')]))
+
+    def test_not_plain(self):
+        # A macro project under another name
+        assert not self.plain(ooxml_file([('word/a.xml', b'')], [('vbaProject', 'a.xml')]))
+        # Escaped relationship type
+        assert not self.plain(ooxml_file([('word/a.xml', b'')], [('&#x6F;leObject', 'a.xml')]))
+        # Missing target and part without content type, rejected by officedissector
+        assert not self.plain(ooxml_file(rels=[('styles', 'missing.xml')]))
+        assert not self.plain(ooxml_file([('word/media/a.png', b'')], [('image', 'media/a.png')]))
+
+    def test_features(self):
+        data = ooxml_file([('word/embeddings/oleObject1.bin', b''), ('word/activeX/a.xml', b'')])
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            assert _zip_features(archive) == {'vba': False, 'activex': True, 'embeddings': True,
+                                              'odf_macro': True}
+
+    def test_ooxml_fast_path(self, tmpdir, monkeypatch):
+        import officedissector
+
+        def document(path):
+            raise AssertionError('parsed ' + path)
+        monkeypatch.setattr(officedissector.doc, 'Document', document)
+        src = tmpdir.mkdir('src')
+        src.join('plain.docx').write_binary(ooxml_file())
+        src.join('macro.docm').write_binary(ooxml_file())
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst))
+        groomer.processdir()
+        assert dst.join('plain.docx').check(file=1)
+        # Macro enabled documents still go through officedissector
+        assert dst.join('DANGEROUS_macro.docm_DANGEROUS').check(file=1)
+
+    def test_libreoffice(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        with zipfile.ZipFile(str(src.join('macro.odt')), 'w') as archive:
+            archive.writestr('mimetype', 'application/vnd.oasis.opendocument.text')
+            archive.writestr('Basic/Standard/Module1.xml', '<module/>')
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst))
+        groomer.processdir()
+        assert dst.join('DANGEROUS_macro.odt_DANGEROUS').check(file=1)
+
+
+@skipif_nodeps
+class TestDedup:
+
+    @pytest.fixture
+    def src(self, tmpdir):
+        from PIL import Image, PngImagePlugin
+        src = tmpdir.mkdir('src')
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Author', 'someone')
+        Image.new('RGB', (8, 8)).save(str(src.join('photo.png')), pnginfo=info)
+        with zipfile.ZipFile(str(src.join('macro.odt')), 'w') as archive:
+            archive.writestr('mimetype', 'application/vnd.oasis.opendocument.text')
+            archive.writestr('Basic/Standard/Module1.xml', '<module/>')
+        src.mkdir('copies')
+        src.join('photo.png').copy(src.join('copies', 'other.png'))
+        src.join('macro.odt').copy(src.join('copies', 'other.odt'))
+        return src
+
+    def count_calls(self, monkeypatch):
+        import bin.filecheck
+        calls = []
+        reencode_image = KittenGroomerFileCheck._reencode_image
+        zip_features = bin.filecheck._zip_features
+        monkeypatch.setattr(KittenGroomerFileCheck, '_reencode_image',
+                            lambda self, *args: calls.append(args) or reencode_image(self, *args))
+        monkeypatch.setattr(bin.filecheck, '_zip_features',
+                            lambda *args: calls.append(args) or zip_features(*args))
+        return calls
+
+    def test_duplicates(self, tmpdir, src, monkeypatch):
+        dst = tmpdir.join('dst')
+        calls = self.count_calls(monkeypatch)
+        # The calls are counted in this process
+        groomer = KittenGroomerFileCheck(str(src), str(dst), watchdog=False)
+        groomer.processdir()
+        assert len(calls) == 2
+        for first, copy in (('photo.png', 'copies/other.png'),
+                            ('photo.png.metadata.txt', 'copies/other.png.metadata.txt'),
+                            ('DANGEROUS_macro.odt_DANGEROUS', 'copies/DANGEROUS_other.odt_DANGEROUS')):
+            assert dst.join(copy).read_binary() == dst.join(first).read_binary()
+            assert dst.join(copy).stat().ino == dst.join(first).stat().ino
+        with open(groomer.log_processing) as f:
+            assert f.read().count('duplicate_of=') == 2
+
+    def test_no_dedup(self, tmpdir, src, monkeypatch):
+        dst = tmpdir.join('dst')
+        calls = self.count_calls(monkeypatch)
+        groomer = KittenGroomerFileCheck(str(src), str(dst), dedup=False, watchdog=False)
+        groomer.processdir()
+        assert len(calls) == 4
+        assert dst.join('copies', 'other.png').stat().ino != dst.join('photo.png').stat().ino
+
+
+    def test_sha1_collision(self, tmpdir, monkeypatch):
+        from PIL import Image
+        src = tmpdir.mkdir('src')
+        Image.new('RGB', (8, 8)).save(str(src.join('a.png')))
+        Image.new('RGB', (8, 8), 'red').save(str(src.join('b.png')))
+        hash_file = Hasher.hash_file
+
+        def colliding(self, *args):
+            digests, header = hash_file(self, *args)
+            digests['sha1'] = '0' * 40
+            return digests, header
+        monkeypatch.setattr(Hasher, 'hash_file', colliding)
+        groomer = KittenGroomerFileCheck(str(src), str(tmpdir.join('dst')),
+                                         cache=str(tmpdir.join('cache.db')))
+        groomer.processdir()
+        with open(groomer.log_processing) as f:
+            log = f.read()
+        assert 'duplicate_of=' not in log
+        assert 'cached=' not in log
+        assert tmpdir.join('dst', 'b.png').read_binary() != tmpdir.join('dst', 'a.png').read_binary()
+
+
+@skipif_nodeps
+class TestVerdictCacheRuns:
+
+    def run(self, tmpdir, src, **kwargs):
+        dst = tmpdir.join('dst')
+        if dst.check():
+            dst.remove()
+        groomer = KittenGroomerFileCheck(str(src), str(dst), cache=str(tmpdir.join('cache.db')),
+                                         **kwargs)
+        groomer.processdir()
+        groomer.verdict_cache.close()
+        with open(groomer.log_processing) as f:
+            return f.read()
+
+    def test_clear_cache(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('notes.txt').write('notes')
+        assert 'cached=' not in self.run(tmpdir, src)
+        assert 'cached=True' in self.run(tmpdir, src)
+        assert 'cached=' not in self.run(tmpdir, src, clear_cache=True)
+
+    def test_ruleset_version(self, monkeypatch):
+        import PIL
+        version = _ruleset_version()
+        assert _ruleset_version() == version
+        # An analyzer upgrade invalidates the cached verdicts
+        monkeypatch.setattr(PIL, '__version__', '0.0', raising=False)
+        assert _ruleset_version() != version
+
+
+@skipif_nodeps
+class TestHandlerWatchdog:
+
+    @pytest.fixture
+    def src(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('doc.pdf').write_binary(b'%PDF-1.4\n%%EOF\n')
+        src.join('notes.txt').write('notes')
+        return src
+
+    def processed(self, groomer):
+        groomer.processdir()
+        with open(groomer.log_processing) as f:
+            return f.read()
+
+    def test_timeout(self, tmpdir, src, monkeypatch):
+        dst = tmpdir.join('dst')
+        monkeypatch.setattr(KittenGroomerFileCheck, '_pdf', lambda self: time.sleep(10))
+        start = time.monotonic()
+        log = self.processed(KittenGroomerFileCheck(str(src), str(dst), handler_timeout=0.5))
+        assert time.monotonic() - start < 5
+        assert 'timeout=0.5' in log
+        assert dst.join('DANGEROUS_doc.pdf_DANGEROUS').read_binary() == src.join('doc.pdf').read_binary()
+        assert not dst.join('doc.pdf').check()
+        assert dst.join('notes.txt').check()
+
+    def test_default_timeout(self, tmpdir, src, monkeypatch):
+        # Types without a budget of their own get the default one
+        dst = tmpdir.join('dst')
+        monkeypatch.setattr(KittenGroomerFileCheck, 'default_handler_timeout', 0.5)
+        monkeypatch.setattr(KittenGroomerFileCheck, 'text', lambda self: time.sleep(10))
+        log = self.processed(KittenGroomerFileCheck(str(src), str(dst)))
+        assert 'timeout=0.5' in log
+        assert dst.join('DANGEROUS_notes.txt_DANGEROUS').check()
+
+    def test_fsync_batch(self, tmpdir, src):
+        # The copies made in the child are flushed by the parent
+        groomer = KittenGroomerFileCheck(str(src), str(tmpdir.join('dst')), fsync='batch')
+        dst_path = tmpdir.join('dst', 'notes.txt').strpath
+        groomer.process_file(src.join('notes.txt').strpath, dst_path, 'notes.txt')
+        assert groomer.copy_engine.take_unsynced() == [dst_path]
+
+    def test_memory(self, tmpdir, src, monkeypatch):
+        dst = tmpdir.join('dst')
+        monkeypatch.setattr(KittenGroomerFileCheck, '_pdf', lambda self: bytearray(0x20000000))
+        log = self.processed(KittenGroomerFileCheck(str(src), str(dst), handler_memory=0x4000000))
+        assert 'oom=' in log
+        assert dst.join('DANGEROUS_doc.pdf_DANGEROUS').check()
+
+    def test_state(self, tmpdir, src):
+        from PIL import Image, PngImagePlugin
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Author', 'someone')
+        Image.new('RGB', (8, 8)).save(str(src.join('photo.png')), pnginfo=info)
+        dst = tmpdir.join('dst')
+        groomer = KittenGroomerFileCheck(str(src), str(dst))
+        log = self.processed(groomer)
+        # Handed back by the child process
+        assert 'processing_type=pdf' in log
+        assert groomer.image_budget.pixels == 64
+        assert dst.join('photo.png').check()
+        assert dst.join('photo.png.metadata.txt').check()
+        assert not [name for name in os.listdir(str(dst)) if name.startswith('.')]
+
+
+@skipif_nodeps
+class TestWorkScheduler:
+
+    def test_order(self, tmpdir):
+        scheduler = WorkScheduler(CostModel())
+        for name, size in (('a', 10), ('archive', 1000), ('c', 100)):
+            scheduler.add(name, 'text/plain', size)
+        assert [scheduler.pop() for i in range(3)] == [(1, 'archive'), (2, 'c'), (0, 'a')]
+        assert not scheduler.has_tasks()
+        assert scheduler.done(2, 'c\n', [], None) == []
+        assert scheduler.take_lines() == ''
+        member = tmpdir.join('member')
+        member.write('x' * 5000)
+        task = (member.strpath, 'dst', 'member', 1, 'text/plain', {}, 0)
+        assert scheduler.done(1, '', [(None, 'archive\n'), (task, None), (None, 'nested\n')],
+                              'journal entry', b'archive tree\n') == []
+        assert scheduler.queued_size == 5000
+        assert scheduler.pop() == (4, task)
+        assert scheduler.done(0, 'a\n', [], None) == []
+        assert scheduler.take_lines() == 'a\narchive\n'
+        assert scheduler.take_content() == b'archive tree\n'
+        assert scheduler.take_content() == b''
+        assert scheduler.pending_archives() == ['journal entry']
+        assert scheduler.done(4, 'member\n', [], None) == ['journal entry']
+        assert scheduler.queued_size == 0
+        assert scheduler.take_lines() == 'member\nnested\nc\n'
+        assert scheduler.pending_archives() == []
+
+    def test_archive_members(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        with zipfile.ZipFile(str(src.join('big.zip')), 'w') as archive:
+            for i in range(4):
+                archive.writestr('doc{}.txt'.format(i), 'text {}'.format(i))
+            inner = io.BytesIO()
+            with zipfile.ZipFile(inner, 'w') as inner_archive:
+                inner_archive.writestr('inner.txt', 'inner')
+            archive.writestr('inner.zip', inner.getvalue())
+            archive.writestr('last.txt', 'last')
+        src.join('small.txt').write('small')
+        scratch = tmpdir.mkdir('scratch')
+        logs = []
+        # Without room in the queue, the members are processed by the worker of the archive
+        for workers, max_queued_size in ((1, 0x10000000), (2, 0x10000000), (2, 12)):
+            dst = tmpdir.join('dst')
+            if dst.check():
+                dst.remove()
+            groomer = KittenGroomerFileCheck(str(src), str(dst), workers=workers, max_recursive_depth=3,
+                                             cost_model=tmpdir.join('costs.json').strpath,
+                                             scratch_dir=str(scratch), max_queued_size=max_queued_size)
+            groomer.processdir()
+            with open(groomer.log_processing) as f:
+                logs.append([line.split(':', 3)[3] for line in f])
+            with open(groomer.log_journal) as f:
+                journal = [os.path.basename(json.loads(line)['src']) for line in f]
+            # The archive is done once its members are
+            assert journal.index('big.zip') > journal.index('doc3.txt')
+            assert dst.join('big.zip', 'doc0.txt').read() == 'text 0'
+            assert dst.join('big.zip', 'inner.zip', 'inner.txt').read() == 'inner'
+        assert logs[0] == logs[1] == logs[2]
+        # The scratch directories are removed
+        assert scratch.listdir() == []
+        assert 'text/plain' in json.load(open(tmpdir.join('costs.json').strpath))['sums']
+
+
+@skipif_nodeps
+class TestPDFScan:
+
+    def counts(self, pdfid):
+        return {name: (getattr(pdfid, name).count, getattr(pdfid, name).hexcode)
+                for name in PDF_KEYWORDS}
+
+    def check(self, tmp_path, data):
+        path = tmp_path / 'test.pdf'
+        path.write_bytes(data)
+        scanned = _scan_pdf(data)
+        assert self.counts(scanned) == self.counts(cPDFiD(PDFiD(str(path)), True))
+        return self.counts(scanned)
+
+    def test_names(self, tmp_path):
+        counts = self.check(tmp_path, b'%PDF-1.4 /JS\n/JS /JavaScript/AA//OpenAction /JSON /Launch '
+                                      b'/RichMedia\x00/Encrypt/JS\xdf')
+        assert counts['js'] == (1, 0)
+        assert counts['openaction'] == (1, 0)
+        assert counts['encrypt'] == (1, 0)
+
+    def test_hexcode(self, tmp_path):
+        counts = self.check(tmp_path, b'%PDF-1.4\n/J#53 /#4AS /X#JS /JS#zz /Java#20Script '
+                                      b'/Open#41ction#')
+        assert counts['js'] == (4, 2)
+        assert counts['javascript'] == (0, 0)
+        assert counts['openaction'] == (1, 1)
+
+    def test_random(self, tmp_path):
+        atoms = [b'/JS', b'/J#53', b'/#4', b'#', b'/', b'4A', b'S', b'\xdf', b' ', b'\n',
+                 b'/AA', b'/Launch', b'stream', b'\xff']
+        rand = random.Random(0)
+        for _ in range(100):
+            self.check(tmp_path, b'%PDF-1.7' + b''.join(rand.choice(atoms) for _ in range(30)))
+
+    def test_no_header(self):
+        assert _scan_pdf(b'/JS') is None
+        assert _scan_pdf(b'%PDF-1.') is None
+
+
+@skipif_nodeps
+class TestArchiveBudget:
+
+    def test_limits(self):
+        budget = ArchiveBudget('a.zip', max_size=100, max_entries=2)
+        budget.check(100, 2)
+        budget.charge(60, 1)
+        with pytest.raises(ArchiveBudgetExceeded):
+            budget.check(size=41)
+        with pytest.raises(ArchiveBudgetExceeded):
+            budget.check(entries=2)
+
+    def test_ratio(self):
+        budget = ArchiveBudget('a.zip', compressed_size=0x10000, max_ratio=100)
+        # Small archives are not checked
+        budget.check(0x10000 * 200)
+        with pytest.raises(ArchiveBudgetExceeded) as e:
+            budget.check(0x10000 * 300)
+        assert e.value.budget is budget
+
+
+@skipif_nodeps
+class TestMimeIndexes:
+
+    def test_extension_index(self):
+        assert EXTENSION_MIMETYPES['.pdf'] == 'application/pdf'
+        assert EXTENSION_MIMETYPES['.gz'] == 'application/gzip'
+        # Aliases are applied
+        assert EXTENSION_MIMETYPES['.rtf'] == 'text/rtf'
+        # Depends on the rest of the path (.tar.xz)
+        assert '.xz' not in EXTENSION_MIMETYPES
+
+    def test_mimetype_index(self):
+        assert '.pdf' in MIMETYPE_EXTENSIONS['application/pdf']
+        # Aliases are applied
+        assert '.exe' in MIMETYPE_EXTENSIONS['application/x-dosexec']
+        assert 'application/x-does-not-exist' not in MIMETYPE_EXTENSIONS
+
+    def test_read_only(self):
+        with pytest.raises(TypeError):
+            EXTENSION_MIMETYPES['.pdf'] = 'text/plain'
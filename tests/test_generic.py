@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import sys
+
+import pytest
+
+from examples import generic
+from kittengroomer.helpers import ToolRunner
+
+# Stands for unoconv: listens on --port, or writes the port to --output
+STUB_UNOCONV = '''#!{}
+import socket, sys
+args = sys.argv[1:]
+port = int(args[args.index('--port') + 1])
+if '--listener' in args:
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen()
+    while True:
+        server.accept()[0].close()
+with open(args[args.index('--output') + 1], 'w') as output:
+    output.write(str(port))
+'''
+
+
+@pytest.fixture
+def unoconv(tmpdir, monkeypatch):
+    stub = tmpdir.join('unoconv')
+    stub.write(STUB_UNOCONV.format(sys.executable))
+    stub.chmod(0o755)
+    monkeypatch.setattr(generic, 'UNOCONV', str(stub))
+    return stub
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class TestConverterPool:
+
+    def test_reuse(self, tmpdir, unoconv):
+        port = free_port()
+        pool = generic.ConverterPool(ToolRunner(), size=1, base_port=port, max_documents=2,
+                                     startup_timeout=10)
+        listener = pool._listeners[0]
+        try:
+            pids = []
+            for i in range(3):
+                output = tmpdir.join('{}.pdf'.format(i))
+                result = pool.convert(str(unoconv), str(output))
+                assert result['returncode'] == 0
+                assert output.read() == str(port)
+                pids.append(listener.process.pid)
+            # Warm for max_documents conversions, then recycled
+            assert pids[0] == pids[1] != pids[2]
+            process = listener.process
+        finally:
+            pool.close()
+        assert process.poll() is not None
+        assert listener.process is None
+        assert not os.path.exists(listener.profile)
+
+    def test_failed_conversion(self, tmpdir, unoconv, monkeypatch):
+        # The PDF to HTML step fails, the run goes on and the pool is closed
+        monkeypatch.setattr(generic, 'PDF2HTMLEX', str(tmpdir.join('missing')))
+        src = tmpdir.mkdir('src')
+        src.join('a.txt').write('a\n')
+        src.join('b.txt').write('b\n')
+        groomer = generic.KittenGroomer(str(src), str(tmpdir.join('dst')), converters=1)
+        groomer.processdir()
+        assert all(listener.process is None for listener in groomer.converter_pool._listeners)
+        with open(groomer.log_processing) as log:
+            failures = [line for line in log if 'Conversion of' in line]
+        assert len(failures) == 2
+        assert any('a.txt' in line for line in failures)
+        assert tmpdir.join('dst').listdir() == [tmpdir.join('dst', 'logs')]
@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import errno
+import hashlib
 import os
+import pickle
+import subprocess
+import time
 
 import pytest
 
-from kittengroomer import FileBase, KittenGroomerBase
+from kittengroomer import (CopyEngine, CostModel, FileBase, Hasher, KittenGroomerBase, Journal,
+                           MimeDetector, SubtypeDispatcher, ToolRunner, VerdictCache, Watchdog)
 from kittengroomer.helpers import ImplementationRequired
 
 skip = pytest.mark.skip
@@ -13,6 +19,71 @@ xfail = pytest.mark.xfail
 fixture = pytest.fixture
 
 
+# MimeDetector
+
+class TestMimeDetector:
+
+    @fixture
+    def detector(self):
+        return MimeDetector()
+
+    def test_from_file(self, detector):
+        assert detector.from_file('tests/src_valid/blah.conf') == 'text/plain'
+
+    def test_from_file_bytes_path(self, detector, tmpdir):
+        file_path = tmpdir.join('test.txt')
+        file_path.write('testing')
+        assert detector.from_file(os.fsencode(file_path.strpath)) == 'text/plain'
+
+    def test_from_file_empty(self, detector, tmpdir):
+        file_path = tmpdir.join('empty')
+        file_path.write('')
+        assert detector.from_file(file_path.strpath) == 'inode/x-empty'
+
+    def test_from_buffer_bounded(self, detector):
+        detector.header_size = 4
+        assert detector.from_buffer(b'%PDF-1.4\n' + b'a' * 100) == detector.from_buffer(b'%PDF')
+
+    def test_from_files(self, detector, tmpdir):
+        paths = []
+        for name, content in (('a.txt', 'testing'), ('b.pdf', '%PDF-1.4\n')):
+            file_path = tmpdir.join(name)
+            file_path.write(content)
+            paths.append(file_path.strpath)
+        assert detector.from_files(paths) == ['text/plain', 'application/pdf']
+
+
+# SubtypeDispatcher
+
+class TestSubtypeDispatcher:
+
+    @fixture
+    def dispatcher(self):
+        return SubtypeDispatcher([
+            (['msword', 'vnd.ms-'], 'office'),
+            (['zip', 'compress'], 'archive'),
+            (['x-7z'], 'never'),
+        ])
+
+    def test_substring(self, dispatcher):
+        assert dispatcher.get('vnd.ms-excel') == 'office'
+        assert dispatcher.get('x-zip-compressed') == 'archive'
+
+    def test_priority(self, dispatcher):
+        # Matches both 'compress' and 'x-7z', declared first wins
+        assert dispatcher.get('x-7z-compressed') == 'archive'
+
+    def test_default(self, dispatcher):
+        assert dispatcher.get('pdf') is None
+        assert dispatcher.get('pdf', 'unknown') == 'unknown'
+        assert dispatcher.get('pdf') is None
+
+    def test_cache(self, dispatcher):
+        dispatcher.get('msword')
+        dispatcher.patterns = ()
+        assert dispatcher.get('msword') == 'office'
+
+
 # FileBase
 
 class TestFileBase:
@@ -119,6 +190,34 @@ class TestFileBase:
         # Need to test something that's a directory
         # Need to test something that causes the unicode exception
 
+    def test_mimetype_given(self, source_file, dest_file):
+        file = FileBase(source_file, dest_file, mimetype='text/x-test')
+        assert file.main_type == 'text'
+        assert file.sub_type == 'x-test'
+
+    def test_open_buffer(self, temp_file):
+        buf = temp_file.open_buffer()
+        assert buf.read() == b'testing'
+        assert temp_file.open_buffer() is buf
+        assert buf.tell() == 0
+        temp_file.close()
+        assert temp_file.open_buffer().read() == b'testing'
+        temp_file.close()
+
+    def test_open_buffer_lines(self, tmpdir):
+        file_path = tmpdir.join('lines.txt')
+        file_path.write('a\nb\n')
+        file = FileBase(file_path.strpath, file_path.strpath)
+        assert list(file.open_buffer()) == [b'a\n', b'b\n']
+        file.close()
+
+    def test_open_buffer_empty(self, tmpdir):
+        file_path = tmpdir.join('empty.txt')
+        file_path.write('')
+        file = FileBase(file_path.strpath, file_path.strpath)
+        assert file.open_buffer().read() == b''
+        file.close()
+
     def test_has_mimetype_no_main_type(self, generic_conf_file):
         generic_conf_file.main_type = ''
         assert generic_conf_file.has_mimetype() is False
@@ -213,6 +312,355 @@ class TestFileBase:
         assert generic_conf_file.log_details.get('force_ext') is None
         # shouldn't change a file's extension if it already is right
 
+    def test_verdict(self, generic_conf_file, tmpdir):
+        generic_conf_file.make_unknown()
+        generic_conf_file.force_ext('.txt')
+        generic_conf_file.log_string += 'Text file'
+        verdict = generic_conf_file.get_verdict()
+        assert 'filepath' not in verdict['log_details']
+        file_path = tmpdir.join('other.conf')
+        file_path.write('testing')
+        other = FileBase(file_path.strpath, tmpdir.join('dst', 'other.conf').strpath)
+        other.apply_verdict(verdict)
+        assert other.dst_path == tmpdir.join('dst', 'UNKNOWN_other.conf.txt').strpath
+        assert other.log_details.get('unknown') is True
+        assert other.log_details.get('force_ext') is True
+        assert other.log_string == 'Text file'
+
+
+class TestVerdictCache:
+
+    @fixture
+    def verdict(self):
+        return {'log_details': {'dangerous': True, 'error': ValueError('test')},
+                'log_string': '', 'filename_prefix': 'DANGEROUS_',
+                'filename_suffix': '_DANGEROUS', 'copied': True}
+
+    def test_get_set(self, tmpdir, verdict):
+        cache = VerdictCache(tmpdir.join('cache.db').strpath, '1')
+        assert cache.get('abc', '.txt') is None
+        cache.set('abc', '.txt', verdict)
+        cached = cache.get('abc', '.txt')
+        assert cached['log_details'] == {'dangerous': True, 'error': 'test'}
+        assert cached['filename_prefix'] == 'DANGEROUS_'
+        assert cache.get('abc', '.pdf') is None
+        cache.close()
+
+    def test_version_invalidates(self, tmpdir, verdict):
+        path = tmpdir.join('cache.db').strpath
+        cache = VerdictCache(path, '1')
+        cache.set('abc', '.txt', verdict)
+        cache.close()
+        cache = VerdictCache(path, '2')
+        assert cache.get('abc', '.txt') is None
+        cache.close()
+        cache = VerdictCache(path, '1')
+        assert cache.get('abc', '.txt') is None
+
+    def test_evict(self, tmpdir, verdict):
+        cache = VerdictCache(tmpdir.join('cache.db').strpath, '1', max_entries=2)
+        for digest in ('a', 'b', 'c'):
+            cache.set(digest, '.txt', verdict)
+        cache.get('a', '.txt')
+        cache.evict()
+        assert cache.get('a', '.txt') is not None
+        assert cache.get('b', '.txt') is None
+        assert cache.get('c', '.txt') is not None
+
+    def test_pickle(self, tmpdir, verdict):
+        cache = VerdictCache(tmpdir.join('cache.db').strpath, '1')
+        cache.set('abc', '.txt', verdict)
+        cache = pickle.loads(pickle.dumps(cache))
+        assert cache.get('abc', '.txt') is not None
+
+
+class TestJournal:
+
+    def test_record_load(self, tmpdir):
+        journal = Journal(tmpdir.join('journal.log').strpath)
+        assert journal.load() == {}
+        journal.record('/src/a.txt', '/dst/a.txt', {'copied': True})
+        journal.record('/src/b.exe', '/dst/DANGEROUS_b.exe_DANGEROUS', {'copied': True})
+        journal.close()
+        entries = journal.load()
+        assert sorted(entries) == ['/src/a.txt', '/src/b.exe']
+        assert entries['/src/b.exe']['dst'] == '/dst/DANGEROUS_b.exe_DANGEROUS'
+
+    def test_load_interrupted(self, tmpdir):
+        journal = Journal(tmpdir.join('journal.log').strpath)
+        journal.record('/src/a.txt', '/dst/a.txt', {})
+        journal.close()
+        with open(journal.path, 'a') as f:
+            f.write('{"src": "/src/b.t')
+        assert list(journal.load()) == ['/src/a.txt']
+
+    def test_fsync_interval(self, tmpdir):
+        journal = Journal(tmpdir.join('journal.log').strpath)
+        journal.fsync_interval = 2
+        journal.record('/src/a.txt', '/dst/a.txt', {})
+        assert journal._unsynced == 1
+        journal.record('/src/b.txt', '/dst/b.txt', {})
+        assert journal._unsynced == 0
+        journal.close()
+
+    def test_pickle(self, tmpdir):
+        journal = Journal(tmpdir.join('journal.log').strpath)
+        journal.record('/src/a.txt', '/dst/a.txt', {})
+        journal = pickle.loads(pickle.dumps(journal))
+        journal.record('/src/b.txt', '/dst/b.txt', {})
+        journal.close()
+        assert len(journal.load()) == 2
+
+
+class TestToolRunner:
+
+    def test_run(self):
+        runner = ToolRunner()
+        result = runner.run(['/bin/sh', '-c', 'echo out; exit 3'], stdout=subprocess.PIPE)
+        assert result['tool'] == 'sh'
+        assert result['returncode'] == 3
+        assert result['output'] == b'out\n'
+        assert not result['timed_out']
+
+    def test_cwd(self, tmpdir):
+        runner = ToolRunner()
+        result = runner.run(['pwd'], stdout=subprocess.PIPE, cwd=tmpdir.strpath)
+        assert result['output'].decode().strip() == tmpdir.strpath
+        assert os.getcwd() != tmpdir.strpath
+
+    def test_timeout_kills_group(self, tmpdir):
+        runner = ToolRunner(timeout=0.5)
+        marker = tmpdir.join('marker')
+        start = time.monotonic()
+        # The child of the shell must be killed too
+        result = runner.run(['/bin/sh', '-c', 'sleep 2 && touch {}'.format(marker)])
+        assert result['timed_out']
+        assert time.monotonic() - start < 2
+        time.sleep(2)
+        assert not marker.check()
+
+    def test_limits(self, tmpdir):
+        # Each call marks its start, then succeeds only if it sees the other one running
+        script = ('touch {0}/$0; for n in 1 2 3 4 5 6 7 8 9 10; do '
+                  '[ -e {0}/$1 ] && exit 0; sleep 0.1; done; exit 1')
+        for limit, returncodes in ((1, [1, 0]), (2, [0, 0])):
+            marks = tmpdir.mkdir(str(limit))
+            runner = ToolRunner(limits={'sh': limit})
+            futures = [runner.submit(['sh', '-c', script.format(marks), mine, other])
+                       for mine, other in (('a', 'b'), ('b', 'a'))]
+            assert [f.result()['returncode'] for f in futures] == returncodes
+
+    def test_pickle(self):
+        runner = ToolRunner(limits={'sh': 1})
+        runner.run(['/bin/sh', '-c', 'true'])
+        runner = pickle.loads(pickle.dumps(runner))
+        assert runner.limits == {'sh': 1}
+        assert runner.run(['/bin/sh', '-c', 'true'])['returncode'] == 0
+
+
+@pytest.mark.skipif(not Watchdog.available(), reason='needs os.fork')
+class TestWatchdog:
+
+    def test_result(self):
+        state = []
+        result = Watchdog().run(lambda: state.append(1) or len(state))
+        assert result['result'] == 1
+        assert not result['timed_out'] and not result['oom'] and result['error'] is None
+        # Changes made by the child stay in the child
+        assert state == []
+
+    def test_error(self):
+        result = Watchdog().run(lambda: 1 / 0)
+        assert result['result'] is None
+        assert 'ZeroDivisionError' in result['error']
+
+    def test_timeout(self):
+        start = time.monotonic()
+        result = Watchdog().run(lambda: time.sleep(5), timeout=0.2)
+        assert result['timed_out']
+        assert result['result'] is None
+        assert time.monotonic() - start < 2
+
+    def test_memory(self):
+        watchdog = Watchdog(max_rss=0x4000000)
+        result = watchdog.run(lambda: len(bytearray(0x20000000)), timeout=10)
+        assert result['oom']
+        assert result['result'] is None
+        assert watchdog.run(lambda: len(bytearray(0x100000)))['result'] == 0x100000
+
+
+class TestCostModel:
+
+    def test_fit(self):
+        model = CostModel()
+        assert model.estimate('image/png', 100) == (CostModel.default_per_file +
+                                                    CostModel.default_per_byte * 100)
+        for size in (100, 200, 300):
+            model.record('image/png', size, 1 + size / 100)
+        assert model.estimate('image/png', 1000) == pytest.approx(11)
+        # Unknown subtypes use their main type, then everything
+        assert model.estimate('image/gif', 1000) == pytest.approx(11)
+        model.record('text/plain', 100, 1)
+        assert model.estimate('text/plain', 1000) == pytest.approx(model.estimate('audio/ogg', 1000))
+
+    def test_same_size(self):
+        model = CostModel()
+        model.record('text/plain', 10, 1)
+        model.record('text/plain', 10, 3)
+        assert model.estimate('text/plain', 1000) == pytest.approx(2)
+
+    def test_max_records(self, monkeypatch):
+        monkeypatch.setattr(CostModel, 'max_records', 10)
+        model = CostModel()
+        for i in range(100):
+            model.record('text/plain', 10 + i % 2, 1)
+        assert model.sums['text/plain'][0] <= 10
+        for i in range(100):
+            model.record('text/plain', 10 + i % 2, 5)
+        assert model.estimate('text/plain', 10) == pytest.approx(5, rel=0.01)
+
+    def test_save(self, tmpdir):
+        path = tmpdir.join('costs.json').strpath
+        model = CostModel(path)
+        model.record('text/plain', 10, 1)
+        model.record('text/plain', 20, 2)
+        model.save()
+        assert CostModel(path).estimate('text/plain', 30) == pytest.approx(3)
+        tmpdir.join('costs.json').write('{')
+        assert CostModel(path).sums == {}
+
+
+class TestCopyEngine:
+
+    def test_copy(self, tmpdir):
+        src = tmpdir.join('src.sh')
+        src.write_binary(os.urandom(100000))
+        src.chmod(0o750)
+        dst = tmpdir.join('a', 'b', 'dst.sh')
+        result = CopyEngine().copy(src.strpath, dst.strpath)
+        assert result['error'] is None
+        assert result['size'] == 100000
+        assert dst.read_binary() == src.read_binary()
+        assert dst.stat().mode & 0o777 == 0o750
+        # Only the destination is left, the temporary file was renamed
+        assert dst.dirpath().listdir() == [dst]
+
+    def test_sparse(self, tmpdir):
+        src = tmpdir.join('sparse')
+        with open(src.strpath, 'wb') as f:
+            f.seek(0x4000000)
+            f.write(b'data')
+            f.truncate(0x8000000)
+        if os.stat(src.strpath).st_blocks * 512 >= 0x8000000:
+            pytest.skip('The filesystem does not support sparse files')
+        dst = tmpdir.join('dst')
+        assert CopyEngine().copy(src.strpath, dst.strpath)['error'] is None
+        assert dst.size() == 0x8000000
+        assert os.stat(dst.strpath).st_blocks * 512 < 0x100000
+        with open(dst.strpath, 'rb') as f:
+            f.seek(0x4000000)
+            assert f.read(4) == b'data'
+
+    def test_fallback(self, tmpdir, monkeypatch):
+        def unsupported(*args):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        monkeypatch.setattr(os, 'copy_file_range', unsupported, raising=False)
+        monkeypatch.setattr(os, 'sendfile', unsupported)
+        src = tmpdir.join('src')
+        src.write('text')
+        engine = CopyEngine()
+        result = engine.copy(src.strpath, tmpdir.join('dst').strpath)
+        assert result['method'] == 'read'
+        assert tmpdir.join('dst').read() == 'text'
+
+    def test_error(self, tmpdir):
+        result = CopyEngine().copy(tmpdir.join('missing').strpath, tmpdir.join('dst').strpath)
+        assert result['errno'] == errno.ENOENT
+        assert result['error'] == 'No such file or directory'
+
+    def test_link(self, tmpdir, monkeypatch):
+        src = tmpdir.join('src')
+        src.write('text')
+        dst = tmpdir.join('a', 'dst')
+        dst.write('old', ensure=True)
+        engine = CopyEngine()
+        result = engine.link(src.strpath, dst.strpath)
+        assert result['method'] == 'link'
+        assert dst.read() == 'text'
+        assert os.stat(dst.strpath).st_ino == os.stat(src.strpath).st_ino
+
+        def unsupported(*args):
+            raise OSError(errno.EPERM, 'Operation not permitted')
+        monkeypatch.setattr(os, 'link', unsupported)
+        other = tmpdir.join('a', 'other')
+        assert engine.link(src.strpath, other.strpath)['method'] not in (None, 'link')
+        assert other.read() == 'text'
+        assert os.stat(other.strpath).st_ino != os.stat(src.strpath).st_ino
+        assert engine.link(tmpdir.join('missing').strpath, other.strpath)['errno'] == errno.ENOENT
+
+    def test_dirs_cache(self, tmpdir):
+        engine = CopyEngine()
+        directory = tmpdir.join('a', 'b').strpath
+        engine.makedirs(directory)
+        tmpdir.join('a').remove()
+        src = tmpdir.join('src')
+        src.write('text')
+        # The cached directory is created again
+        assert engine.copy(src.strpath, os.path.join(directory, 'dst'))['error'] is None
+
+    @pytest.mark.parametrize('fsync', ['none', 'file', 'batch', 'end'])
+    def test_fsync(self, tmpdir, fsync):
+        engine = CopyEngine(fsync, batch_size=2)
+        src = tmpdir.join('src')
+        src.write('text')
+        for i in range(3):
+            assert engine.copy(src.strpath, tmpdir.join(str(i)).strpath)['error'] is None
+        assert len(engine.take_unsynced()) == (1 if fsync == 'batch' else 0)
+        # Copies of another process join the batch
+        engine.add_unsynced([tmpdir.join('0').strpath])
+        assert engine.take_unsynced() == ([tmpdir.join('0').strpath] if fsync == 'batch' else [])
+        engine.close()
+        with pytest.raises(ValueError):
+            CopyEngine('always')
+
+
+class TestHasher:
+
+    def test_hash_file(self, tmpdir):
+        data = os.urandom(0x280000)
+        file = tmpdir.join('data')
+        file.write_binary(data)
+        digests, header = Hasher(('sha256',)).hash_file(file.strpath, 100)
+        assert digests == {'sha1': hashlib.sha1(data).hexdigest(),
+                           'sha256': hashlib.sha256(data).hexdigest()}
+        assert header == data[:100]
+
+    def test_tree(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(Hasher, 'chunk_size', 0x1000)
+        data = os.urandom(0x2800)
+        file = tmpdir.join('data')
+        file.write_binary(data)
+        hasher = Hasher(('sha256',), tree_min_size=0x2000)
+        digests, header = hasher.hash_file(file.strpath, 10)
+        chunks = [hashlib.sha256(data[i:i + 0x1000]).digest() for i in range(0, 0x2800, 0x1000)]
+        assert digests == {'sha1': hashlib.sha1(data).hexdigest(),
+                           'sha256-tree': hashlib.sha256(b''.join(chunks)).hexdigest()}
+        assert header == data[:10]
+        # Smaller files are hashed in one piece
+        file.write_binary(data[:0x1000])
+        assert 'sha256' in hasher.hash_file(file.strpath)[0]
+
+    def test_stream(self):
+        hashes = Hasher(('md5',)).new()
+        hashes.update(b'a')
+        hashes.update(b'b')
+        assert hashes.hexdigests() == {'sha1': hashlib.sha1(b'ab').hexdigest(),
+                                       'md5': hashlib.md5(b'ab').hexdigest()}
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            Hasher(('nohash',))
+
 
 class TestKittenGroomerBase:
 
@@ -238,15 +686,84 @@ class TestKittenGroomerBase:
                                           debug=True)
         # we should maybe protect access to self.current_file in some way?
 
+    def test_resume_keeps_logs(self, tmpdir):
+        dst = tmpdir.join('dst').strpath
+        groomer = KittenGroomerBase(tmpdir.strpath, dst)
+        with open(groomer.log_journal, 'w') as f:
+            f.write('')
+        KittenGroomerBase(tmpdir.strpath, dst, resume=True)
+        assert os.path.exists(groomer.log_journal)
+        KittenGroomerBase(tmpdir.strpath, dst)
+        assert not os.path.exists(groomer.log_journal)
+
+    def test_pickle(self, generic_groomer):
+        groomer = pickle.loads(pickle.dumps(generic_groomer))
+        assert groomer.src_root_dir == generic_groomer.src_root_dir
+        assert groomer.log_name
+
     def test_computehash(self, tmpdir):
         file = tmpdir.join('test.txt')
         file.write('testing')
         simple_groomer = KittenGroomerBase(tmpdir.strpath, tmpdir.strpath)
         simple_groomer._computehash(file.strpath)
 
+    def test_hash_and_sniff(self, tmpdir):
+        file = tmpdir.join('test.txt')
+        file.write('testing')
+        simple_groomer = KittenGroomerBase(tmpdir.strpath, tmpdir.strpath)
+        digest, mimetype = simple_groomer._hash_and_sniff(file.strpath)
+        assert digest == simple_groomer._computehash(file.strpath)
+        assert mimetype == 'text/plain'
+
     def test_tree(self, generic_groomer):
         generic_groomer.tree(generic_groomer.src_root_dir)
 
+    def test_tree_sniffs_mimetypes(self, tmpdir):
+        file = tmpdir.join('test.txt')
+        file.write('testing')
+        simple_groomer = KittenGroomerBase(tmpdir.strpath, tmpdir.join('dst').strpath)
+        assert simple_groomer.sniffed_mimetypes[file.strpath] == 'text/plain'
+
+    def test_tree_layout(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('a.txt').write('a')
+        src.mkdir('sub').join('b.txt').write('b')
+        src.join('link').mksymlinkto('/etc/passwd')
+        groomer = KittenGroomerBase(src.strpath, tmpdir.join('dst').strpath)
+        # Each directory is written after its subdirectories
+        assert tmpdir.join('dst', 'logs', 'content.log').read().splitlines() == [
+            '#' * 80,
+            "   |  +- b'sub'/",
+            '   |  |  +-- b.txt\t- e9d71f5ee7c92d6dc9e92ffdad17b8bd49418f98',
+            '#' * 80,
+            "   +- b'src'/",
+            '   |  +-- a.txt\t- 86f7e437faa5a7fce15d1ddcb9eaeaea377667b8',
+            '   |  +-- link\t- Symbolic link to /etc/passwd',
+        ]
+        assert groomer.digests[src.join('sub', 'b.txt').strpath] == {
+            'sha1': 'e9d71f5ee7c92d6dc9e92ffdad17b8bd49418f98'}
+
+    def test_tree_digests(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('a.txt').write('a')
+        groomer = KittenGroomerBase(src.strpath, tmpdir.join('dst').strpath,
+                                    digest_algorithms=('sha256', 'blake2b'))
+        digests = groomer.digests[src.join('a.txt').strpath]
+        assert digests['sha1'] == hashlib.sha1(b'a').hexdigest()
+        assert digests['sha256'] == hashlib.sha256(b'a').hexdigest()
+        assert digests['blake2b'] == hashlib.blake2b(b'a').hexdigest()
+
+    def test_tree_workers(self, tmpdir, monkeypatch):
+        src = tmpdir.mkdir('src')
+        for i in range(40):
+            src.ensure('d{}'.format(i % 3), 'f{}-{}'.format(i, 'x' * 100)).write(str(i))
+        logs = []
+        for workers in (1, 8):
+            monkeypatch.setattr(KittenGroomerBase, 'hash_workers', workers)
+            KittenGroomerBase(src.strpath, tmpdir.join('dst').strpath)
+            logs.append(tmpdir.join('dst', 'logs', 'content.log').read())
+        assert logs[0] == logs[1]
+
     def test_safe_copy(self, tmpdir):
         file = tmpdir.join('test.txt')
         file.write('testing')
@@ -257,6 +774,21 @@ class TestKittenGroomerBase:
         simple_groomer.cur_file = FileBase(file.strpath, filedest.strpath)
         assert simple_groomer._safe_copy() is True
         #check that it handles weird file path inputs
+        missing = tmpdir.join('missing.txt')
+        missing.write('removed')
+        simple_groomer.cur_file = FileBase(missing.strpath, filedest.strpath)
+        missing.remove()
+        assert simple_groomer._safe_copy() is False
+        assert simple_groomer.cur_file.log_details['copy_error'] == 'No such file or directory'
+
+    def test_run_process(self, tmpdir):
+        groomer = KittenGroomerBase(tmpdir.mkdir('src').strpath, tmpdir.join('dst').strpath)
+        file = tmpdir.join('src', 'test.txt')
+        file.write('test')
+        groomer.cur_file = FileBase(file.strpath, tmpdir.join('dst', 'test.txt').strpath)
+        assert groomer._run_process('/bin/sh -c "exit 0"')
+        assert groomer._run_process('/bin/sh -c "exit 1"') is None
+        assert groomer.cur_file.log_details['sh']['returncode'] == 1
 
     def test_safe_metadata_split(self, tmpdir):
         file = tmpdir.join('test.txt')
@@ -280,6 +812,37 @@ class TestKittenGroomerBase:
         assert file.strpath in files
         assert testdir.strpath not in files
 
+    def test_list_all_files_sorted(self, tmpdir):
+        for name in ('b.txt', 'a.txt', 'c.txt'):
+            tmpdir.join(name).write('testing')
+        simple_groomer = KittenGroomerBase(tmpdir.strpath, tmpdir.strpath)
+        files = list(simple_groomer._list_all_files(simple_groomer.src_root_dir))
+        assert files == sorted(files)
+
+    def test_walk_files(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('big.txt').write('x' * 100)
+        src.mkdir('src').join('small.txt').write('x')
+        src.join('src', 'medium.txt').write('x' * 10)
+        src.mkdir('linked').join('inside.txt').write('x')
+        src.join('dirlink').mksymlinkto(src.join('linked'))
+        src.join('filelink').mksymlinkto(src.join('big.txt'))
+        groomer = KittenGroomerBase(src.strpath, tmpdir.join('dst').strpath)
+        entries = list(groomer._walk_files(src.strpath, '/dst'))
+        # Same files and order as os.walk, the source prefix is not replaced in the path
+        walked = [os.path.join(root, name) for root, dirs, files in os.walk(src.strpath)
+                  for name in sorted(files) if not dirs.sort()]
+        assert [entry.path for entry in entries] == walked
+        assert [entry.relative_path for entry in entries] == [
+            'big.txt', 'filelink', 'linked/inside.txt', 'src/medium.txt', 'src/small.txt']
+        assert entries[3].dst_path == '/dst/src/medium.txt'
+        assert entries[1].entry.is_symlink()
+        by_size = [entry.relative_path for entry in groomer._walk_files(src.strpath, by_size=True)]
+        # Ties in walk order, the size of the symlink itself is the length of its target
+        assert [path for path in by_size if path != 'filelink'] == [
+            'big.txt', 'src/medium.txt', 'linked/inside.txt', 'src/small.txt']
+        assert FileBase(entries[0].path, entries[0].dst_path, entry=entries[0].entry).size == 100
+
     def test_print_log(self, generic_groomer):
         with pytest.raises(AttributeError):
             generic_groomer._print_log()